@@ -48,13 +48,13 @@ force_https_domains = "NONE"
 # v0.19.0+ Automatic Domains Whitelist (Experimental)
 # by given wild match domains (glob syntax, '*.example.com'), if we got domains match these cases,
 #   it would be automatically added to the `external_domains`
-# However, before you restart your server, you should check the 'automatic_domains_whitelist.log' file,
-#   and manually add domains to the config, or it would not work after you restart your server
+# The added domains are saved to the 'automatic_domains_whitelist.log' file, and loaded again after restart,
+#   you may still want to check it and add the domains to the config manually
 # You CANNOT relay on the automatic whitelist, because the basic (but important) rewrite require specified domains to work.
 # For More Supported Pattern Please See: https://docs.python.org/3/library/fnmatch.html#module-fnmatch
 # 如果给定以通配符形式的域名, 当程序遇到匹配的域名时, 将会自动加入到 `external_domains` 的列表中
-# 但是, 当你重启服务器程序前, 请检查程序目录下 'automatic_domains_whitelist.log' 文件,
-#   并将里面的域名手动添加到 `external_domains` 的列表中 (因为程序不会在运行时修改本配置文件)
+# 自动添加的域名会保存在程序目录下 'automatic_domains_whitelist.log' 文件中, 重启后会自动加载,
+#   也可以将里面的域名手动添加到 `external_domains` 的列表中 (程序不会在运行时修改本配置文件)
 # 自动域名添加白名单功能并不能取代 `external_domains` 中一个个指定的域名,
 #   因为基础重写(很重要)不支持使用通配符(否则会带来10倍以上的性能下降).
 # 如果需要使用 * 以外的通配符, 请查看 https://docs.python.org/3/library/fnmatch.html#module-fnmatch 这里的的说明
@@ -63,6 +63,23 @@ automatic_domains_whitelist_enable = True
 # domains_whitelist_auto_add_glob_list = ('*.google.com', '*.gstatic.com', '*.google.com.hk')
 domains_whitelist_auto_add_glob_list = ("*.dingtalkcloud.com",)
 
+# Max number of automatically added domains, matched domains beyond it are ignored
+# Added domains are appended to `automatic_domains_whitelist_file` and loaded again after restart
+#   (if they still match the globs above), None to disable
+# 自动添加的域名的最大个数, 超过后不再添加
+# 自动添加的域名会被追加到这个文件中, 重启后会自动加载(仍然需要匹配上面的通配符), None 表示不保存
+automatic_domains_whitelist_max_size = 1000
+automatic_domains_whitelist_file = "automatic_domains_whitelist.log"
+
+# How the Path attribute of the remote Set-Cookie headers is rewritten
+#   None: keep it as is
+#   False: cookies of external domains are moved under their sub-site, eg. for a.foobar.com
+#       Path=/verify  -->  Path=/extdomains/a.foobar.com/verify  (cookies of the main domains are kept as is)
+#   True: every Path is rewritten to /
+# 远程响应 Set-Cookie 中 Path 的重写方式:
+#   None: 不重写; False: 外部域名的cookie的Path被放到对应的子站路径下(主域名不变); True: 所有的Path都重写为 /
+aggressive_cookies_rewrite = None
+
 # ############## Proxy Settings ##############
 # Global proxy option, True or False (case sensitive)
 # Tip: If you want to make an GOOGLE mirror in China, you need an foreign proxy.
@@ -81,6 +98,28 @@ proxy_settings = dict(
 # 注意: 在正式部署到服务器后, 请把这个值修改为2, 如果设置为3或4,会产生非常大量的debug输出
 verbose_level = 3
 
+# Logs are formatted and written by a background thread, logs above `verbose_level` cost almost nothing
+#   "text": human readable, colorful in terminal; "json": one json object per line, for log collectors
+#   every log line carries the id of the request being handled (from the X-Request-ID header, or generated)
+# 日志由后台线程写入, 超过 verbose_level 的日志几乎没有开销; 每条日志都带有当前请求的id, 方便关联同一个请求的日志
+log_format = "text"  # or "json"
+log_file = None  # None for stdout
+# only a fraction of the debug logs (v>=3) are written, helpful if you need debug logs under heavy traffic
+# 只输出一部分debug日志(v>=3), 在大流量下需要debug日志时使用, 1 表示全部输出
+log_debug_sample_rate = 1.0
+log_queue_size = 10000
+
+# Access log, one json line per request: method, mirrored/remote url, status, bytes in/out,
+#   cache result (hit/miss/stale...), stream or not, and the duration of each stage
+#   buffered and written by a background thread, rotated when larger than `access_log_max_bytes`
+#   summarize slow urls and cache hit ratio with: python -m mirror_core.access_log logs/access.jsonl*
+# 访问日志, 每个请求一行json, 可以用上面的命令统计慢url和缓存命中率等
+access_log_enable = True
+access_log_path = "logs/access.jsonl"
+access_log_max_bytes = 52428800  # 50MB
+access_log_backup_count = 5
+access_log_flush_interval = 1  # seconds
+
 # #####################################################
 # ################# ADVANCED Settings #################
 # #####################################################
@@ -117,9 +156,94 @@ force_decode_with_charsets = None
 # this will be helpful to solve Chinese GBK issues
 possible_charsets = ["utf-8", "GBK"]
 
+# Before the `possible_charsets`, the charset in BOM, Content-Type, <meta charset> and the last one detected
+#   for the same domain and mime are tried. A charset is verified by decoding the first N bytes of the text,
+#   and then the whole text is decoded only once
+# 编码检测时只解码文本开头的N个字节来验证编码, 找到编码以后整个文本只解码一次
+charset_detect_prefix_size = 65536
+
 # v0.29.1+ Keep-Alive Per domain
 connection_keep_alive_enable = True
 
+# Cache the dns resolution results of `allowed_domains` in memory
+#   new connections to the remote server would not wait for dns lookups
+#   if the re-resolution fails after expired, the stale result would be used
+# 在内存中缓存被镜像域名的DNS解析结果, 过期后若重新解析失败, 会继续使用旧的结果
+dns_cache_enable = True
+dns_cache_ttl = 300
+
+# Resolve and open keep-alive connections to the target domain and the most used external domains
+#   at startup, and refresh them every `connection_prewarm_interval` seconds
+#   requires `connection_keep_alive_enable`
+# 启动时预先建立到主域名和最常用的外部域名的 keep-alive 连接, 并定时刷新, 使用户请求不需要等待握手
+connection_prewarm_enable = True
+connection_prewarm_interval = 60
+connection_prewarm_max_domains = 8
+
+# Timeouts (seconds) when requesting the remote server
+#   the read timeout is the max time between two received bytes, not the total response time
+# 请求远程服务器的超时时间(秒), 读取超时指两次收到数据之间的最大间隔, 而不是整个响应的时间
+remote_connect_timeout = 5
+remote_read_timeout = 30
+
+# Max retries for idempotent requests (GET/HEAD/OPTIONS) when connection or read errors occur
+# 幂等请求(GET/HEAD/OPTIONS)在连接或读取出错时的最大重试次数, 0 表示不重试
+remote_retry_count = 2
+
+# Per domain circuit breaker
+#   if a remote domain fails `circuit_breaker_failure_threshold` times in a row (timeout/connection error/502/503/504)
+#   requests to it would fail fast in the next `circuit_breaker_recovery_time` seconds
+# 某个远程域名连续失败达到阈值后, 在接下来的一段时间内对它的请求会立即失败, 避免工作线程堆积
+circuit_breaker_enable = True
+circuit_breaker_failure_threshold = 5
+circuit_breaker_recovery_time = 30
+
+# Internal errors: a small precomputed error page is sent unless `error_page_show_detail` is enabled
+#   tracebacks and snapshot dumps (to the `error_dump` folder) are sampled and rate limited,
+#   so a burst of errors would not turn into a burst of disk io; error counts per host and kind are in the metrics
+#   snapshots leave out secrets (`admin_token`, proxy settings, Authorization/Cookie headers), but still contain
+#   urls and request data, so they are disabled by default
+# 内部错误时默认只返回一个简单的页面, traceback输出和快照dump有频率限制, 避免大量错误时给本机带来额外的负担
+#   快照中不含密钥(`admin_token`, 代理设置, Authorization/Cookie请求头), 但是仍然含有url和请求数据, 所以默认不启用
+error_page_show_detail = False
+error_snapshot_enable = False
+error_snapshot_max_per_minute = 6
+error_snapshot_sample_rate = 1.0
+
+# Per-stage timing histograms (url decode, header extract, cache lookup/store, upstream connect/ttfb/body,
+#   rewrite, cookie rewrite, compress, stream) and counters, in the Prometheus text format
+#   available at `metrics_path`, only for clients in `metrics_allowed_ips` with the `admin_token` (see below)
+#   `metrics_path?format=json` returns the throughput of every active and recently finished stream instead
+# 记录请求处理各个阶段的耗时和一些计数器, 可以在 `metrics_path` 以 Prometheus 的格式获取, 只允许指定的IP并且带有 `admin_token` 的请求访问
+#   `metrics_path?format=json` 返回每个正在进行的, 以及最近结束的stream的吞吐量统计
+metrics_enable = True
+metrics_path = "/__zmirror_metrics__"
+metrics_allowed_ips = ("127.0.0.1", "::1")
+
+# Secret token of the admin endpoints (metrics and the profiler), clients must send "Authorization: Bearer <admin_token>"
+#   Behind a reverse proxy (eg. a local nginx) every visitor has the proxy's ip, so the ip allow lists are not enough
+#   None to disable the admin endpoints
+# 管理页面(统计数据, 采样分析器)的密钥, 请求头中需要带有 "Authorization: Bearer <admin_token>"
+#   在反向代理(比如本机的nginx)之后, 所有访问者的IP都是代理的IP, 只限制IP是不够的. 为None时管理页面不可访问
+admin_token = None
+
+# Built-in sampling profiler, samples the stacks of all threads (request handlers, stream preloaders...)
+#   and writes a collapsed-stack (flamegraph.pl) or speedscope (https://www.speedscope.app) file to `profiler_output_dir`
+#   start it by visiting `profiler_path` from `profiler_allowed_ips` with the `admin_token`,
+#   eg: curl -H "Authorization: Bearer <admin_token>" "http://127.0.0.1/__zmirror_profile__?seconds=30&format=speedscope"
+#   or by sending `profiler_signal` to the process, eg: kill -USR2 <pid>  (None to disable the signal)
+#   only one run at a time
+# 运行中的采样分析器, 可以在不重启的情况下找出性能热点
+#   访问 `profiler_path`(需要 `admin_token`) 或者向进程发送 `profiler_signal` 信号即可开始采样, 结果写入 `profiler_output_dir` 文件夹
+profiler_enable = False
+profiler_path = "/__zmirror_profile__"
+profiler_allowed_ips = ("127.0.0.1", "::1")
+profiler_signal = "SIGUSR2"
+profiler_seconds = 30
+profiler_interval = 0.005  # seconds
+profiler_format = "collapsed"  # or "speedscope"
+profiler_output_dir = "profile_dump"
+
 # ############## Builtin server ##############
 # v0.23.1+ configs for flask builtin server (only affect when directly run wsgi.py)
 
@@ -144,6 +268,19 @@ builtin_server_extra_options = {}
 #   an 304 response support is implanted inside
 local_cache_enable = True
 
+# Responses relayed in stream mode (eg. large media) are written to disk while being sent,
+#   bodies larger than `local_cache_max_stream_size` bytes are not cached, other responses are limited to 8MB
+#   When all cache files together exceed `local_cache_max_disk_size` bytes, the least recently used ones are evicted
+# stream模式传输的响应(比如大的媒体文件)在发送的同时写入磁盘, 超过 `local_cache_max_stream_size` 字节的不缓存,
+#   其他响应的上限是8MB. 所有缓存文件的总大小超过 `local_cache_max_disk_size` 字节时, 删除最久未使用的
+local_cache_max_stream_size = 1073741824  # 1GB
+local_cache_max_disk_size = 10737418240  # 10GB
+
+# A Range request covered by another in-flight Range request waits for it (then reads the cached segment)
+#   at most this many seconds, after that it requests the remote server itself
+# 被正在进行的另一个Range请求覆盖的Range请求, 最多等待它这么多秒(然后从分段缓存中读取), 超时后自己向远程服务器请求
+range_coalesce_wait_timeout = 2
+
 # ############## Custom Content Injection #############
 # v0.29.4+
 # 允许方便地向某些页面的某些地方插入文本内容(js/css等)
@@ -482,12 +619,51 @@ stream_transfer_enable = True
 # )
 
 # v0.20.1+ streamed content fetch size (per package)
+#   this is the initial size, it grows (up to `stream_buffer_max_size`) when both the remote server and the client are fast,
+#   and shrinks when the client can not keep up or the remote server is slow
+# 这是初始大小, 远程服务器和浏览器都很快时会逐渐增大, 浏览器跟不上或远程服务器很慢时会减小
 stream_buffer_size = 16384  # 16KB
+stream_buffer_max_size = 262144  # 256KB
+
+# If a client stops reading a streamed response for this many seconds,
+#   the remote connection is closed instead of being held open (and filling our buffers) for it
+# 浏览器超过这个时间没有读取stream响应时, 关闭远程连接, 而不是一直占用连接和内存
+stream_client_stall_timeout = 30
+
+# All streamed responses share one preload thread pool, so the number of threads stays flat
+#   no matter how many videos are being watched.
+#   At most `stream_preload_max_workers` streams are preloaded at the same time,
+#   streams beyond that are sent synchronously (read a piece, send a piece) without preload.
+#   A preload holds its thread until the whole stream is sent, so there is no waiting queue
+# 所有stream共享一个预读线程池, 线程数量不会随着stream的数量增长
+#   超出线程池容量的stream会在请求线程中边读边发, 不进行预读.
+#   预读会一直占用线程直到整个stream传输完成, 所以不设等待队列
+stream_preload_max_workers = 32
 
 # v0.21.0+ streamed content async preload -- max preload packages number
 # 异步加载缓冲区存储的数据包的最大数量, 不要设置得太小
 stream_transfer_async_preload_max_packages_size = 15
 
+# When streamed binary content is relayed as-is (no decompression needed),
+#   data is read from the remote socket directly into a few reusable buffers of (at most) this size
+#   at most `stream_relay_buffer_size` * `stream_relay_buffer_count` bytes are buffered per response
+# 当stream模式的二进制内容可以原样透传时, 会直接从远程连接读取到几个可复用的缓冲区中, 而不是为每个数据块创建新对象
+stream_relay_buffer_size = 262144  # 256KB
+stream_relay_buffer_count = 4
+
+# ############## Response Compression ##############
+# Binary responses are passed through to the client in the remote server's original (compressed) form,
+#   while rewritten text responses are compressed once with this level (1~9), and the compressed one is cached
+#   the encoding (br, zstd or gzip) is chosen by the client's Accept-Encoding,
+#   br and zstd require the optional `brotli` and `zstandard` packages
+#   set to 0 to disable compression of rewritten text
+# 二进制响应会以远程服务器的原始(压缩)形式直接发送给浏览器
+#   重写后的文本响应会以此压缩级别压缩一次, 并缓存压缩后的结果, 设置为0则不压缩
+#   根据浏览器的 Accept-Encoding 选择 br zstd 或 gzip, 其中 br 和 zstd 需要安装 `brotli` 和 `zstandard` 库
+response_compress_level = 6
+# text responses smaller than this size (bytes) would not be compressed
+response_compress_min_size = 1024
+
 # ############## Cron Tasks ##############
 # v0.21.4+ Cron Tasks, if you really know what you are doing, please do not disable this option
 # 定时任务, 除非你真的知道你在做什么, 否则请不要关闭本选项
@@ -759,6 +935,30 @@ custom_text_rewriter_enable = False
 #   in these cases, you can add them here
 text_like_mime_types = ("text", "json", "javascript", "xml")
 
+# Request headers which never contain urls, they are sent to remote as is, without the domain rewriting
+#   the values of other headers (cookie, referer, origin...) are rewritten, and the results are memoized,
+#   `request_rewrite_cache_size` is the max number of memoized values, 0 to disable
+# 这些请求头中不会有url, 不进行域名重写, 原样发送给远程服务器; 其他请求头的重写结果会被缓存
+# request_rewrite_skip_headers = {"accept", "accept-language", "user-agent", "cache-control", ...}
+request_rewrite_cache_size = 4096
+
+# Request bodies (POST/PUT) larger than this, with unknown size (chunked), or binary ones (such as file uploads),
+#   are streamed to the remote server chunk by chunk, without being read into memory or rewritten
+# 大于这个大小(字节), 大小未知, 或者二进制的请求体(比如上传的文件)会边读取边发送给远程服务器, 不进行重写
+request_body_rewrite_max_size = 1048576  # 1MB
+
+# Max number of memoized urls in each direction of the url mapping
+#   (mirror url --> remote url for every request, remote url --> mirror url for redirects), 0 to disable
+# 镜像url与远程url相互转换的缓存大小(每个方向), 0 表示不缓存
+url_mapping_cache_size = 4096
+
+# When the domain set changes (such as by the automatic domains whitelist), the affected regex patterns are recompiled
+#   in a background thread and swapped in atomically, requests keep using the old ones meanwhile
+#   At most this fraction of time is spent on compiling, changes arriving in between are merged into one rebuild
+# 域名改变时(比如自动白名单), 受影响的正则会在后台线程中重新编译, 然后整体替换, 请求不需要等待
+#   编译所用的时间最多占这个比例, 期间的多次改变会被合并为一次编译
+pattern_rebuild_budget = 0.05
+
 # v0.21.2+ Only serve static resources (based on mime)
 #   Only if remote response's mime contains in the `mime_to_use_cdn`, would be sent to client
 #       however, any request would be sent to remote
@@ -82,6 +82,15 @@ class Config:
 
         ######### advanced settings #########
         self._verbose_level = 2
+        self._log_format = "text"
+        self._log_file = None
+        self._log_debug_sample_rate = 1.0
+        self._log_queue_size = 10000
+        self._access_log_enable = True
+        self._access_log_path = "logs/access.jsonl"
+        self._access_log_max_bytes = 50 * 1024 * 1024  # 50MB
+        self._access_log_backup_count = 5
+        self._access_log_flush_interval = 1
 
         self._builtin_server_host = "0.0.0.0"
         self._builtin_server_debug = False
@@ -93,6 +102,8 @@ class Config:
         self._custom_allowed_origin = None
         self._automatic_domains_whitelist_enable = True
         self._domains_whitelist_auto_add_glob_list = ()
+        self._automatic_domains_whitelist_max_size = 1000
+        self._automatic_domains_whitelist_file = "automatic_domains_whitelist.log"
         self._aggressive_cookies_rewrite = None
 
         self._global_ua_white_name = "qiniu-imgstg-spider"
@@ -100,13 +111,52 @@ class Config:
 
         self._force_decode_with_charsets = None
         self._possible_charsets = ["utf-8", "gbk", "big5", "latin1"]
+        self._charset_detect_prefix_size = 65536
 
         self._connection_keep_alive_enable = True
+        self._dns_cache_enable = True
+        self._dns_cache_ttl = 300
+        self._connection_prewarm_enable = True
+        self._connection_prewarm_interval = 60
+        self._connection_prewarm_max_domains = 8
+        self._remote_connect_timeout = 5
+        self._remote_read_timeout = 30
+        self._remote_retry_count = 2
+        self._circuit_breaker_enable = True
+        self._circuit_breaker_failure_threshold = 5
+        self._circuit_breaker_recovery_time = 30
+        self._error_page_show_detail = False
+        self._error_snapshot_enable = False
+        self._error_snapshot_max_per_minute = 6
+        self._error_snapshot_sample_rate = 1.0
+        self._admin_token = None
+        self._metrics_enable = True
+        self._metrics_path = "/__zmirror_metrics__"
+        self._metrics_allowed_ips = ("127.0.0.1", "::1")
+        self._profiler_enable = False
+        self._profiler_path = "/__zmirror_profile__"
+        self._profiler_allowed_ips = ("127.0.0.1", "::1")
+        self._profiler_signal = "SIGUSR2"
+        self._profiler_seconds = 30
+        self._profiler_interval = 0.005
+        self._profiler_format = "collapsed"
+        self._profiler_output_dir = "profile_dump"
         self._local_cache_enable = True
+        self._local_cache_max_stream_size = 1073741824
+        self._local_cache_max_disk_size = 10737418240
+        self._range_coalesce_wait_timeout = 2
 
         self._stream_transfer_enable = True
         self._stream_buffer_size = 1024 * 16  # 16KB
+        self._stream_buffer_max_size = 1024 * 256  # 256KB
+        self._stream_client_stall_timeout = 30
+        self._stream_preload_max_workers = 32
         self._stream_transfer_async_preload_max_packages_size = 15
+        self._stream_relay_buffer_size = 1024 * 256  # 256KB
+        self._stream_relay_buffer_count = 4
+
+        self._response_compress_level = 6
+        self._response_compress_min_size = 1024
 
         self._cron_task_enable = True
         self._cron_task_list = [
@@ -128,6 +178,37 @@ class Config:
 
         self._custom_text_rewriter_enable = False
         self._text_like_mime_types = set(["text", "json", "javascript", "xml"])
+        self._request_rewrite_skip_headers = {
+            "accept",
+            "accept-charset",
+            "accept-language",
+            "cache-control",
+            "connection",
+            "content-type",
+            "dnt",
+            "if-match",
+            "if-modified-since",
+            "if-none-match",
+            "if-range",
+            "if-unmodified-since",
+            "pragma",
+            "priority",
+            "range",
+            "sec-ch-ua",
+            "sec-ch-ua-mobile",
+            "sec-ch-ua-platform",
+            "sec-fetch-dest",
+            "sec-fetch-mode",
+            "sec-fetch-site",
+            "sec-fetch-user",
+            "te",
+            "upgrade-insecure-requests",
+            "user-agent",
+        }
+        self._request_rewrite_cache_size = 4096
+        self._request_body_rewrite_max_size = 1024 * 1024  # 1MB
+        self._url_mapping_cache_size = 4096
+        self._pattern_rebuild_budget = 0.05
         self._custom_inject_content = {}
 
         ######### developer settings #########
@@ -146,6 +227,7 @@ class Config:
             "server",
             "location",
             "accept-ranges",
+            "content-range",
             "access-control-allow-origin",
             "access-control-allow-headers",
             "access-control-allow-methods",
@@ -365,6 +447,108 @@ class Config:
     def verbose_level(self, value):
         self._verbose_level = value
 
+    @property
+    def log_format(self):
+        """
+        "text" (colorful, human readable) or "json" (one json object per line, with request id)
+        """
+        return self._log_format
+
+    @log_format.setter
+    def log_format(self, value):
+        self._log_format = value
+
+    @property
+    def log_file(self):
+        """
+        write logs to this file instead of stdout, None for stdout
+        """
+        return self._log_file
+
+    @log_file.setter
+    def log_file(self, value):
+        self._log_file = value
+
+    @property
+    def log_debug_sample_rate(self):
+        """
+        only this fraction (0~1) of the debug logs (v>=3) are written, 1 means all of them
+        """
+        return self._log_debug_sample_rate
+
+    @log_debug_sample_rate.setter
+    def log_debug_sample_rate(self, value):
+        self._log_debug_sample_rate = value
+
+    @property
+    def log_queue_size(self):
+        """
+        logs are written by a background thread, at most this many logs can be waiting,
+        more are dropped (and counted) instead of blocking the requests
+        """
+        return self._log_queue_size
+
+    @log_queue_size.setter
+    def log_queue_size(self, value):
+        self._log_queue_size = value
+
+    @property
+    def access_log_enable(self):
+        """
+        Write an access log, one json object per request: method, urls, status, bytes in/out,
+        cache result, stream or not and per-stage durations.
+        summarize it with: python -m mirror_core.access_log <files>
+        """
+        return self._access_log_enable
+
+    @access_log_enable.setter
+    def access_log_enable(self, value):
+        self._access_log_enable = value
+
+    @property
+    def access_log_path(self):
+        """
+        path of the access log file, the folder would be created if not exists
+        """
+        return self._access_log_path
+
+    @access_log_path.setter
+    def access_log_path(self, value):
+        self._access_log_path = value
+
+    @property
+    def access_log_max_bytes(self):
+        """
+        the access log is rotated (access.jsonl -> access.jsonl.1 -> ...) when it grows larger than this, 0 to disable
+        """
+        return self._access_log_max_bytes
+
+    @access_log_max_bytes.setter
+    def access_log_max_bytes(self, value):
+        self._access_log_max_bytes = value
+
+    @property
+    def access_log_backup_count(self):
+        """
+        number of rotated access log files to keep
+        """
+        return self._access_log_backup_count
+
+    @access_log_backup_count.setter
+    def access_log_backup_count(self, value):
+        self._access_log_backup_count = value
+
+    @property
+    def access_log_flush_interval(self):
+        """
+        seconds between two writes of the buffered access log entries
+        """
+        return self._access_log_flush_interval
+
+    @access_log_flush_interval.setter
+    def access_log_flush_interval(self, value):
+        self._access_log_flush_interval = value
+
     @property
     def builtin_server_host(self):
         return self._builtin_server_host
@@ -439,8 +623,8 @@ class Config:
         Automatic Domains Whitelist
         by given wild match domains (glob syntax, '*.example.com'), if we got domains match these cases,
         it would be automatically added to the `external_domains`
-        # However, before you restart your server, you should check the 'automatic_domains_whitelist.log' file,
-        and manually add domains to the config, or it would not work after you restart your server
+        The added domains are saved to the 'automatic_domains_whitelist.log' file, and loaded again after restart,
+        you may still want to check it and add the domains to the config manually
         You CANNOT relay on the automatic whitelist, because the basic (but important) rewrite require specified domains to work.
         For More Supported Pattern Please See: https://docs.python.org/3/library/fnmatch.html#module-fnmatch
         """
@@ -458,8 +642,35 @@ class Config:
     def domains_whitelist_auto_add_glob_list(self, value):
         self._domains_whitelist_auto_add_glob_list = value
 
+    @property
+    def automatic_domains_whitelist_max_size(self):
+        """
+        max number of domains the automatic whitelist would add, further matched domains are ignored
+        """
+        return self._automatic_domains_whitelist_max_size
+
+    @automatic_domains_whitelist_max_size.setter
+    def automatic_domains_whitelist_max_size(self, value):
+        self._automatic_domains_whitelist_max_size = value
+
+    @property
+    def automatic_domains_whitelist_file(self):
+        """
+        domains added by the automatic whitelist are appended to this file, and loaded again after restart,
+        None to disable
+        """
+        return self._automatic_domains_whitelist_file
+
+    @automatic_domains_whitelist_file.setter
+    def automatic_domains_whitelist_file(self, value):
+        self._automatic_domains_whitelist_file = value
+
     @property
     def aggressive_cookies_rewrite(self):
+        """
+        rewrite the Path of remote Set-Cookie headers: None keeps it, False moves cookies of external domains
+        under their sub-site (/extdomains/domain/...), True rewrites every Path to /
+        """
         return self._aggressive_cookies_rewrite
 
     @aggressive_cookies_rewrite.setter
@@ -517,6 +728,18 @@ class Config:
     def possible_charsets(self, value):
         self._possible_charsets = value
 
+    @property
+    def charset_detect_prefix_size(self):
+        """
+        how many bytes at the beginning of a text are decoded to verify a charset,
+        the whole text is decoded only once, with the charset found
+        """
+        return self._charset_detect_prefix_size
+
+    @charset_detect_prefix_size.setter
+    def charset_detect_prefix_size(self, value):
+        self._charset_detect_prefix_size = value
+
     @property
     def connection_keep_alive_enable(self):
         """
@@ -528,6 +751,317 @@ class Config:
     def connection_keep_alive_enable(self, value):
         self._connection_keep_alive_enable = value
 
+    @property
+    def dns_cache_enable(self):
+        """
+        Cache the dns resolution results of `allowed_domains` in memory,
+        so that new connections to the remote server do not have to wait for dns lookups
+        """
+        return self._dns_cache_enable
+
+    @dns_cache_enable.setter
+    def dns_cache_enable(self, value):
+        self._dns_cache_enable = value
+
+    @property
+    def dns_cache_ttl(self):
+        """
+        seconds before a cached dns resolution result expires
+        """
+        return self._dns_cache_ttl
+
+    @dns_cache_ttl.setter
+    def dns_cache_ttl(self, value):
+        self._dns_cache_ttl = value
+
+    @property
+    def connection_prewarm_enable(self):
+        """
+        Resolve and open keep-alive connections to the target domain and the most used external domains
+        at startup, and refresh them periodically, so user requests would not pay the connection latency.
+        requires `connection_keep_alive_enable`
+        """
+        return self._connection_prewarm_enable and self._connection_keep_alive_enable
+
+    @connection_prewarm_enable.setter
+    def connection_prewarm_enable(self, value):
+        self._connection_prewarm_enable = value
+
+    @property
+    def connection_prewarm_interval(self):
+        """
+        seconds between two connection pre-warming rounds,
+        should be less than the session ttl (180s) in connection_pool
+        """
+        return self._connection_prewarm_interval
+
+    @connection_prewarm_interval.setter
+    def connection_prewarm_interval(self, value):
+        self._connection_prewarm_interval = value
+
+    @property
+    def connection_prewarm_max_domains(self):
+        """
+        max number of domains to pre-warm, the target domain is always included,
+        other domains are chosen by their recent usage
+        """
+        return self._connection_prewarm_max_domains
+
+    @connection_prewarm_max_domains.setter
+    def connection_prewarm_max_domains(self, value):
+        self._connection_prewarm_max_domains = value
+
+    @property
+    def remote_connect_timeout(self):
+        """
+        seconds to wait for establishing a connection to the remote server
+        """
+        return self._remote_connect_timeout
+
+    @remote_connect_timeout.setter
+    def remote_connect_timeout(self, value):
+        self._remote_connect_timeout = value
+
+    @property
+    def remote_read_timeout(self):
+        """
+        seconds to wait between two bytes received from the remote server (not the total response time)
+        """
+        return self._remote_read_timeout
+
+    @remote_read_timeout.setter
+    def remote_read_timeout(self, value):
+        self._remote_read_timeout = value
+
+    @property
+    def remote_retry_count(self):
+        """
+        max retries for idempotent requests (GET/HEAD/OPTIONS) when connection or read errors occur,
+        0 to disable retry
+        """
+        return self._remote_retry_count
+
+    @remote_retry_count.setter
+    def remote_retry_count(self, value):
+        self._remote_retry_count = value
+
+    @property
+    def circuit_breaker_enable(self):
+        """
+        Per domain circuit breaker, if a remote domain keeps failing (timeout/connection error/502/503/504),
+        requests to it would fail fast for a while, instead of piling up worker threads behind it
+        """
+        return self._circuit_breaker_enable
+
+    @circuit_breaker_enable.setter
+    def circuit_breaker_enable(self, value):
+        self._circuit_breaker_enable = value
+
+    @property
+    def circuit_breaker_failure_threshold(self):
+        """
+        consecutive failures before the circuit breaker of a domain opens
+        """
+        return self._circuit_breaker_failure_threshold
+
+    @circuit_breaker_failure_threshold.setter
+    def circuit_breaker_failure_threshold(self, value):
+        self._circuit_breaker_failure_threshold = value
+
+    @property
+    def circuit_breaker_recovery_time(self):
+        """
+        seconds that an opened circuit breaker waits before letting a trial request through
+        """
+        return self._circuit_breaker_recovery_time
+
+    @circuit_breaker_recovery_time.setter
+    def circuit_breaker_recovery_time(self, value):
+        self._circuit_breaker_recovery_time = value
+
+    @property
+    def error_page_show_detail(self):
+        """
+        Show the detailed error page (request detail, traceback, snapshot path) on internal errors,
+        otherwise a small precomputed page is sent. Do not enable it in production
+        """
+        return self._error_page_show_detail
+
+    @error_page_show_detail.setter
+    def error_page_show_detail(self, value):
+        self._error_page_show_detail = value
+
+    @property
+    def error_snapshot_enable(self):
+        """
+        Dump a snapshot (pickle) to the `error_dump` folder on internal errors, rate limited,
+        secrets (admin_token, proxy settings, Authorization/Cookie headers) are redacted
+        """
+        return self._error_snapshot_enable
+
+    @error_snapshot_enable.setter
+    def error_snapshot_enable(self, value):
+        self._error_snapshot_enable = value
+
+    @property
+    def error_snapshot_max_per_minute(self):
+        """
+        at most this many tracebacks/snapshots per minute, the rest are only counted
+        """
+        return self._error_snapshot_max_per_minute
+
+    @error_snapshot_max_per_minute.setter
+    def error_snapshot_max_per_minute(self, value):
+        self._error_snapshot_max_per_minute = value
+
+    @property
+    def error_snapshot_sample_rate(self):
+        """
+        only this fraction (0~1) of the internal errors may print a traceback or dump a snapshot
+        """
+        return self._error_snapshot_sample_rate
+
+    @error_snapshot_sample_rate.setter
+    def error_snapshot_sample_rate(self, value):
+        self._error_snapshot_sample_rate = value
+
+    @property
+    def metrics_enable(self):
+        """
+        Collect per-stage timings (url decode, upstream ttfb/body, rewrite, cache...) and counters,
+        exposed at `metrics_path` in the Prometheus text format,
+        `metrics_path?format=json` returns the throughput of every active and recently finished stream
+        """
+        return self._metrics_enable
+
+    @metrics_enable.setter
+    def metrics_enable(self, value):
+        self._metrics_enable = value
+
+    @property
+    def metrics_path(self):
+        """
+        url path of the metrics endpoint, should not collide with any path of the mirrored site
+        """
+        return self._metrics_path
+
+    @metrics_path.setter
+    def metrics_path(self, value):
+        self._metrics_path = value
+
+    @property
+    def metrics_allowed_ips(self):
+        """
+        only these client ips can access the metrics endpoint, others get 404
+        """
+        return self._metrics_allowed_ips
+
+    @metrics_allowed_ips.setter
+    def metrics_allowed_ips(self, value):
+        self._metrics_allowed_ips = value
+
+    @property
+    def admin_token(self):
+        """
+        secret token required (as "Authorization: Bearer <token>") by the admin endpoints (metrics, profiler),
+        None to disable these endpoints. Behind a reverse proxy every client has the proxy's ip,
+        so the ip allow lists alone are not enough
+        """
+        return self._admin_token
+
+    @admin_token.setter
+    def admin_token(self, value):
+        self._admin_token = value
+
+    @property
+    def profiler_enable(self):
+        """
+        Built-in sampling profiler, can be started at runtime by visiting `profiler_path`
+        or by sending `profiler_signal` to the process
+        """
+        return self._profiler_enable
+
+    @profiler_enable.setter
+    def profiler_enable(self, value):
+        self._profiler_enable = value
+
+    @property
+    def profiler_path(self):
+        """
+        url path that starts the profiler, query params: seconds, interval, format
+        """
+        return self._profiler_path
+
+    @profiler_path.setter
+    def profiler_path(self, value):
+        self._profiler_path = value
+
+    @property
+    def profiler_allowed_ips(self):
+        """
+        only these client ips can start the profiler, others get 404
+        """
+        return self._profiler_allowed_ips
+
+    @profiler_allowed_ips.setter
+    def profiler_allowed_ips(self, value):
+        self._profiler_allowed_ips = value
+
+    @property
+    def profiler_signal(self):
+        """
+        name of the signal that starts the profiler with default params, eg: "SIGUSR2", None to disable
+        """
+        return self._profiler_signal
+
+    @profiler_signal.setter
+    def profiler_signal(self, value):
+        self._profiler_signal = value
+
+    @property
+    def profiler_seconds(self):
+        """
+        default profiling duration (seconds)
+        """
+        return self._profiler_seconds
+
+    @profiler_seconds.setter
+    def profiler_seconds(self, value):
+        self._profiler_seconds = value
+
+    @property
+    def profiler_interval(self):
+        """
+        default sampling interval (seconds)
+        """
+        return self._profiler_interval
+
+    @profiler_interval.setter
+    def profiler_interval(self, value):
+        self._profiler_interval = value
+
+    @property
+    def profiler_format(self):
+        """
+        default output format, "collapsed" (flamegraph.pl/speedscope) or "speedscope" (json)
+        """
+        return self._profiler_format
+
+    @profiler_format.setter
+    def profiler_format(self, value):
+        self._profiler_format = value
+
+    @property
+    def profiler_output_dir(self):
+        """
+        folder that profile files are written to
+        """
+        return self._profiler_output_dir
+
+    @profiler_output_dir.setter
+    def profiler_output_dir(self, value):
+        self._profiler_output_dir = value
+
     @property
     def local_cache_enable(self):
         """
@@ -540,6 +1074,40 @@ class Config:
     def local_cache_enable(self, value):
         self._local_cache_enable = value
 
+    @property
+    def local_cache_max_stream_size(self):
+        """
+        max size in bytes of a response body cached in stream mode (written to disk as it is relayed, eg. large media),
+        non-stream responses are still limited to 8MB
+        """
+        return self._local_cache_max_stream_size
+
+    @local_cache_max_stream_size.setter
+    def local_cache_max_stream_size(self, value):
+        self._local_cache_max_stream_size = value
+
+    @property
+    def local_cache_max_disk_size(self):
+        """
+        max total size in bytes of all local cache files, least recently used entries are evicted beyond it
+        """
+        return self._local_cache_max_disk_size
+
+    @local_cache_max_disk_size.setter
+    def local_cache_max_disk_size(self, value):
+        self._local_cache_max_disk_size = value
+
+    @property
+    def range_coalesce_wait_timeout(self):
+        """
+        seconds a Range request waits for an overlapping in-flight Range request before going to the remote server itself
+        """
+        return self._range_coalesce_wait_timeout
+
+    @range_coalesce_wait_timeout.setter
+    def range_coalesce_wait_timeout(self, value):
+        self._range_coalesce_wait_timeout = value
+
     @property
     def stream_transfer_enable(self):
         """
@@ -558,7 +1126,8 @@ class Config:
     @property
     def stream_buffer_size(self):
         """
-        streamed content fetch size (per package)
+        streamed content fetch size (per package),
+        this is the initial size, it grows up to `stream_buffer_max_size` when both sides are fast
         """
         return self._stream_buffer_size
 
@@ -566,6 +1135,42 @@ class Config:
     def stream_buffer_size(self, value):
         self._stream_buffer_size = value
 
+    @property
+    def stream_buffer_max_size(self):
+        """
+        max streamed content fetch size (per package) for content that must be decompressed,
+        see `stream_relay_buffer_size` for content relayed as-is
+        """
+        return self._stream_buffer_max_size
+
+    @stream_buffer_max_size.setter
+    def stream_buffer_max_size(self, value):
+        self._stream_buffer_max_size = value
+
+    @property
+    def stream_client_stall_timeout(self):
+        """
+        if a client stops reading a streamed response for this many seconds,
+        the remote connection is closed instead of being held open for it
+        """
+        return self._stream_client_stall_timeout
+
+    @stream_client_stall_timeout.setter
+    def stream_client_stall_timeout(self, value):
+        self._stream_client_stall_timeout = value
+
+    @property
+    def stream_preload_max_workers(self):
+        """
+        size of the thread pool shared by all streamed responses for async preload,
+        at most this many streams are preloaded at the same time, others are sent synchronously without preload
+        """
+        return self._stream_preload_max_workers
+
+    @stream_preload_max_workers.setter
+    def stream_preload_max_workers(self, value):
+        self._stream_preload_max_workers = value
+
     @property
     def stream_transfer_async_preload_max_packages_size(self):
         """
@@ -577,6 +1182,54 @@ class Config:
     def stream_transfer_async_preload_max_packages_size(self, value):
         self._stream_transfer_async_preload_max_packages_size = value
 
+    @property
+    def stream_relay_buffer_size(self):
+        """
+        max size of each reusable buffer when relaying streamed binary content as-is,
+        buffers start at `stream_buffer_size` and grow when both sides are fast
+        """
+        return self._stream_relay_buffer_size
+
+    @stream_relay_buffer_size.setter
+    def stream_relay_buffer_size(self, value):
+        self._stream_relay_buffer_size = value
+
+    @property
+    def stream_relay_buffer_count(self):
+        """
+        number of reusable buffers per streamed response when relaying binary content as-is,
+        at most `stream_relay_buffer_size` * `stream_relay_buffer_count` bytes are buffered per response
+        """
+        return self._stream_relay_buffer_count
+
+    @stream_relay_buffer_count.setter
+    def stream_relay_buffer_count(self, value):
+        self._stream_relay_buffer_count = value
+
+    @property
+    def response_compress_level(self):
+        """
+        compress level (1~9) of the rewritten text responses sent to clients, 0 to disable compression
+        the encoding (br, zstd or gzip) is chosen by the client's Accept-Encoding
+        binary responses are always passed through in the remote server's original (compressed) form
+        """
+        return self._response_compress_level
+
+    @response_compress_level.setter
+    def response_compress_level(self, value):
+        self._response_compress_level = value
+
+    @property
+    def response_compress_min_size(self):
+        """
+        rewritten text responses smaller than this size (bytes) would not be compressed
+        """
+        return self._response_compress_min_size
+
+    @response_compress_min_size.setter
+    def response_compress_min_size(self, value):
+        self._response_compress_min_size = value
+
     @property
     def cron_task_enable(self):
         """
@@ -629,6 +1282,63 @@ class Config:
     def text_like_mime_types(self, value):
         self._text_like_mime_types = self._text_like_mime_types.union(set(value))
 
+    @property
+    def request_rewrite_skip_headers(self):
+        """
+        request headers (lower case) that never contain urls, they are sent to remote without rewriting
+        """
+        return self._request_rewrite_skip_headers
+
+    @request_rewrite_skip_headers.setter
+    def request_rewrite_skip_headers(self, value):
+        self._request_rewrite_skip_headers = set(x.lower() for x in value)
+
+    @property
+    def request_rewrite_cache_size(self):
+        """
+        how many rewritten request header values (cookie, referer...) are memoized, 0 to disable
+        """
+        return self._request_rewrite_cache_size
+
+    @request_rewrite_cache_size.setter
+    def request_rewrite_cache_size(self, value):
+        self._request_rewrite_cache_size = value
+
+    @property
+    def request_body_rewrite_max_size(self):
+        """
+        request bodies larger than this (in bytes), with unknown size (chunked), or binary ones,
+        are streamed to the remote server chunk by chunk, without being read into memory or rewritten
+        """
+        return self._request_body_rewrite_max_size
+
+    @request_body_rewrite_max_size.setter
+    def request_body_rewrite_max_size(self, value):
+        self._request_body_rewrite_max_size = value
+
+    @property
+    def url_mapping_cache_size(self):
+        """
+        how many urls are memoized in each direction of the mirror url <--> remote url mapping, 0 to disable
+        """
+        return self._url_mapping_cache_size
+
+    @url_mapping_cache_size.setter
+    def url_mapping_cache_size(self, value):
+        self._url_mapping_cache_size = value
+
+    @property
+    def pattern_rebuild_budget(self):
+        """
+        when the domain set changes (eg. automatic whitelist), regex patterns are recompiled in background,
+        at most this fraction of time is spent on compiling, further changes are merged and compiled later
+        """
+        return self._pattern_rebuild_budget
+
+    @pattern_rebuild_budget.setter
+    def pattern_rebuild_budget(self, value):
+        self._pattern_rebuild_budget = value
+
     @property
     def custom_inject_content(self):
         """
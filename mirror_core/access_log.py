@@ -0,0 +1,248 @@
+# coding=utf-8
+"""
+本模块为支持 `access_log_enable` 选项而存在
+每个请求一行json(JSONL), 字段名尽量短:
+    ts      请求开始的时间(unix时间戳)
+    rid     request id, 与日志中的相同, 见 structured_log
+    m       请求方法
+    url     浏览器请求的(镜像)url
+    rurl    对应的远程url, 请求没有到达远程时为null
+    st      状态码
+    bin     浏览器请求体的字节数
+    bout    发送给浏览器的响应体的字节数
+    cache   本地缓存的结果: hit, not_modified, range_hit, segment_hit, miss, stale(有缓存但已过期), bypass(不适用缓存)
+    strm    是否以stream模式传输
+    sst     stream的结束状态: done, aborted, 非stream时没有这一项
+    t       各阶段的耗时(秒), 阶段名称见 metrics, 其中 total 包括stream传输的时间
+
+写入由 AccessLogWriter 在后台线程中批量完成, 文件超过 max_bytes 后轮转(access.jsonl --> access.jsonl.1 --> ...)
+
+离线统计(慢url, 缓存命中率等):
+    python -m mirror_core.access_log access.jsonl [access.jsonl.1 ...] [--top 20]
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from time import time
+
+try:
+    from typing import Dict, Iterable, Iterator, List, Union
+except:  # pragma: no cover
+    pass
+
+# 这些缓存结果被认为是命中
+HIT_RESULTS = ("hit", "not_modified", "range_hit", "segment_hit")
+
+
+class AccessLogWriter:
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backup_count=5, flush_interval=1.0, max_buffered=1000):
+        """
+        :param path: 日志文件路径, 文件夹不存在时会被创建
+        :param max_bytes: 单个文件的最大大小, 超过后轮转, 0 表示不轮转
+        :param backup_count: 保留的旧文件个数
+        :param flush_interval: 写入文件的间隔(秒)
+        :param max_buffered: 缓冲区中的条数达到这个值时立即写入
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._buffer = []  # type: List[dict]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._file_lock = threading.Lock()
+        self._writer_pid = None
+        atexit.register(self.flush)
+
+    def write(self, entry):
+        """
+        记录一个请求, 写入文件的时候才会被序列化, 之后不应该再修改 entry
+        :type entry: dict
+        """
+        if self._writer_pid != os.getpid():
+            self._start_writer()
+        with self._lock:
+            self._buffer.append(entry)
+            if len(self._buffer) >= self.max_buffered:
+                self._wakeup.set()
+
+    def _start_writer(self):
+        with self._lock:
+            pid = os.getpid()
+            if self._writer_pid == pid:
+                return
+            self._writer_pid = pid
+        threading.Thread(target=self._flush_loop, name="zmirror-access-log", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:  # coverage: exclude
+                print("ACCESS LOG WRITE ERROR:", e, file=sys.stderr)
+
+    def flush(self):
+        """把缓冲区中的记录写入文件"""
+        with self._lock:
+            entries, self._buffer = self._buffer, []
+        if not entries:
+            return
+        data = "".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n" for entry in entries)
+        data = data.encode("utf-8")
+        with self._file_lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "ab") as fp:
+                fp.write(data)
+
+    def _rotate(self):
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = "%s.%d" % (self.path, i)
+            if os.path.exists(source):
+                os.replace(source, "%s.%d" % (self.path, i + 1))
+        os.replace(self.path, self.path + ".1")
+
+
+def track_streamed_response(resp, entry, writer):
+    """
+    stream模式的响应, 统计实际发送的字节数, 在传输结束(或浏览器断开)后才写入访问日志
+    :type resp: Response
+    :type entry: dict
+    :type writer: AccessLogWriter
+    """
+    entry["bout"] = 0
+    entry["sst"] = "aborted"
+    resp.response = _iter_counting_bytes(resp.response, entry)
+    # WSGI服务器一定会调用 close(), 即使响应体一次都没有被读取
+    resp.call_on_close(lambda: _finish_streamed_entry(entry, writer))
+
+
+def _iter_counting_bytes(iterable, entry):
+    try:
+        for chunk in iterable:
+            entry["bout"] += len(chunk)
+            yield chunk
+        entry["sst"] = "done"
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+
+def _finish_streamed_entry(entry, writer):
+    entry["t"]["total"] = round(time() - entry["ts"], 4)
+    writer.write(entry)
+
+
+# ------------- 离线统计 -------------
+def iter_entries(paths):
+    """
+    :type paths: List[str]
+    :rtype: Iterator[dict]
+    """
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as fp:
+            for line in fp:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def summarize(entries, top=20):
+    """
+    统计: 状态码分布, 缓存命中率, 各阶段耗时, 最慢的url, 请求最多的未命中缓存的url (可以考虑缓存或预热的)
+    url 去掉了查询参数
+    :type entries: Iterable[dict]
+    :rtype: str
+    """
+    total = 0
+    statuses = Counter()
+    cache_results = Counter()
+    stage_times = defaultdict(list)  # type: Dict[str, List[float]]
+    url_times = defaultdict(list)  # type: Dict[str, List[float]]
+    url_misses = Counter()
+    bytes_out = 0
+    for entry in entries:
+        total += 1
+        statuses[entry.get("st")] += 1
+        cache_results[entry.get("cache")] += 1
+        bytes_out += entry.get("bout") or 0
+        times = entry.get("t") or {}
+        for name, seconds in times.items():
+            stage_times[name].append(seconds)
+        url = (entry.get("rurl") or entry.get("url") or "").split("?", 1)[0]
+        url_times[url].append(times.get("total", 0.0))
+        if entry.get("cache") in ("miss", "stale"):
+            url_misses[url] += 1
+
+    lines = ["requests: %d, bytes out: %d" % (total, bytes_out)]
+    if not total:
+        return lines[0]
+
+    lines.append("")
+    lines.append("status:  " + ", ".join("%s: %d" % (k, v) for k, v in statuses.most_common()))
+
+    lookups = sum(v for k, v in cache_results.items() if k not in ("bypass", None))
+    hits = sum(cache_results[k] for k in HIT_RESULTS)
+    lines.append("cache:   " + ", ".join("%s: %d" % (k, v) for k, v in cache_results.most_common()))
+    lines.append("cache hit ratio: %.1f%% (%d/%d lookups)" % (hits * 100.0 / max(1, lookups), hits, lookups))
+
+    lines.append("")
+    lines.append("%-18s %8s %10s %10s %10s" % ("stage", "count", "avg", "p50", "p95"))
+    for name, values in sorted(stage_times.items()):
+        values.sort()
+        lines.append("%-18s %8d %10.4f %10.4f %10.4f" % (
+            name, len(values), sum(values) / len(values), _percentile(values, 0.5), _percentile(values, 0.95)
+        ))
+
+    lines.append("")
+    lines.append("slowest urls (by p95 of total):")
+    lines.append("%10s %10s %8s  %s" % ("p95", "avg", "count", "url"))
+    url_stats = []
+    for url, values in url_times.items():
+        values.sort()
+        url_stats.append((_percentile(values, 0.95), sum(values) / len(values), len(values), url))
+    for p95, avg, count, url in sorted(url_stats, reverse=True)[:top]:
+        lines.append("%10.4f %10.4f %8d  %s" % (p95, avg, count, url))
+
+    if url_misses:
+        lines.append("")
+        lines.append("most missed urls (candidates for caching or prewarm):")
+        for url, count in url_misses.most_common(top):
+            lines.append("%8d  %s" % (count, url))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize zmirror access logs")
+    parser.add_argument("paths", nargs="+", help="access log files (jsonl)")
+    parser.add_argument("--top", type=int, default=20, help="number of urls to show")
+    args = parser.parse_args(argv)
+    print(summarize(iter_entries(args.paths), args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ import os
 import tempfile
 import time
 import pickle
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
 try:
@@ -94,10 +96,49 @@ def _time_str_to_unix(timestring):
     return t
 
 
+def iter_file_range(fp, length, chunk_size=65536):
+    """
+    从文件的当前位置开始读取 length 字节, 读取完成或中断后关闭文件
+    :type length: int
+    :type chunk_size: int
+    :rtype: Iterator[bytes]
+    """
+    try:
+        while length > 0:
+            data = fp.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fp.close()
+
+
 class FileCache:
-    def __init__(self, max_size_kb=8192):
-        self.items_dict = {}
+    # 每个资源最多缓存的分段(Range请求的部分内容)数量
+    max_segments_per_key = 32
+
+    def __init__(self, max_size_kb=8192, max_stream_size=1073741824, max_disk_size=10737418240):
+        """
+        :param max_size_kb: 序列化(pickle)存储的对象的最大大小, 即非stream模式的完整响应
+        :type max_size_kb: int
+        :param max_stream_size: stream模式下附加的内容文件的最大大小, 字节, 见 attach_content()
+        :type max_stream_size: int
+        :param max_disk_size: 所有缓存文件的总大小上限, 字节, 超过时删除最久未使用的条目
+        :type max_disk_size: int
+        """
+        # 按使用顺序排列, 最近使用的在最后, 见 _touch()
+        #   读取时只取一次条目(元组, 不可变), 之后只使用取到的这个条目, 不再用key查找, 其他线程同时删除它也不受影响
+        self.items_dict = OrderedDict()  # type: OrderedDict[str, tuple]
         self.max_size_byte = max_size_kb * 1024
+        self.max_stream_size_byte = max_stream_size
+        self.max_disk_size_byte = max_disk_size
+        # 所有缓存文件(对象文件和内容文件)的总大小
+        self.disk_usage = 0
+        self._lock = threading.RLock()
+        # 分段索引, key -> {(start, stop): complete_length}, stop不包含
+        #   每个分段本身是一个普通的缓存条目, 见 get_segment_key()
+        self.segments = {}
 
     def __del__(self):
         self.flush_all()
@@ -118,10 +159,9 @@ class FileCache:
         if expires <= 0 or obj_size > self.max_size_byte:
             return False
 
-        self.delete(key)
-
         temp_file = tempfile.NamedTemporaryFile(prefix="zmirror_", suffix=".tmp", delete=False)
         pickle.dump(obj, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+        file_size = temp_file.tell()
 
         cache_item = (
             temp_file.name,  # 0 cache file path
@@ -129,77 +169,369 @@ class FileCache:
             int(time.time()),  # 2 added time (unix time)
             expires,  # 3 expires second
             _time_str_to_unix(last_modified),  # 4 last modified, unix time
+            None,  # 5 content file path, see attach_content()
+            file_size,  # 6 size of all files on disk
         )
         temp_file.close()
-        self.items_dict[key] = cache_item
+        with self._lock:
+            # 在锁内替换旧的条目, 同一个key被同时存入时不会漏掉旧条目的文件
+            self.delete(key)
+            self._make_room(file_size)
+            self.items_dict[key] = cache_item
+            self.disk_usage += file_size
         return True
 
-    def delete(self, key):
-        if self._is_item_exist(key):
-            file_path = self.items_dict[key][0]
+    def attach_content(self, key, content_path, obj_size=0):
+        """
+        为一个已缓存的对象附加一个内容文件, 内容文件会在缓存条目被删除时一并删除
+        用于stream模式: 先缓存响应头, 在内容接收完成后再附加内容
+            内容以原始的二进制形式存储在文件中, 读取时可以直接发送(sendfile), 不需要反序列化
+        如果条目不存在或内容过大(`max_stream_size`), 内容文件会被删除
+        缓存文件的总大小超过 `max_disk_size` 时, 会先删除最久未使用的其他条目
+        :param content_path: 内容文件的路径
+        :type content_path: str
+        :param obj_size: 内容的大小
+        :type obj_size: int
+        :return: 是否成功
+        :rtype: bool
+        """
+        with self._lock:
+            item = self._get_item(key)
+            if obj_size > min(self.max_stream_size_byte, self.max_disk_size_byte) or item is None:
+                if os.path.exists(content_path):
+                    os.remove(content_path)
+                return False
+
+            old_content_path = item[5]
+            old_content_size = 0
+            if old_content_path and old_content_path != content_path and os.path.exists(old_content_path):
+                old_content_size = os.path.getsize(old_content_path)
+                os.remove(old_content_path)
+
+            self._make_room(obj_size - old_content_size, exclude=key)
+            item = self.items_dict.get(key)
+            if item is None:
+                # 恰好过期了
+                if os.path.exists(content_path):
+                    os.remove(content_path)
+                return False
+            self.items_dict[key] = item[:5] + (content_path, item[6] + obj_size - old_content_size)
+            self.disk_usage += obj_size - old_content_size
+            if item[1] is not None:
+                item[1]["without_content"] = False
+        return True
+
+    def _make_room(self, size, exclude=None):
+        """
+        删除过期的和最久未使用的条目, 直到能再放下 size 字节, 调用者需要持有 self._lock
+        :type size: int
+        :param exclude: 不删除这个条目
+        :type exclude: Union[str, None]
+        """
+        if self.disk_usage + size <= self.max_disk_size_byte:
+            return
+        self.check_all_expire()
+        for key in list(self.items_dict):
+            if self.disk_usage + size <= self.max_disk_size_byte:
+                break
+            if key != exclude:
+                self.delete(key)
+
+    def _touch(self, key):
+        """将条目移动到 items_dict 的末尾, 表示最近使用过"""
+        with self._lock:
+            if key in self.items_dict:
+                self.items_dict.move_to_end(key)
+
+    def get_content_path(self, key):
+        """
+        获取 attach_content() 附加的内容文件的路径, 没有时返回None
+        :rtype: Union[str, None]
+        """
+        item = self._get_item(key)
+        return item[5] if item is not None else None
+
+    @staticmethod
+    def get_segment_key(key, start, stop):
+        """
+        分段缓存条目的key
+        :param start: 分段的起始位置
+        :param stop: 分段的结束位置, 不包含
+        :rtype: str
+        """
+        return "%s|bytes=%d-%d" % (key, start, stop - 1)
+
+    def add_segment(self, key, start, stop, complete_length, content_path):
+        """
+        将一个分段的内容文件附加到已缓存的分段条目上(条目需要先用 get_segment_key() 作为key存入),
+            并加入分段索引. 被新分段完全覆盖的旧分段会被删除
+        :param key: 完整资源的缓存key
+        :type start: int
+        :param stop: 不包含
+        :type stop: int
+        :param complete_length: 完整资源的长度
+        :type complete_length: int
+        :type content_path: str
+        :rtype: bool
+        """
+        with self._lock:
+            if not self.attach_content(self.get_segment_key(key, start, stop), content_path, stop - start):
+                return False
+
+            segments = self.segments.setdefault(key, {})
+            for seg_start, seg_stop in list(segments):
+                if start <= seg_start and seg_stop <= stop and (seg_start, seg_stop) != (start, stop):
+                    self.delete(self.get_segment_key(key, seg_start, seg_stop))
+                    segments.pop((seg_start, seg_stop), None)
+            segments[(start, stop)] = complete_length
+
+            while len(segments) > self.max_segments_per_key:
+                # 删除最早加入的分段
+                seg_start, seg_stop = next(iter(segments))
+                self.delete(self.get_segment_key(key, seg_start, seg_stop))
+                segments.pop((seg_start, seg_stop), None)
+        return True
+
+    def find_segment(self, key, start, stop=None):
+        """
+        查找一个能完整覆盖所请求范围的分段
+        范围的表示方法与 werkzeug.datastructures.Range 相同:
+            (100, 200) 表示 bytes=100-199, (100, None) 表示 bytes=100-, (-100, None) 表示最后100字节
+        :type start: int
+        :type stop: Union[int, None]
+        :return: (分段的key, 分段起始位置, 分段结束位置, 请求的起始位置, 请求的结束位置, 完整长度), 位置均为不包含的结束位置
+            没有找到时返回None
+        :rtype: Union[tuple, None]
+        """
+        with self._lock:
+            segments = self.segments.get(key)
+            if not segments:
+                return None
+            segment_items = list(segments.items())
+
+        for (seg_start, seg_stop), complete_length in segment_items:
+            seg_key = self.get_segment_key(key, seg_start, seg_stop)
+            if self.get_content_path(seg_key) is None:
+                # 已过期或者已被删除
+                with self._lock:
+                    segments.pop((seg_start, seg_stop), None)
+                continue
+
+            if start < 0:
+                range_start, range_stop = max(0, complete_length + start), complete_length
+            else:
+                range_start = start
+                range_stop = complete_length if stop is None else min(stop, complete_length)
+
+            if seg_start <= range_start < range_stop <= seg_stop:
+                return seg_key, seg_start, seg_stop, range_start, range_stop, complete_length
+        return None
+
+    def delete(self, key, expected_item=None):
+        """
+        :param expected_item: 只有当前的条目就是这个条目时才删除, 用于删除读取时发现已过期/已损坏的条目,
+            不会误删另一个线程刚刚存入的新条目
+        """
+        with self._lock:
+            item = self.items_dict.get(key)
+            if item is None or (expected_item is not None and item is not expected_item):
+                return
             del self.items_dict[key]
+            self.disk_usage -= item[6]
+            file_path = item[0]
+            content_path = item[5]
             if os.path.exists(file_path):
                 os.remove(file_path)
+            if content_path and os.path.exists(content_path):
+                os.remove(content_path)
 
     def flush_all(self):
-        for key in list(self.items_dict.keys()):
-            self.delete(key)
+        with self._lock:
+            for key in list(self.items_dict.keys()):
+                self.delete(key)
+            self.segments.clear()
 
     def check_all_expire(self, force_flush_all=False):
         if force_flush_all:
             self.flush_all()
             return
-        keys_to_delete = []
-        for item_key in self.items_dict:
-            if self.is_expires(item_key):
-                keys_to_delete.append(item_key)
-        for key in keys_to_delete:
-            self.delete(key)
+        now = time.time()
+        with self._lock:
+            for key, item in list(self.items_dict.items()):
+                if now > item[2] + item[3]:
+                    self.delete(key, item)
+
+    def _get_item(self, key):
+        """
+        取出一个未过期的条目, 已过期的会被删除
+        :rtype: Union[tuple, None]
+        """
+        item = self.items_dict.get(key)
+        if item is None:
+            return None
+        if time.time() > item[2] + item[3]:
+            self.delete(key, item)
+            return None
+        return item
 
     def is_cached(self, key):
-        if not self._is_item_exist(key):
-            return False
-        if self.is_expires(key):
-            self.delete(key)
-            return False
-        else:
-            return True
+        return self._get_item(key) is not None
 
     def get_obj(self, key):
-        if self.is_cached(key):
-            file_path = self.items_dict[key][0]
-            try:
-                with open(file_path, "rb") as fp:
-                    obj = pickle.load(fp)
-            except:
-                self.delete(key)
-                return None
-            else:
-                return obj
-        else:
+        item = self._get_item(key)
+        if item is None:
+            return None
+        try:
+            with open(item[0], "rb") as fp:
+                obj = pickle.load(fp)
+        except:
+            # 文件已损坏, 或者刚刚被另一个线程删除
+            self.delete(key, item)
             return None
+        self._touch(key)
+        return obj
 
     def get_info(self, key):
-        if self.is_cached(key):
-            return self.items_dict[key][1]
-        else:
-            return None
+        item = self._get_item(key)
+        return item[1] if item is not None else None
 
     def is_unchanged(self, key, last_modified=None):
-        if not self.is_cached(key) or last_modified is None:
+        item = self._get_item(key)
+        if item is None or last_modified is None or item[4] is None:
             return False
-        else:
-            ct = self.items_dict[key][4]
-            if ct is None:
-                return False
-            elif ct == _time_str_to_unix(last_modified):
-                return True
+        return item[4] == _time_str_to_unix(last_modified)
+
+    def is_stale(self, key):
+        """有这个缓存, 但已经过期"""
+        return self.is_expires(key)
 
     def is_expires(self, key):
-        item = self.items_dict[key]
-        if time.time() > item[2] + item[3]:
-            return True
-        return False
+        item = self.items_dict.get(key)
+        return item is not None and time.time() > item[2] + item[3]
 
     def _is_item_exist(self, key):
         return key in self.items_dict
+
+
+class CacheContentWriter:
+    """
+    stream模式下, 边传输边把内容追加写入临时文件, 内存占用与响应的大小无关
+    传输完成后调用 commit(), 原子地附加到已缓存的(只有头部的)条目上, 见 FileCache.attach_content()
+    传输中断时调用 discard(), 临时文件被删除, 缓存中不会出现不完整的内容
+    内容超过缓存的大小限制(FileCache 的 `max_stream_size`)时自动放弃
+    """
+
+    def __init__(self, cache, key, segment=None):
+        """
+        :type cache: FileCache
+        :param key: 缓存条目的key
+        :type key: str
+        :param segment: 如果写入的是一个分段, 为 (完整资源的key, start, stop, complete_length), 见 FileCache.add_segment()
+        :type segment: Union[tuple, None]
+        """
+        self.cache = cache
+        self.key = key
+        self.segment = segment
+        self.size = 0
+        self.finished = False
+        self._file = None  # 临时文件在第一次写入时才创建
+
+    def write(self, data):
+        """
+        :type data: Union[bytes, bytearray, memoryview]
+        """
+        if self.finished:
+            return
+        if self.size + len(data) > self.cache.max_stream_size_byte:
+            # 太大了, 不缓存
+            self.discard()
+            return
+        if self._file is None:
+            self._file = tempfile.NamedTemporaryFile(prefix="zmirror_", suffix=".tmp", delete=False)
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        """
+        :return: 是否成功加入缓存
+        :rtype: bool
+        """
+        if self.finished or self._file is None:
+            self.finished = True
+            return False
+        self.finished = True
+        self._file.close()
+        path, self._file = self._file.name, None
+
+        if self.segment is None:
+            return self.cache.attach_content(self.key, path, self.size)
+        if self.size == self.segment[2] - self.segment[1] and self.cache.add_segment(*self.segment, path):
+            return True
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+
+    def discard(self):
+        self.finished = True
+        if self._file is None:
+            return
+        self._file.close()
+        path, self._file = self._file.name, None
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class RangeFetchRegistry:
+    """
+    记录正在从远程服务器获取的Range请求, 用于合并重叠的Range请求
+    当一个Range请求所需的范围已经被另一个正在进行的请求覆盖时, 它会等待那个请求完成,
+        然后直接从分段缓存中读取, 而不是再向远程服务器请求一次
+    超过 timeout 秒仍未完成的记录视为无效
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        # key -> {(start, stop): (threading.Event, 开始时间)}
+        self._fetches = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key, start, stop):
+        """
+        开始获取一个范围
+        :type key: str
+        :type start: int
+        :param stop: 不包含
+        :type stop: int
+        :return: (event, is_leader)
+            如果已经有覆盖这一范围的请求正在进行, is_leader 为False, 调用者应该等待 event
+            否则登记为新的请求, is_leader 为True, 完成后调用者必须调用 finish()
+        :rtype: Tuple[threading.Event, bool]
+        """
+        now = time.time()
+        with self._lock:
+            fetches = self._fetches.setdefault(key, {})
+            for (fetch_start, fetch_stop), (event, started) in list(fetches.items()):
+                if now - started > self.timeout:
+                    event.set()
+                    del fetches[(fetch_start, fetch_stop)]
+                elif fetch_start <= start and stop <= fetch_stop:
+                    return event, False
+
+            event = threading.Event()
+            fetches[(start, stop)] = (event, now)
+            return event, True
+
+    def finish(self, key, event):
+        """
+        结束一个由 begin() 登记的请求, 唤醒所有等待者
+        :type key: str
+        :type event: threading.Event
+        """
+        with self._lock:
+            fetches = self._fetches.get(key, {})
+            for fetch_range, (fetch_event, _) in list(fetches.items()):
+                if fetch_event is event:
+                    del fetches[fetch_range]
+            if not fetches:
+                self._fetches.pop(key, None)
+        event.set()
@@ -0,0 +1,179 @@
+# coding=utf-8
+"""
+文本编码检测, 并且只解码一次
+
+按以下顺序确定编码, 找到一个就停止:
+    1. `force_decode_with_charsets`
+    2. BOM (utf-8 utf-16)
+    3. Content-Type 中的 charset
+    4. 文本开头的 <meta charset> / <?xml encoding> / @charset (只检查前 META_SNIFF_SIZE 字节)
+    5. 同一个 (域名, MIME) 上一次检测到的编码
+    6. 依次尝试 `possible_charsets`
+除了1和2, 其他的编码都需要先通过验证: 用增量解码器解码开头的 `charset_detect_prefix_size` 字节,
+    明显不对的编码不会被用来解码整个页面
+通过验证的编码以严格模式解码整个内容, 开头之后才出现无法解码的字节时(比如前64KB都是ASCII的脚本, 之后是GBK),
+    继续尝试下一个编码. 通常情况下整个内容只解码一次
+
+所有编码都无法严格解码时, 非严格模式(errors="replace")下用第一个通过验证的编码替换掉无法解码的字节,
+    严格模式(errors="strict", 用于浏览器的请求体)下视为二进制
+"""
+import codecs
+import re
+
+try:
+    from typing import Dict, Iterable, Tuple, Union
+except:  # pragma: no cover
+    pass
+
+META_SNIFF_SIZE = 1024
+
+# 缓存的 (域名, MIME) 的最大个数
+MAX_REMEMBERED = 4096
+
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+_meta_charset_regex = re.compile(
+    rb"""<meta[^>]+?charset\s*=\s*["']?\s*([\w.:-]+)"""  # <meta charset="gbk"> 和 <meta http-equiv=... content="...; charset=gbk">
+    rb"""|<\?xml[^>]+?encoding\s*=\s*["']([\w.:-]+)"""  # <?xml version="1.0" encoding="gbk"?>
+    rb"""|@charset\s+["']([\w.:-]+)""",  # css: @charset "gbk";
+    flags=re.IGNORECASE,
+)
+_content_type_charset_regex = re.compile(r"""charset\s*=\s*["']?\s*([\w.:-]+)""", flags=re.IGNORECASE)
+
+# 声明的编码往往是实际编码的子集
+_CHARSET_ALIASES = {
+    "gb2312": "gbk",
+    "ascii": "utf-8",
+}
+
+
+def normalize_charset(name):
+    """
+    :type name: Union[str, bytes, None]
+    :return: python中的编码名称, 未知的编码返回None
+    :rtype: Union[str, None]
+    """
+    if not name:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode("ascii", "ignore")
+    try:
+        name = codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+    return _CHARSET_ALIASES.get(name, name)
+
+
+class CharsetDetector:
+    def __init__(self, force_charset=None, possible_charsets=("utf-8", "gbk"), prefix_size=65536):
+        """
+        :param force_charset: 即 `force_decode_with_charsets`, 不为None时总是使用这个编码
+        :type force_charset: Union[str, None]
+        :param possible_charsets: 即 `possible_charsets`, 依次尝试
+        :type possible_charsets: Iterable[str]
+        :param prefix_size: 验证编码时解码的字节数
+        :type prefix_size: int
+        """
+        self.force_charset = normalize_charset(force_charset)
+        self.possible_charsets = [c for c in (normalize_charset(x) for x in possible_charsets or ()) if c]
+        self.prefix_size = prefix_size
+        self._remembered = {}  # type: Dict[Tuple[str, str], str]
+
+    def decode(self, content, content_type=None, cache_key=None, errors="replace"):
+        """
+        检测编码并解码
+        :type content: bytes
+        :param content_type: Content-Type 头, 可以为None
+        :type content_type: Union[str, None]
+        :param cache_key: 记住检测结果, 通常为 (域名, MIME)
+        :type cache_key: Union[Tuple[str, str], None]
+        :param errors: "replace": 与requests的 .text 相同, 只要有一个编码通过了验证, 总是能得到文本;
+                       "strict": 任何一个字节无法解码都视为二进制
+        :type errors: str
+        :return: (文本, 编码), 无法确定编码(或者严格模式下解码失败)时返回 (None, None)
+        :rtype: Tuple[Union[str, None], Union[str, None]]
+        """
+        fallback = None
+        for charset in self._iter_candidates(content, content_type, cache_key):
+            try:
+                text = content.decode(charset)
+            except UnicodeDecodeError:
+                # 开头之后才出现了无法解码的字节, 尝试下一个编码
+                if fallback is None:
+                    fallback = charset
+                continue
+            except LookupError:
+                continue
+            if cache_key is not None and self._remembered.get(cache_key) != charset:
+                if len(self._remembered) >= MAX_REMEMBERED:
+                    self._remembered.clear()
+                self._remembered[cache_key] = charset
+            return text, charset
+
+        if fallback is None or errors == "strict":
+            return None, None
+        return content.decode(fallback, errors), fallback
+
+    def detect(self, content, content_type=None, cache_key=None):
+        """
+        只检测编码, 不解码整个内容
+        :rtype: Union[str, None]
+        """
+        for charset in self._iter_candidates(content, content_type, cache_key):
+            return charset
+        return None
+
+    def _iter_candidates(self, content, content_type, cache_key):
+        """
+        按顺序产生通过了验证的编码
+        :rtype: Iterable[str]
+        """
+        if self.force_charset is not None:
+            yield self.force_charset
+            return
+
+        for bom, charset in _BOMS:
+            if content.startswith(bom):
+                yield charset
+                return
+
+        tried = set()
+        prefix = content[: self.prefix_size]
+
+        declared = []
+        if content_type:
+            match = _content_type_charset_regex.search(content_type)
+            if match is not None:
+                declared.append(match.group(1))
+        match = _meta_charset_regex.search(content, 0, META_SNIFF_SIZE)
+        if match is not None:
+            declared.append(match.group(1) or match.group(2) or match.group(3))
+        declared = [normalize_charset(x) for x in declared]
+
+        if cache_key is not None:
+            declared.append(self._remembered.get(cache_key))
+
+        for charset in declared + self.possible_charsets:
+            if charset is None or charset in tried:
+                continue
+            tried.add(charset)
+            if self._is_valid_prefix(prefix, charset):
+                yield charset
+
+    @staticmethod
+    def _is_valid_prefix(prefix, charset):
+        """
+        :type prefix: bytes
+        :type charset: str
+        :rtype: bool
+        """
+        try:
+            # final=False: 开头部分的最后可能截断了一个多字节字符
+            codecs.getincrementaldecoder(charset)().decode(prefix, final=False)
+        except (UnicodeDecodeError, LookupError):
+            return False
+        return True
@@ -0,0 +1,105 @@
+# coding=utf-8
+"""
+本模块为支持 `circuit_breaker_enable` 选项而存在
+为每个远程域名维护一个熔断器(circuit breaker)
+
+当某个域名连续失败(超时/连接错误/网关错误)达到 `failure_threshold` 次后, 熔断器打开(open),
+    在 `recovery_time` 秒内, 所有对这个域名的请求都会立即失败, 而不会占用工作线程去等待超时
+    recovery_time 过后, 熔断器进入半开(half-open)状态, 只放行一个试探请求,
+        试探成功则关闭熔断器, 恢复正常; 试探失败则重新打开熔断器
+        试探请求因为与远程服务器无关的原因(比如浏览器断开)没有得到结果时, 下一个请求可以立即成为试探请求,
+            试探请求一直没有结果时, recovery_time 秒后放行下一个试探请求, 熔断器不会卡在半开状态
+
+这样一个坏掉的外部域名不会让所有工作线程都堆积在它身上
+"""
+import threading
+from time import time
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(ConnectionError):
+    """熔断器处于打开状态时, 对该域名的请求会抛出此异常"""
+
+    def __init__(self, domain, retry_after=0):
+        super().__init__("Circuit breaker is open for domain:", domain)
+        self.domain = domain
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, recovery_time=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started = 0.0  # 半开状态下, 当前试探请求的开始时间, 0 表示没有正在进行的试探
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        是否允许发出请求
+        :rtype: bool
+        """
+        if self.state == STATE_CLOSED:
+            return True
+        now = time()
+        with self._lock:
+            if self.state == STATE_OPEN and now - self.opened_at >= self.recovery_time:
+                # 熔断时间已过, 放行一个试探请求
+                self.state = STATE_HALF_OPEN
+                self.trial_started = now
+                return True
+            if self.state == STATE_HALF_OPEN and now - self.trial_started >= self.recovery_time:
+                # 没有正在进行的试探, 或者上一个试探一直没有结果
+                self.trial_started = now
+                return True
+            return False
+
+    def retry_after(self):
+        """距离下一次允许试探还需要等待的秒数"""
+        started = self.trial_started if self.state == STATE_HALF_OPEN else self.opened_at
+        return max(0, int(started + self.recovery_time - time()) + 1)
+
+    def record_success(self):
+        if self.state == STATE_CLOSED and self.failures == 0:
+            return
+        with self._lock:
+            self.state = STATE_CLOSED
+            self.failures = 0
+
+    def record_aborted(self):
+        """请求因为与远程服务器无关的原因没有得到结果, 如果它是试探请求, 下一个请求可以立即试探"""
+        if self.state != STATE_HALF_OPEN:
+            return
+        with self._lock:
+            if self.state == STATE_HALF_OPEN:
+                self.trial_started = 0.0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = STATE_OPEN
+                self.opened_at = time()
+
+
+# 每个域名一个熔断器
+breakers = {}  # type: dict[str, CircuitBreaker]
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(domain, failure_threshold=5, recovery_time=30):
+    """
+    获取某个域名的熔断器, 不存在则新建
+    :type domain: str
+    :rtype: CircuitBreaker
+    """
+    breaker = breakers.get(domain)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = breakers.setdefault(domain, CircuitBreaker(failure_threshold, recovery_time))
+    return breaker
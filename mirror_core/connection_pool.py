@@ -9,13 +9,22 @@ requests的连接在每个session中是自动 keep-alive 的,
     通过保持并复用 requests 的session, 可以极大地减少requests在请求远程服务器时的连接延迟
 
 以前的版本是线程不安全, 当并发数大时会出现 ConnectionResetError
+
+为支持 `connection_prewarm_enable` 选项, 还提供了 prewarm() 函数,
+    用于预先建立到某个域名的 keep-alive 连接, 使用户的第一个请求不需要等待TCP/TLS握手
 """
 from time import time
 import requests
 import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 SESSION_TTL = 180  # 在清除过期session时, 会丢弃所有180秒未活动的session
 
+# 对幂等请求的重试次数, 见 `remote_retry_count` 选项, 由 set_max_retries() 设置
+max_retries = 0
+RETRY_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
 # session池
 pool = {
     "example.com": [
@@ -31,9 +40,45 @@ pool = {
     ],
 }
 
+pool_lock = threading.Lock()  # 所有对 pool 的修改都需要持有这个锁
+
 locked_session = threading.local()  # 这是一个 thread-local 变量
 
 
+def set_max_retries(retries):
+    """设置之后新建的session对幂等请求的重试次数"""
+    global max_retries
+    max_retries = retries
+
+
+def create_session():
+    """
+    新建一个 requests.Session, 对幂等请求(GET/HEAD/OPTIONS)的连接错误和读取错误进行有限次数的重试
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    if max_retries:
+        retry = Retry(
+            total=max_retries,
+            allowed_methods=RETRY_METHODS,
+            backoff_factor=0.1,
+            raise_on_redirect=False,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return session
+
+
+def _new_session(domain):
+    return {
+        "domain": domain,
+        "session": create_session(),
+        "active": time(),
+    }
+
+
 def get_session(domain):
     """
     获取一个此域名的 keep-alive 的session
@@ -41,9 +86,6 @@ def get_session(domain):
     :type domain: str
     :rtype: requests.Session
     """
-    if domain not in pool:
-        pool[domain] = []
-
     if not hasattr(locked_session, "session"):
         # 这个变量用于存储本线程中被锁定的session
         # 当一个session被拿出来使用时, 会从 pool 中被移除, 加入到下面这个变量中
@@ -51,15 +93,16 @@ def get_session(domain):
         #    此时被锁定的session会重新进入session池
         locked_session.session = []
 
-    if not pool[domain]:
+    with pool_lock:
+        if pool.get(domain):
+            # 从线程池中取出最近的一个
+            session = pool[domain].pop()
+        else:
+            session = None
+
+    if session is None:
         # 线程池空, 新建一个 session
-        session = {
-            "domain": domain,
-            "session": requests.Session(),
-        }
-    else:
-        # 从线程池中取出最近的一个
-        session = pool[domain].pop()
+        session = _new_session(domain)
 
     session["active"] = time()
 
@@ -69,15 +112,50 @@ def get_session(domain):
 
 
 def release_lock():
+    """将本线程中被锁定的session放回session池, 在每个请求结束时调用"""
     if not hasattr(locked_session, "session"):
         return
-    for session in locked_session.session:  # type: dict
-        pool[session["domain"]].append(session)
+    with pool_lock:
+        for session in locked_session.session:  # type: dict
+            pool.setdefault(session["domain"], []).append(session)
+    locked_session.session = []
 
 
-def clear(force_flush=False):
-    if force_flush:
-        pool.clear()
+def prewarm(domain, url, **kwargs):
+    """
+    预热到某个域名的 keep-alive 连接
+    会向 url 发送一个 HEAD 请求, 完成DNS解析和TCP/TLS握手, 然后把session放回session池
+    如果池中已有session, 则复用最近的一个, 同时刷新它的活动时间, 使其不会因过期而被清除
+
+    :param domain: 域名, 与 get_session() 的参数相同
+    :type domain: str
+    :param url: 用于预热的url, 一般为 scheme://domain/
+    :type url: str
+    :param kwargs: 传给 requests.Session.head() 的其他参数, 如 proxies, verify, timeout
+    :return: 是否预热成功
+    :rtype: bool
+    """
+    with pool_lock:
+        session = pool[domain].pop() if pool.get(domain) else None
+    if session is None:
+        session = _new_session(domain)
+
+    try:
+        session["session"].head(url, allow_redirects=False, **kwargs).close()
+    except requests.RequestException:
+        return False
     else:
-        for domain in pool.keys():
-            pool[domain] = [s for s in pool[domain] if s["active"] > time() - SESSION_TTL]
+        session["active"] = time()
+        return True
+    finally:
+        with pool_lock:
+            pool.setdefault(domain, []).append(session)
+
+
+def clear(force_flush=False):
+    with pool_lock:
+        if force_flush:
+            pool.clear()
+        else:
+            for domain in pool.keys():
+                pool[domain] = [s for s in pool[domain] if s["active"] > time() - SESSION_TTL]
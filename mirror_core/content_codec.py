@@ -0,0 +1,241 @@
+# coding=utf-8
+"""
+本模块为响应内容的压缩/解压提供统一的接口, 支持 gzip, deflate, br(brotli), zstd
+
+brotli 和 zstd 依赖可选的第三方库 `brotli`(或 `brotlicffi`) 和 `zstandard`,
+    未安装时会自动禁用对应的编码, 既不会向远程服务器声明支持, 也不会用它压缩发给浏览器的响应
+
+编码名称使用 Content-Encoding 中的写法, 空字符串 "" 表示不压缩(identity)
+"""
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    from typing import Dict, List, Union
+except:  # pragma: no cover
+    pass
+
+# 向浏览器发送响应时, 压缩编码的优先顺序(从高到低)
+PREFERRED_ENCODINGS = tuple(
+    encoding for encoding, available in (("br", brotli), ("zstd", zstandard), ("gzip", True)) if available
+)
+
+# 我们能够解压的编码, 只有这些编码会在请求远程服务器时被声明
+DECODABLE_ENCODINGS = ("gzip", "deflate") + tuple(
+    encoding for encoding, available in (("br", brotli), ("zstd", zstandard)) if available
+)
+
+
+def parse_accept_encoding(accept_encoding):
+    """
+    解析 Accept-Encoding 请求头
+    'gzip, deflate;q=0.5, br;q=0' --> {'gzip': 1.0, 'deflate': 0.5, 'br': 0.0}
+    :type accept_encoding: str
+    :rtype: Dict[str, float]
+    """
+    result = {}
+    if not accept_encoding:
+        return result
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params[:2] == "q=":
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        result[name] = q
+    return result
+
+
+def acceptable_encodings(accept_encoding, candidates=PREFERRED_ENCODINGS):
+    """
+    candidates 中浏览器可以接受的编码, 按 candidates 的顺序排列
+    不压缩("")如果可以接受的话, 放在最后
+    :type accept_encoding: str
+    :param candidates: 候选的编码, 默认为我们支持压缩的编码
+    :type candidates: Tuple[str]
+    :rtype: List[str]
+    """
+    accepted = parse_accept_encoding(accept_encoding)
+    wildcard = accepted.get("*", 0.0)
+    result = [e for e in candidates if accepted.get(e, wildcard) > 0]
+    if accepted.get("identity", 1.0 if wildcard or "*" not in accepted else 0.0) > 0:
+        result.append("")
+    return result
+
+
+def negotiate(accept_encoding):
+    """
+    根据浏览器的 Accept-Encoding 选出最合适的压缩编码, 都不支持时返回 "" (不压缩)
+    :type accept_encoding: str
+    :rtype: str
+    """
+    for encoding in acceptable_encodings(accept_encoding):
+        return encoding
+    return ""
+
+
+def is_acceptable(content_encoding, accept_encoding):
+    """
+    浏览器是否能接受以 content_encoding 编码的响应
+    :type content_encoding: str
+    :type accept_encoding: str
+    :rtype: bool
+    """
+    content_encoding = content_encoding.strip().lower()
+    if not content_encoding or content_encoding == "identity":
+        return True
+    accepted = parse_accept_encoding(accept_encoding)
+    if content_encoding == "x-gzip":
+        content_encoding = "gzip"
+    return accepted.get(content_encoding, accepted.get("*", 0.0)) > 0
+
+
+def filter_accept_encoding(accept_encoding):
+    """
+    生成发送给远程服务器的 Accept-Encoding: 浏览器接受的编码中, 我们能够解压的那些
+    如果一个都没有, 则返回 "identity", 避免 requests 自动加上浏览器不支持的编码
+    :type accept_encoding: str
+    :rtype: str
+    """
+    accepted = parse_accept_encoding(accept_encoding)
+    encodings = [e for e in DECODABLE_ENCODINGS if accepted.get(e, accepted.get("*", 0.0)) > 0]
+    return ", ".join(encodings) if encodings else "identity"
+
+
+def compress(data, encoding, level=6):
+    """
+    一次性压缩
+    :type data: bytes
+    :param encoding: 压缩编码, "" 表示不压缩
+    :type encoding: str
+    :param level: 压缩级别, 对所有编码通用, 会被限制在各编码支持的范围内
+    :type level: int
+    :rtype: bytes
+    """
+    if not encoding:
+        return data
+    if encoding == "gzip":
+        compressor = zlib.compressobj(max(1, min(level, 9)), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == "deflate":
+        return zlib.compress(data, max(1, min(level, 9)))
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=max(0, min(level, 11)))
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=max(1, min(level, 22))).compress(data)
+    raise ValueError("Unsupported content encoding: {}".format(encoding))
+
+
+class _IdentityDecoder:
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class _ZlibDecoder:
+    def __init__(self, wbits):
+        self._first_try = wbits == zlib.MAX_WBITS  # deflate 可能是带zlib头的, 也可能是裸的
+        self._obj = zlib.decompressobj(wbits)
+        self._buffer = b""
+
+    def decompress(self, data):
+        if not self._first_try:
+            return self._obj.decompress(data)
+        self._buffer += data
+        try:
+            result = self._obj.decompress(data)
+        except zlib.error:
+            # 不带zlib头的裸deflate数据
+            self._first_try = False
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            result = self._obj.decompress(self._buffer)
+        else:
+            if result:
+                self._first_try = False
+        if not self._first_try:
+            self._buffer = b""
+        return result
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class _BrotliDecoder:
+    def __init__(self):
+        self._obj = brotli.Decompressor()
+        self._process = getattr(self._obj, "process", None) or self._obj.decompress
+
+    def decompress(self, data):
+        return self._process(data)
+
+    def flush(self):
+        return b""
+
+
+class _ZstdDecoder:
+    def __init__(self):
+        self._obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+def get_decoder(content_encoding):
+    """
+    获取一个增量解压器, 支持 .decompress(chunk) 和 .flush()
+    不支持的编码返回None
+    :type content_encoding: str
+    """
+    content_encoding = content_encoding.strip().lower()
+    if not content_encoding or content_encoding == "identity":
+        return _IdentityDecoder()
+    if content_encoding in ("gzip", "x-gzip"):
+        return _ZlibDecoder(16 + zlib.MAX_WBITS)
+    if content_encoding == "deflate":
+        return _ZlibDecoder(zlib.MAX_WBITS)
+    if content_encoding == "br" and brotli is not None:
+        return _BrotliDecoder()
+    if content_encoding == "zstd" and zstandard is not None:
+        return _ZstdDecoder()
+    return None
+
+
+def iter_decompress(chunks, content_encoding):
+    """
+    对一个二进制块的迭代器进行增量解压
+    :type content_encoding: str
+    :rtype: Iterator[bytes]
+    """
+    decoder = get_decoder(content_encoding)
+    if decoder is None:
+        raise ValueError("Unsupported content encoding: {}".format(content_encoding))
+    for chunk in chunks:
+        data = decoder.decompress(chunk)
+        if data:
+            yield data
+    data = decoder.flush()
+    if data:
+        yield data
@@ -0,0 +1,89 @@
+# coding=utf-8
+"""
+远程响应中 Set-Cookie 的重写, 每个cookie只解析一次, 在一次遍历中同时处理各个属性:
+    Domain    改为本站域名 (不含端口, cookie的Domain属性不能带端口)
+    Path      按 `aggressive_cookies_rewrite` 重写为 / 或者对应的子站路径, 见 config.py
+    Secure    本站为http时移除, 否则浏览器不会保存这个cookie, 同时移除 SameSite=None (它要求Secure)
+其他属性, 以及 name=value 部分原样保留
+
+同一个原始值的重写结果会被缓存, 见 SetCookieRewriter.rewrite()
+"""
+from functools import lru_cache
+
+try:
+    from typing import Iterable, List, Union
+except:  # pragma: no cover
+    pass
+
+# 缓存的 Set-Cookie 原始值的最大个数
+CACHE_SIZE = 1024
+
+
+class SetCookieRewriter:
+    def __init__(self, my_host_name, strip_secure, aggressive_path):
+        """
+        :param my_host_name: 本站域名, 不含端口
+        :type my_host_name: str
+        :param strip_secure: 是否移除 Secure 属性 (本站为http时)
+        :type strip_secure: bool
+        :param aggressive_path: 即 `aggressive_cookies_rewrite`: True 为 /, False 为子站路径, None 不重写path
+        :type aggressive_path: Union[bool, None]
+        """
+        self.my_host_name = my_host_name
+        self.strip_secure = strip_secure
+        self.aggressive_path = aggressive_path
+        self._cached_rewrite = lru_cache(maxsize=CACHE_SIZE)(self._rewrite)
+
+    def rewrite_all(self, raw_values, path_prefix=""):
+        """
+        :param raw_values: 远程响应中所有原始的 Set-Cookie 值, 每个头一个cookie
+        :type raw_values: Iterable[str]
+        :param path_prefix: 外部域名的子站路径, 如 "/extdomains/a.foobar.com", 主域名为空字符串
+        :type path_prefix: str
+        :rtype: List[str]
+        """
+        rewrite = self._cached_rewrite
+        return [rewrite(value, path_prefix) for value in raw_values]
+
+    def rewrite(self, raw_value, path_prefix=""):
+        """
+        :type raw_value: str
+        :type path_prefix: str
+        :rtype: str
+        """
+        return self._cached_rewrite(raw_value, path_prefix)
+
+    def _rewrite(self, raw_value, path_prefix):
+        segments = raw_value.split(";")
+        # 第一段是 name=value, 原样保留
+        parts = [segments[0].strip()]
+        path_index = None
+        for segment in segments[1:]:
+            segment = segment.strip()
+            if not segment:
+                continue
+            name, eq, value = segment.partition("=")
+            name_l = name.rstrip().lower()
+            if name_l == "domain":
+                parts.append("Domain=" + self.my_host_name)
+                continue
+            elif name_l == "secure":
+                if self.strip_secure:
+                    continue
+            elif name_l == "samesite":
+                if self.strip_secure and value.strip().lower() == "none":
+                    continue
+            elif name_l == "path":
+                path_index = len(parts)
+            parts.append(segment)
+
+        if path_index is not None and self.aggressive_path is not None:
+            if self.aggressive_path:
+                # 暴力cookie path重写, 把所有path都重写为 /
+                parts[path_index] = "Path=/"
+            elif path_prefix:
+                # 重写外部域名的cookie的path到当前url下, 主域名不重写
+                # eg(/extdomains/a.foobar.com): path=/verify; -> path=/extdomains/a.foobar.com/verify
+                path = parts[path_index].partition("=")[2].strip()
+                parts[path_index] = "Path=" + path_prefix + (path if path.startswith("/") else "/" + path)
+        return "; ".join(parts)
@@ -1,16 +1,25 @@
-from flask import Flask, jsonify, request
+import hmac
+from time import thread_time, time
+
+import requests
+from flask import Flask, Response, abort, jsonify, request
 
 from utils.util import *
 
+from . import access_log, connection_pool, errors, metrics, profiler, stream_control, structured_log
+from .circuit_breaker import CircuitOpenError
 from .page_generator import PageGenerator
 from .post_request import ResponseRewriter
 from .prior_request import RequestRewriter
 from .request_remote import RequestSender
+from .request_context import RequestContext
 from .shares import Shares
-from .threadlocal import ZmirrorThreadLocal
 
 app = Flask(__name__)
 
+# 浏览器(或前端代理)提供的 X-Request-ID 只有符合这个格式才会被使用
+_request_id_regex = re.compile(r"^[\w.:-]{1,64}$")
+
 
 class LeoMirrorApp:
     def __init__(self) -> None:
@@ -19,13 +28,10 @@ class LeoMirrorApp:
 
     def init_app(self) -> None:
         self.app = app
-        self.parse = ZmirrorThreadLocal()
         self.G = Shares()
 
-        self.req_rewriter = RequestRewriter(self.parse, self.G)
-        self.req_sender = RequestSender(self.parse, self.G)
-        self.resp_rewriter = ResponseRewriter(self.parse, self.G)
-        self.page_generator = PageGenerator(self.parse)
+        # 不与具体请求相关的页面(如首页)
+        self.page_generator = PageGenerator(None)
 
     def run(self, host="127.0.0.1", port=80, debug=False) -> None:
         port = self.G.conf.my_port or port
@@ -40,22 +46,167 @@ class LeoMirrorApp:
         else:
             return jsonify({"message": "Hello from LeoMirror!"})
 
+    def metrics_page(self):
+        """
+        Prometheus 格式的统计数据, 只允许 `metrics_allowed_ips` 中带有 `admin_token` 的请求访问, 其他人看到的是404
+            Prometheus 的 scrape_config 中设置 authorization: {credentials: <admin_token>} 即可
+        参数 format=json 时返回每个正在进行的, 以及最近结束的stream的吞吐量统计和预读线程池的状态
+        """
+        if not self.is_admin_request(self.G.conf.metrics_allowed_ips):
+            abort(404)
+        if request.args.get("format") == "json":
+            return jsonify(stream_control.get_stream_stats())
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    def is_admin_request(self, allowed_ips):
+        """
+        管理页面的访问控制: 来源IP在 allowed_ips 中, 并且请求头中带有正确的 `admin_token`
+            部署在反向代理(如本机的nginx)之后时, 所有访问者的IP都是 127.0.0.1, 只检查IP是不够的
+            token 放在请求头 Authorization: Bearer <token> 中, 而不是url中, 以免被写入访问日志
+        没有设置 `admin_token` 时, 管理页面一律不可访问
+        :type allowed_ips: Iterable[str]
+        :rtype: bool
+        """
+        token = self.G.conf.admin_token
+        if not token or request.remote_addr not in allowed_ips:
+            return False
+        scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+    def profile_page(self):
+        """
+        在后台开始采样, 立即返回输出文件的路径, 同一时间只能有一次采样
+        只允许 `profiler_allowed_ips` 中带有 `admin_token` 的请求访问, 见 is_admin_request()
+        参数: seconds, interval(秒), format(collapsed/speedscope), 默认值见设置
+        """
+        conf = self.G.conf
+        if not self.is_admin_request(conf.profiler_allowed_ips):
+            abort(404)
+        try:
+            seconds = float(request.args.get("seconds", conf.profiler_seconds))
+            interval = float(request.args.get("interval", conf.profiler_interval))
+        except ValueError:
+            return jsonify({"error": "seconds and interval should be numbers"}), 400
+        output_format = request.args.get("format", conf.profiler_format)
+        if output_format not in profiler.FORMATS:
+            return jsonify({"error": "format should be one of: " + ", ".join(profiler.FORMATS)}), 400
+        seconds = min(max(seconds, 0.1), profiler.MAX_SECONDS)
+        interval = max(interval, 0.001)
+
+        path = profiler.profiler.start(seconds, interval, output_format, conf.profiler_output_dir)
+        if path is None:
+            return jsonify({"error": "profiler is already running", "last_file": profiler.profiler.last_file}), 409
+        self.G.logger.info("ProfilerStarted", seconds, interval, path)
+        return jsonify({"file": path, "seconds": seconds, "interval": interval, "format": output_format})
+
     def entry_point(self, input_path):
+        # 日志的关联ID, 优先使用前端代理提供的, 见 structured_log
+        request_id = request.headers.get("X-Request-ID")
+        if request_id is None or not _request_id_regex.match(request_id):
+            request_id = structured_log.new_request_id()
+        structured_log.set_request_id(request_id)
+
+        # 每个请求一个新的上下文, 不会残留上一个请求的状态
+        parse = RequestContext(request.method)
+        parse.time["start_time"] = thread_time()
+        _start_time = time()
+        resp = self.handle_request(parse)
+        metrics.observe_stage("total", time() - _start_time)
+        metrics.requests_total.inc(resp.status_code)
+        if self.G.access_log is not None:
+            self.write_access_log(parse, resp, _start_time)
+        return resp
+
+    def write_access_log(self, parse, resp, start_time):
+        """
+        记录访问日志, 字段的含义见 access_log
+        stream模式的响应在传输结束后才会被写入
+        :type parse: RequestContext
+        :type resp: Response
+        :type start_time: float
+        """
+        entry = {
+            "ts": round(start_time, 3),
+            "rid": structured_log.get_request_id(),
+            "m": request.method,
+            "url": request.url,
+            "rurl": parse.remote_url,
+            "st": resp.status_code,
+            "bin": request.content_length or 0,
+            "cache": parse.cache_result,
+            "strm": resp.is_streamed and not resp.direct_passthrough,
+            # parse.time 中除了时间点以外都是耗时
+            "t": {k: round(v, 4) for k, v in parse.time.items() if k not in ("start_time", "req_start_time")},
+        }
+        if entry["strm"]:
+            access_log.track_streamed_response(resp, entry, self.G.access_log)
+        else:
+            entry["bout"] = resp.content_length or 0
+            entry["t"]["total"] = round(time() - start_time, 4)
+            self.G.access_log.write(entry)
+
+    def handle_request(self, parse):
+        """
+        处理请求的各个组件都是为本请求新建的, 通过 parse 共享请求的状态
+        :type parse: RequestContext
+        :rtype: Response
+        """
+        req_rewriter = RequestRewriter(parse, self.G)
+        req_sender = RequestSender(parse, self.G)
+        resp_rewriter = ResponseRewriter(parse, self.G)
+        page_generator = PageGenerator(parse)
         try:
-            self.req_rewriter.assemle_parse()
-            self.req_sender.request_remote_site()
-            resp = self.resp_rewriter.generate_our_response()
+            req_rewriter.assemle_parse()
+            with metrics.stage("cache_lookup", parse.time):
+                cached_resp = resp_rewriter.try_get_cached_response()
+            if cached_resp is not None:
+                return cached_resp
+            req_sender.request_remote_site()
+            resp = resp_rewriter.generate_our_response()
             return resp
+        except CircuitOpenError as e:
+            errors.record_error(e.domain, "circuit_open")
+            self.G.logger.warn("CircuitOpen, fail fast:", e.domain)
+            return page_generator.generate_upstream_error_page(
+                "Remote server is temporarily unavailable", 503, retry_after=e.retry_after
+            )
+        except requests.Timeout:
+            errors.record_error(parse.remote_domain, "timeout")
+            self.G.logger.warn("RemoteTimeout:", parse.remote_url)
+            return page_generator.generate_upstream_error_page("Remote server timed out", 504)
+        except requests.ConnectionError:
+            errors.record_error(parse.remote_domain, "connection")
+            self.G.logger.warn("RemoteConnectionError:", parse.remote_url)
+            return page_generator.generate_upstream_error_page("Can not connect to remote server", 502)
         except:
-            self.G.logger.error("Error occurred while generating response")
-            traceback.print_exc()
-            return self.page_generator.generate_error_page(
+            errors.record_error(parse.remote_domain, "internal")
+            # traceback 和快照dump在 generate_error_page 中进行, 并且有频率限制
+            return page_generator.generate_error_page(
                 errormsg="Error occurred while generating response", is_traceback=True
             )
+        finally:
+            # 将本次请求使用的session放回连接池, 供之后的请求复用
+            connection_pool.release_lock()
+            # 唤醒等待本请求的重叠Range请求, 关闭没能发送出去的stream传输 (如果还没有交给WSGI服务器的话)
+            resp_rewriter.finish_pending_transfers()
 
 
 mirror_app = LeoMirrorApp()
 
+if mirror_app.G.conf.metrics_enable:
+    # 固定路径的路由优先于下面的通配路由, 不会被当作镜像的页面
+    app.add_url_rule(mirror_app.G.conf.metrics_path, "metrics", mirror_app.metrics_page)
+if mirror_app.G.conf.profiler_enable:
+    app.add_url_rule(mirror_app.G.conf.profiler_path, "profiler", mirror_app.profile_page)
+    if mirror_app.G.conf.profiler_signal:
+        profiler.install_signal_handler(
+            mirror_app.G.conf.profiler_signal,
+            mirror_app.G.conf.profiler_seconds,
+            mirror_app.G.conf.profiler_interval,
+            mirror_app.G.conf.profiler_format,
+            mirror_app.G.conf.profiler_output_dir,
+        )
+
 
 # @app.route("/", methods=["GET", "POST"])
 # def home():
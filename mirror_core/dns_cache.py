@@ -0,0 +1,118 @@
+# coding=utf-8
+"""
+本模块为支持 `dns_cache_enable` 选项而存在
+提供了一个带TTL的、线程安全的DNS解析缓存
+
+requests(urllib3) 在每次新建连接时都会调用 `socket.getaddrinfo` 进行DNS解析,
+    对于被镜像的域名来说, 这意味着每个新连接都要付出一次DNS查询的延迟
+通过替换 `socket.getaddrinfo`, 对 `allowed_domains` 中的域名的解析结果进行缓存,
+    其他域名的解析不受任何影响
+
+当缓存过期而重新解析失败时, 会继续使用已过期的解析结果(stale), 以避免DNS服务器的临时故障影响镜像
+"""
+import socket
+import threading
+from time import time
+
+DNS_TTL = 300  # 解析结果的默认有效时间, 秒
+
+_original_getaddrinfo = socket.getaddrinfo
+
+# 解析缓存
+# key: (host, port, family, type, proto, flags)
+# value: (过期时间, getaddrinfo的返回值)
+_cache = {}
+_cache_lock = threading.Lock()
+
+_cacheable_hosts = set()  # type: set[str]
+_ttl = DNS_TTL
+
+
+def _split_host_port(domain):
+    """
+    'example.com:8080' --> ('example.com', 8080)
+    'example.com' --> ('example.com', None)
+    """
+    host, _, port = domain.partition(":")
+    return host, int(port) if port.isdigit() else None
+
+
+def cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    """`socket.getaddrinfo` 的带缓存版本, 仅缓存 `_cacheable_hosts` 中的域名"""
+    if host not in _cacheable_hosts:
+        return _original_getaddrinfo(host, port, family, type, proto, flags)
+
+    key = (host, port, family, type, proto, flags)
+    item = _cache.get(key)
+    if item is not None and item[0] > time():
+        return item[1]
+
+    try:
+        result = _original_getaddrinfo(host, port, family, type, proto, flags)
+    except socket.gaierror:
+        if item is not None:
+            # 解析失败时使用过期的结果
+            return item[1]
+        raise
+
+    with _cache_lock:
+        _cache[key] = (time() + _ttl, result)
+    return result
+
+
+def install(domains, ttl=DNS_TTL):
+    """
+    启用DNS缓存
+    :param domains: 需要缓存解析结果的域名(可以带端口)
+    :type domains: Iterable[str]
+    :param ttl: 解析结果的有效时间, 秒
+    :type ttl: int
+    """
+    global _ttl
+    _ttl = ttl
+    for domain in domains:
+        _cacheable_hosts.add(_split_host_port(domain)[0])
+    socket.getaddrinfo = cached_getaddrinfo
+
+
+def uninstall():
+    socket.getaddrinfo = _original_getaddrinfo
+    clear()
+
+
+def resolve(domain, default_port=443):
+    """
+    预先解析一个域名, 并写入缓存
+    :param domain: 域名, 可以带端口
+    :type domain: str
+    :param default_port: 域名中没有端口时使用的端口, 应该与连接时的scheme一致(https为443, http为80),
+        否则 urllib3 连接时的解析不会命中缓存
+    :type default_port: int
+    :return: 是否解析成功
+    :rtype: bool
+    """
+    host, port = _split_host_port(domain)
+    try:
+        # 与 urllib3.util.connection.create_connection 中的调用参数保持一致, 才能命中缓存
+        cached_getaddrinfo(host, port or default_port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    except socket.gaierror:
+        return False
+    return True
+
+
+def refresh():
+    """重新解析所有即将过期的缓存条目, 使用户请求不需要等待DNS解析"""
+    for key, (expire, _) in list(_cache.items()):
+        if expire - time() > _ttl / 3:
+            continue
+        try:
+            result = _original_getaddrinfo(*key)
+        except socket.gaierror:
+            continue
+        with _cache_lock:
+            _cache[key] = (time() + _ttl, result)
+
+
+def clear():
+    with _cache_lock:
+        _cache.clear()
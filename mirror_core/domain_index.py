@@ -0,0 +1,133 @@
+# coding=utf-8
+"""
+域名分类索引, 在启动时根据设置生成一次, 之后每次判断只需要一次dict查找,
+    不需要反复读取 Config 的属性(其中一些每次都会重新生成list或set)
+
+索引中包含 `allowed_domains` 中的每一个域名(包括 host:port 的形式), 每个域名对应一个 DomainInfo:
+    is_external    是否是外部域名, 不在 `target_domain_alias` 中的都是外部域名
+    use_https      请求远程服务器时是否使用https (TLS策略), 主域名见 `target_scheme`, 外部域名见 `force_https_domains`
+    scheme         请求远程服务器时使用的scheme, "https://" 或者 "http://"
+    mirror_prefix  镜像中的路径前缀, 主域名为空字符串, 外部域名为 "/extdomains/域名"
+
+索引是不可变的, 域名设置改变时应该生成一个新的索引并替换掉旧的, 见 with_domains()
+"""
+try:
+    from typing import Dict, FrozenSet, Iterable, Union
+    from configuration import Config
+except:  # pragma: no cover
+    pass
+
+
+class DomainInfo:
+    __slots__ = ("domain", "is_external", "use_https", "scheme", "mirror_prefix")
+
+    def __init__(self, domain, is_external, use_https):
+        """
+        :type domain: str
+        :type is_external: bool
+        :type use_https: bool
+        """
+        self.domain = domain  # type: str
+        self.is_external = is_external  # type: bool
+        self.use_https = use_https  # type: bool
+        self.scheme = "https://" if use_https else "http://"  # type: str
+        self.mirror_prefix = "/extdomains/" + domain if is_external else ""  # type: str
+
+    def __repr__(self):
+        return "<DomainInfo %s %s %s%s>" % (
+            self.domain,
+            "external" if self.is_external else "main",
+            self.scheme,
+            " " + self.mirror_prefix if self.mirror_prefix else "",
+        )
+
+
+class DomainIndex:
+    def __init__(self, conf, extra_domains=()):
+        """
+        :type conf: Config
+        :param extra_domains: 额外的外部域名, 比如自动白名单中的域名
+        :type extra_domains: Iterable[str]
+        """
+        if conf is None:
+            # 由 with_domains() 复制
+            return
+        force_https = conf.force_https_domains
+        if force_https == "ALL":
+            self._https_all = True
+            self._https_domains = frozenset()  # type: FrozenSet[str]
+        else:
+            self._https_all = False
+            if force_https == "NONE" or force_https is None:
+                self._https_domains = frozenset()
+            else:
+                self._https_domains = frozenset(force_https)
+        self._main_domains = frozenset(conf.target_domain_alias)  # type: FrozenSet[str]
+        main_use_https = conf.target_scheme == "https://"
+
+        index = {}  # type: Dict[str, DomainInfo]
+        for domain in set(conf.allowed_domains) | set(extra_domains):
+            if domain in self._main_domains:
+                index[domain] = DomainInfo(domain, False, main_use_https)
+            else:
+                index[domain] = DomainInfo(domain, True, self.use_https(domain))
+        self._index = index
+        self.domains = frozenset(index)  # type: FrozenSet[str]
+
+    def with_domains(self, domains):
+        """
+        复制一份索引, 并加入新的外部域名, 原来的索引不变
+        :type domains: Iterable[str]
+        :rtype: DomainIndex
+        """
+        new = DomainIndex(None)
+        new._https_all = self._https_all
+        new._https_domains = self._https_domains
+        new._main_domains = self._main_domains
+        new._index = dict(self._index)
+        for domain in domains:
+            if domain not in new._index:
+                new._index[domain] = DomainInfo(domain, domain not in self._main_domains, self.use_https(domain))
+        new.domains = frozenset(new._index)
+        return new
+
+    def __contains__(self, domain):
+        """
+        是否在 `allowed_domains` 中
+        :type domain: str
+        :rtype: bool
+        """
+        return domain in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, domain):
+        """
+        :type domain: str
+        :return: 不在 `allowed_domains` 中时返回None
+        :rtype: Union[DomainInfo, None]
+        """
+        return self._index.get(domain)
+
+    def is_external(self, domain):
+        """
+        不在 `target_domain_alias` 中的域名都是外部域名, 包括不在索引中的
+        :type domain: str
+        :rtype: bool
+        """
+        return domain not in self._main_domains
+
+    def use_https(self, domain):
+        """
+        请求这个外部域名时是否使用https, 即 `force_https_domains`
+        :type domain: str
+        :rtype: bool
+        """
+        return self._https_all or domain in self._https_domains
+
+    def dump(self):
+        """
+        :rtype: Dict[str, str]
+        """
+        return {domain: repr(info) for domain, info in sorted(self._index.items())}
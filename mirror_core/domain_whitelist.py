@@ -0,0 +1,177 @@
+# coding=utf-8
+"""
+本模块为支持 `automatic_domains_whitelist_enable` 选项而存在
+
+响应中出现的, 不在 `allowed_domains` 中的域名, 如果匹配 `domains_whitelist_auto_add_glob_list` 中的某个通配符,
+    就会被自动加入白名单(外部域名), 见 Shares.try_auto_add_domain()
+
+    通配符被编译为一棵按域名标签(label)从右往左的后缀树(suffix trie):
+        *.example.com    com -> example -> (左边剩下的任意内容)
+        img?.cdn.net     net -> cdn -> (左边剩下的部分用 fnmatch 匹配 "img?")
+        foo.*            最右边的标签就含有通配符, 只能对整个域名用 fnmatch 匹配
+    匹配一个域名只需要从右往左走一遍它的标签, 不需要逐个尝试所有的通配符
+
+    白名单的大小有上限(`automatic_domains_whitelist_max_size`), 满了以后不再添加新的域名
+    学习到的域名会被追加到 `automatic_domains_whitelist_file` 文件中, 重启后自动加载(仍然需要匹配当前的通配符)
+"""
+import os
+import re
+import threading
+from fnmatch import translate
+from functools import lru_cache
+
+try:
+    from typing import Dict, Iterable, List, Union
+except:  # pragma: no cover
+    pass
+
+# 缓存的域名匹配结果的个数, 同一个页面中的域名会反复出现
+MATCH_CACHE_SIZE = 4096
+
+_GLOB_CHARS = frozenset("*?[")
+
+
+class _TrieNode:
+    __slots__ = ("children", "exact", "any_prefix", "prefix_regexes")
+
+    def __init__(self):
+        self.children = {}  # type: Dict[str, _TrieNode]
+        self.exact = False  # 通配符在这里结束, 没有剩下的部分, 即完全相同的域名
+        self.any_prefix = False  # 剩下的部分是 "*", 匹配左边的任意非空内容
+        self.prefix_regexes = []  # type: List[re.Pattern]
+
+
+class GlobSuffixTrie:
+    def __init__(self, patterns=()):
+        """
+        :param patterns: 通配符(glob)形式的域名, 如 "*.example.com"
+        :type patterns: Iterable[str]
+        """
+        self.root = _TrieNode()
+        self.patterns = []  # type: List[str]
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        """
+        :type pattern: str
+        """
+        pattern = pattern.strip().lower()
+        if not pattern:
+            return
+        self.patterns.append(pattern)
+        labels = pattern.split(".")
+        node = self.root
+        while labels and not _GLOB_CHARS.intersection(labels[-1]):
+            node = node.children.setdefault(labels.pop(), _TrieNode())
+        if not labels:
+            node.exact = True
+        elif labels == ["*"]:
+            node.any_prefix = True
+        else:
+            # 剩下的部分(不含最后的 ".")交给 fnmatch
+            node.prefix_regexes.append(re.compile(translate(".".join(labels))))
+
+    def match(self, host):
+        """
+        :param host: 小写的域名, 不含端口
+        :type host: str
+        :rtype: bool
+        """
+        labels = host.split(".")
+        node = self.root
+        index = len(labels)
+        while True:
+            if index > 0:
+                if node.any_prefix:
+                    return True
+                if node.prefix_regexes:
+                    prefix = ".".join(labels[:index])
+                    for regex in node.prefix_regexes:
+                        if regex.match(prefix):
+                            return True
+            elif node.exact:
+                return True
+            if index == 0:
+                return False
+            index -= 1
+            node = node.children.get(labels[index])
+            if node is None:
+                return False
+
+
+class AutoDomainWhitelist:
+    def __init__(self, glob_list, max_size=1000, persist_file=None):
+        """
+        :param glob_list: 即 `domains_whitelist_auto_add_glob_list`
+        :type glob_list: Iterable[str]
+        :param max_size: 自动添加的域名的最大个数
+        :type max_size: int
+        :param persist_file: 学习到的域名的保存文件, 为None时不保存
+        :type persist_file: Union[str, None]
+        """
+        self.trie = GlobSuffixTrie(glob_list)
+        self.max_size = max_size
+        self.persist_file = persist_file
+        self.learned = {}  # type: Dict[str, None]  # 有序的集合
+        self.dropped = 0  # 因为白名单已满而被忽略的次数
+        self._lock = threading.Lock()
+        self.match = lru_cache(maxsize=MATCH_CACHE_SIZE)(self._match)
+
+    def _match(self, domain):
+        """
+        :param domain: 域名, 可以带端口
+        :type domain: str
+        :rtype: bool
+        """
+        host, _, port = domain.lower().partition(":")
+        # 只接受合法的域名字符和端口
+        if not host or host.strip("abcdefghijklmnopqrstuvwxyz0123456789-.") or (port and not port.isdigit()):
+            return False
+        return self.trie.match(host)
+
+    def add(self, domain):
+        """
+        把匹配通配符的域名加入白名单
+        :type domain: str
+        :return: 是否是新加入的域名
+        :rtype: bool
+        """
+        if not self.match(domain):
+            return False
+        with self._lock:
+            if domain in self.learned:
+                return False
+            if len(self.learned) >= self.max_size:
+                self.dropped += 1
+                return False
+            self.learned[domain] = None
+            self._persist(domain)
+        return True
+
+    def load(self):
+        """
+        从文件中加载之前学习到的域名, 不再匹配当前通配符的会被忽略
+        :return: 加载的域名
+        :rtype: List[str]
+        """
+        if not self.persist_file or not os.path.exists(self.persist_file):
+            return []
+        with open(self.persist_file, "r", encoding="utf-8") as fp:
+            lines = fp.read().split()
+        with self._lock:
+            for domain in lines:
+                if len(self.learned) >= self.max_size:
+                    break
+                if domain not in self.learned and self.match(domain):
+                    self.learned[domain] = None
+        return list(self.learned)
+
+    def _persist(self, domain):
+        if not self.persist_file:
+            return
+        try:
+            with open(self.persist_file, "a", encoding="utf-8") as fp:
+                fp.write(domain + "\n")
+        except OSError:  # coverage: exclude
+            pass
@@ -0,0 +1,109 @@
+# coding=utf-8
+"""
+本模块为错误处理提供分级的、低开销的支持, 远程服务器故障时, 失败的请求不应该给本机带来额外的负担
+
+    1. 错误计数: 按 (远程域名, 错误类型) 聚合, 见 record_error() 和 get_error_stats(), 同时记录到 metrics 中
+    2. 错误页面: 默认使用预先生成的简单页面, 只有 `error_page_show_detail` 开启时才生成包含详细信息的页面
+    3. traceback 和快照(snapshot)dump: 按 `error_snapshot_sample_rate` 采样,
+        且每分钟最多 `error_snapshot_max_per_minute` 次, 超出的只计数, 见 RateLimiter
+
+错误类型(kind):
+    circuit_open  熔断器打开, 快速失败
+    timeout       连接或读取远程服务器超时
+    connection    无法连接远程服务器
+    internal      zmirror 内部错误
+"""
+import threading
+from collections import Counter
+from functools import lru_cache
+from random import random
+from time import time
+
+from . import metrics
+
+try:
+    from typing import Dict, Tuple, Union
+except:  # pragma: no cover
+    pass
+
+
+class RateLimiter:
+    """
+    令牌桶, 每分钟最多放行 max_per_minute 次, 并且只有 sample_rate 比例的调用有机会被放行
+    """
+
+    def __init__(self, max_per_minute=6, sample_rate=1.0):
+        self._lock = threading.Lock()
+        self.suppressed = 0  # 被拒绝的次数
+        self.configure(max_per_minute, sample_rate)
+
+    def configure(self, max_per_minute, sample_rate):
+        with self._lock:
+            self.max_per_minute = max(0, max_per_minute)
+            self.sample_rate = sample_rate
+            self._tokens = float(self.max_per_minute)
+            self._last_time = time()
+
+    def allow(self):
+        """
+        :rtype: bool
+        """
+        if self.sample_rate < 1 and random() >= self.sample_rate:
+            self.suppressed += 1
+            return False
+        with self._lock:
+            now = time()
+            self._tokens = min(self.max_per_minute, self._tokens + (now - self._last_time) * self.max_per_minute / 60)
+            self._last_time = now
+            if self._tokens < 1:
+                self.suppressed += 1
+                return False
+            self._tokens -= 1
+            return True
+
+
+# 控制内部错误时的 traceback 输出和快照dump, 大小由 Shares 根据设置调整
+snapshot_limiter = RateLimiter()
+
+_error_counts = Counter()  # type: Counter[Tuple[str, str]]
+_error_counts_lock = threading.Lock()
+
+
+def record_error(host, kind):
+    """
+    记录一次错误
+    :param host: 远程域名, 未知时为None
+    :type host: Union[str, None]
+    :param kind: 错误类型, 见模块说明
+    :type kind: str
+    """
+    host = host or "-"
+    with _error_counts_lock:
+        _error_counts[(host, kind)] += 1
+    metrics.errors_total.inc(host, kind)
+
+
+def get_error_stats():
+    """
+    各个域名的各类错误的次数
+    :rtype: Dict[str, Dict[str, int]]
+    """
+    result = {}
+    with _error_counts_lock:
+        items = list(_error_counts.items())
+    for (host, kind), count in items:
+        result.setdefault(host, {})[kind] = count
+    return result
+
+
+@lru_cache(maxsize=64)
+def get_simple_error_body(error_code, errormsg):
+    """
+    简单错误页面的内容, 相同的 (状态码, 信息) 只会生成一次
+    :type error_code: int
+    :type errormsg: str
+    :rtype: bytes
+    """
+    from html import escape
+
+    return "<h1>{code}</h1><p>{msg}</p>".format(code=error_code, msg=escape(errormsg)).encode()
@@ -0,0 +1,279 @@
+# coding=utf-8
+"""
+请求头/响应头的处理表, 在启动时根据设置生成一次, 之后每个请求只需要按头的名称查表, 不需要 if/elif 链
+
+每一项把小写的头名称映射到一个动作:
+    DROP            丢弃
+    PASS            原样保留
+    REWRITE_URL     重写其中的url (请求头: 本站域名 --> 远程域名, 响应头 Location: 远程url --> 镜像url)
+    REWRITE_COOKIE  重写cookie (请求头 Cookie, 响应头 Set-Cookie)
+    FIXED           使用固定的值 (参数), 比如 Access-Control-Allow-Origin
+    CALL            调用参数中的函数 func(owner, value), owner 为 RequestRewriter 或 ResponseRewriter,
+                        返回新的值, 返回None表示丢弃
+
+查表时头名称的原始形式(如 "User-Agent", 或者WSGI environ中的 "HTTP_USER_AGENT")也会被缓存,
+    同一个名称不会被重复地转为小写
+
+每个请求的开销可以这样测量:
+    python -m mirror_core.header_pipeline [--number 20000]
+"""
+from functools import lru_cache
+
+from flask import request
+
+from utils.util import is_mime_represents_text
+
+from . import content_codec
+
+try:
+    from typing import Callable, Dict, Iterable, Tuple, Union
+except:  # pragma: no cover
+    pass
+
+DROP = 0
+PASS = 1
+REWRITE_URL = 2
+REWRITE_COOKIE = 3
+FIXED = 4
+CALL = 5
+
+ACTION_NAMES = ("drop", "pass", "rewrite_url", "rewrite_cookie", "fixed", "call")
+
+# 缓存的原始头名称的最大个数, 头名称由浏览器(或远程服务器)决定, 避免被任意的名称占满内存
+MAX_CACHED_NAMES = 1024
+
+
+class HeaderTable:
+    def __init__(self, rules, default=(PASS, None)):
+        """
+        :param rules: {头名称: (动作, 参数)}
+        :type rules: Dict[str, Tuple[int, object]]
+        :param default: 不在 rules 中的头的动作
+        :type default: Tuple[int, object]
+        """
+        self.rules = {name.lower(): rule for name, rule in rules.items()}
+        self.default = default
+        self._entries = {}  # type: Dict[str, Tuple[str, int, object]]
+        self._environ_entries = {}  # type: Dict[str, Tuple[str, int, object]]
+
+    def lookup(self, name):
+        """
+        :param name: 原始的头名称, 大小写任意
+        :type name: str
+        :return: (小写的头名称, 动作, 参数)
+        :rtype: Tuple[str, int, object]
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            name_l = name.lower()
+            action, arg = self.rules.get(name_l, self.default)
+            entry = (name_l, action, arg)
+            if len(self._entries) < MAX_CACHED_NAMES:
+                self._entries[name] = entry
+        return entry
+
+    def lookup_environ(self, key):
+        """
+        与 lookup() 相同, 但使用 WSGI environ 中的名称, 如 "HTTP_USER_AGENT", "CONTENT_TYPE"
+        :type key: str
+        :rtype: Tuple[str, int, object]
+        """
+        entry = self._environ_entries.get(key)
+        if entry is None:
+            name_l = (key[5:] if key.startswith("HTTP_") else key).replace("_", "-").lower()
+            action, arg = self.rules.get(name_l, self.default)
+            entry = (name_l, action, arg)
+            if len(self._environ_entries) < MAX_CACHED_NAMES:
+                self._environ_entries[key] = entry
+        return entry
+
+    def dump(self):
+        """
+        :rtype: Dict[str, str]
+        """
+        result = {"*": ACTION_NAMES[self.default[0]]}
+        for name, (action, _) in sorted(self.rules.items()):
+            result[name] = ACTION_NAMES[action]
+        return result
+
+
+# ------------- CALL 动作的函数 -------------
+def drop_if_empty(owner, value):
+    # 在flask的request中, 无论浏览器实际有没有传入, content-type头会始终存在,
+    #   如果它是空值, 则表示实际上没这个头, 则剔除掉
+    return value or None
+
+
+# 浏览器的 Accept-Encoding 只有少数几种
+_filter_accept_encoding = lru_cache(maxsize=256)(content_codec.filter_accept_encoding)
+
+
+def filter_accept_encoding(owner, value):
+    # 只向远程服务器声明浏览器支持, 并且我们也能解压的编码(gzip deflate, 以及安装了对应库时的 br zstd)
+    #   文本响应需要解压后重写, 二进制响应会以原始的压缩形式透传给浏览器
+    return _filter_accept_encoding(value)
+
+
+def force_utf8_content_type(owner, value):
+    # 文本响应在重写后都是utf-8编码的
+    parse = owner.parse
+    if is_mime_represents_text(parse.mime, owner.G.conf.text_like_mime_types) and "utf-8" not in value:
+        return parse.mime + "; charset=utf-8"
+    return value
+
+
+def request_origin(owner, value):
+    return request.headers.get("Origin") or owner.G.conf.my_scheme_and_host
+
+
+# ------------- 根据设置生成表 -------------
+def build_request_header_table(conf):
+    """
+    浏览器请求头: 黑名单制, 不在表中的头会被重写其中的url后保留
+    :rtype: HeaderTable
+    """
+    rules = {
+        # 会在zmirror请求时重新生成
+        "host": (DROP, None),
+        "content-length": (DROP, None),
+        "content-type": (CALL, drop_if_empty),
+        "accept-encoding": (CALL, filter_accept_encoding),
+        "cookie": (REWRITE_COOKIE, None),
+    }
+    for name in conf.request_rewrite_skip_headers:
+        rules.setdefault(name, (PASS, None))
+    return HeaderTable(rules, default=(REWRITE_URL, None))
+
+
+def build_response_header_table(conf):
+    """
+    远程响应头: 白名单制, 只有 `allowed_remote_response_headers` 中的头(以及 Set-Cookie)会被发送回浏览器
+    :rtype: HeaderTable
+    """
+    rules = {name: (PASS, None) for name in conf.allowed_remote_response_headers}
+    rules["set-cookie"] = (REWRITE_COOKIE, None)
+    if "location" in rules:
+        rules["location"] = (REWRITE_URL, None)
+    if "content-type" in rules:
+        rules["content-type"] = (CALL, force_utf8_content_type)
+    if conf.custom_allowed_origin is None:
+        origin_rule = (FIXED, conf.my_scheme_and_host)
+    elif conf.custom_allowed_origin == "_*_":  # coverage: exclude
+        origin_rule = (CALL, request_origin)
+    else:
+        origin_rule = (FIXED, conf.custom_allowed_origin)
+    for name in ("access-control-allow-origin", "timing-allow-origin"):
+        if name in rules:
+            rules[name] = origin_rule
+    return HeaderTable(rules, default=(DROP, None))
+
+
+def iter_raw_request_headers(environ):
+    """
+    浏览器的原始请求头 [(environ中的名称, 值)], 与 request.headers 包含的头相同,
+        但是不会把每个名称都转换为 "User-Agent" 的形式, 名称由 HeaderTable.lookup_environ() 查表
+    :type environ: dict
+    :rtype: Iterable[Tuple[str, str]]
+    """
+    for key, value in environ.items():
+        if key.startswith("HTTP_"):
+            # 与werkzeug相同, 忽略 CGI 中可能出现的这两个重复的头
+            if key != "HTTP_CONTENT_TYPE" and key != "HTTP_CONTENT_LENGTH":
+                yield key, value
+        elif (key == "CONTENT_TYPE" or key == "CONTENT_LENGTH") and value:
+            yield key, value
+
+
+def iter_raw_response_headers(remote_response):
+    """
+    远程响应的原始头列表, 重复的头(如 Set-Cookie)不会被合并, 见 ResponseRewriter.rewrite_resp_headers()
+    :type remote_response: requests.Response
+    :rtype: Iterable[Tuple[str, str]]
+    """
+    original_response = getattr(remote_response.raw, "_original_response", None)
+    if original_response is not None:
+        return original_response.headers._headers
+    return remote_response.headers.items()  # coverage: exclude
+
+
+# ------------- 微基准测试 -------------
+_SAMPLE_REQUEST_HEADERS = [
+    ("Host", "{my_host}"),
+    ("Connection", "keep-alive"),
+    ("Cache-Control", "max-age=0"),
+    ("Sec-Ch-Ua", '"Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"'),
+    ("Sec-Ch-Ua-Mobile", "?0"),
+    ("Sec-Ch-Ua-Platform", '"Windows"'),
+    ("Upgrade-Insecure-Requests", "1"),
+    ("User-Agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                   "Chrome/124.0.0.0 Safari/537.36"),
+    ("Accept", "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8"),
+    ("Sec-Fetch-Site", "same-origin"),
+    ("Sec-Fetch-Mode", "navigate"),
+    ("Sec-Fetch-User", "?1"),
+    ("Sec-Fetch-Dest", "document"),
+    ("Referer", "http://{my_host}/extdomains/static.example.com/index.html?from=nav"),
+    ("Accept-Encoding", "gzip, deflate, br, zstd"),
+    ("Accept-Language", "zh-CN,zh;q=0.9,en;q=0.8"),
+    ("Cookie", "sid=4f2a9c0e1b; theme=dark; zmirror_verify=75bf23086a541e1f; last=/extdomains/a.example.com/"),
+]
+
+_SAMPLE_RESPONSE_HEADERS = [
+    ("Date", "Mon, 19 Oct 2026 06:44:10 GMT"),
+    ("Content-Type", "text/html; charset=GBK"),
+    ("Transfer-Encoding", "chunked"),
+    ("Connection", "keep-alive"),
+    ("Cache-Control", "private, max-age=0"),
+    ("Expires", "Mon, 19 Oct 2026 06:44:10 GMT"),
+    ("Server", "nginx"),
+    ("Strict-Transport-Security", "max-age=31536000"),
+    ("X-Frame-Options", "SAMEORIGIN"),
+    ("Set-Cookie", "sid=4f2a9c0e1b; domain=.{target}; path=/; Secure"),
+    ("Set-Cookie", "theme=dark; expires=Tue, 19 Oct 2027 06:44:10 GMT; domain=.{target}; path=/"),
+    ("Access-Control-Allow-Origin", "https://{target}"),
+    ("Vary", "Accept-Encoding"),
+]
+
+
+def main(argv=None):
+    import argparse
+    import timeit
+
+    from flask import Flask, Response
+
+    from .post_request import ResponseRewriter
+    from .prior_request import RequestRewriter
+    from .request_context import RequestContext
+    from .shares import Shares, conf
+
+    parser = argparse.ArgumentParser(description="Measure the per-request cost of the header pipeline")
+    parser.add_argument("--number", type=int, default=20000, help="number of iterations")
+    args = parser.parse_args(argv)
+
+    G = Shares()
+    # 只测量头的处理, 不包括调试日志
+    G.logger.set_print_lower_bound(1)
+    parse = RequestContext("GET")
+    parse.remote_domain = conf.target_domain
+    parse.mime = "text/html"
+    parse.content_type = "text/html; charset=GBK"
+    fmt = {"my_host": conf.my_host_name_with_port, "target": conf.target_domain}
+    request_headers = [(name, value.format(**fmt)) for name, value in _SAMPLE_REQUEST_HEADERS]
+    response_headers = [(name, value.format(**fmt)) for name, value in _SAMPLE_RESPONSE_HEADERS]
+
+    req_rewriter = RequestRewriter(parse, G)
+    resp_rewriter = ResponseRewriter(parse, G)
+    with Flask(__name__).test_request_context("/", headers=request_headers):
+        request_cost = timeit.timeit(req_rewriter.extract_client_header, number=args.number) / args.number
+        response_cost = timeit.timeit(
+            lambda: resp_rewriter.copy_response_headers(Response(), response_headers), number=args.number
+        ) / args.number
+        # 减去创建 Response 对象本身的开销
+        response_cost -= timeit.timeit(Response, number=args.number) / args.number
+
+    print("request headers:  %d, %.2f us per request" % (len(request_headers), request_cost * 1e6))
+    print("response headers: %d, %.2f us per request" % (len(response_headers), response_cost * 1e6))
+
+
+if __name__ == "__main__":
+    main()
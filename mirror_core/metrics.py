@@ -0,0 +1,237 @@
+# coding=utf-8
+"""
+本模块为支持 `metrics_enable` 选项而存在
+收集请求处理各个阶段的耗时(直方图)和一些计数器, 并以 Prometheus 的文本格式输出, 见 render()
+
+各阶段(stage)的名称:
+    url_decode        解析镜像url, 生成远程url
+    header_extract    筛选/重写浏览器的请求头
+    cache_lookup      查找本地缓存
+    upstream_connect  与远程服务器建立连接(包括TLS握手), 复用连接时没有这一阶段
+    upstream_ttfb     发出请求到收到远程响应头
+    upstream_body     读取远程响应体 (非stream模式)
+    rewrite           重写响应文本中的url
+    cookie_rewrite    重写 Set-Cookie
+    compress          压缩重写后的文本
+    cache_store       写入本地缓存
+    stream            stream模式下, 从开始到传输完成
+    total             整个请求(stream模式下不包括传输响应体的时间)
+
+用法:
+    with metrics.stage("rewrite", self.parse.time):
+        ...
+    耗时会记录到直方图中, 同时写入 parse.time["rewrite"]
+"""
+import threading
+from bisect import bisect_left
+from time import time
+
+from . import stream_control
+
+try:
+    from typing import Dict, List, Tuple, Union
+except:  # pragma: no cover
+    pass
+
+# 为False时只会写入 parse.time, 不会记录到直方图和计数器中
+enabled = True
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    parts = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+             for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}  # type: Dict[tuple, float]
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.append("%s%s %s" % (self.name, _format_labels(self.labelnames, labelvalues), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labelvalues -> [每个桶的计数(不累加, 最后一个是+Inf), 总和, 总数]
+        self._values = {}  # type: Dict[tuple, list]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        if not enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(labelvalues)
+            if item is None:
+                item = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            item[0][index] += 1
+            item[1] += value
+            item[2] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        for labelvalues, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, 'le="%s"' % bound)
+                lines.append("%s_bucket%s %d" % (self.name, labels, cumulative))
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append("%s_sum%s %.6f" % (self.name, labels, total))
+            lines.append("%s_count%s %d" % (self.name, labels, count))
+        return lines
+
+
+stage_seconds = Histogram(
+    "zmirror_stage_duration_seconds", "Time spent in each stage of request handling", ("stage",)
+)
+requests_total = Counter("zmirror_requests_total", "Responses sent, by status code", ("status",))
+cache_lookups_total = Counter(
+    "zmirror_cache_lookups_total", "Local cache lookups, by result (hit, miss, stale, not_modified, range_hit, segment_hit)",
+    ("result",),
+)
+errors_total = Counter(
+    "zmirror_errors_total", "Failed requests, by remote host and kind (circuit_open, timeout, connection, internal)",
+    ("host", "kind"),
+)
+stream_bytes_total = Counter(
+    "zmirror_stream_bytes_total", "Bytes transferred by streamed responses", ("direction",)
+)
+streams_total = Counter("zmirror_streams_total", "Finished streamed responses, by final state", ("state",))
+
+_metrics = [stage_seconds, requests_total, cache_lookups_total, errors_total, stream_bytes_total, streams_total]
+
+
+class stage:
+    """
+    记录一个阶段的耗时的上下文管理器
+    :param name: 阶段名称, 见模块说明
+    :param time_dict: 耗时同时写入这个dict (通常是 parse.time), 多次进入同一阶段时累加
+    """
+
+    __slots__ = ("name", "time_dict", "start")
+
+    def __init__(self, name, time_dict=None):
+        self.name = name
+        self.time_dict = time_dict
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        observe_stage(self.name, time() - self.start, self.time_dict)
+        return False
+
+
+def observe_stage(name, seconds, time_dict=None):
+    """
+    直接记录一个阶段的耗时
+    :type name: str
+    :type seconds: float
+    :type time_dict: Union[dict, None]
+    """
+    if time_dict is not None:
+        time_dict[name] = time_dict.get(name, 0.0) + seconds
+    stage_seconds.observe(seconds, name)
+
+
+def observe_stream(stats):
+    """
+    stream结束时调用, 记录stream阶段的耗时和传输的字节数
+    :type stats: stream_control.StreamStats
+    """
+    if stats.state == "done":
+        stage_seconds.observe(stats.finished - stats.started, "stream")
+    streams_total.inc(stats.state)
+    stream_bytes_total.inc("in", amount=stats.bytes_in)
+    stream_bytes_total.inc("out", amount=stats.bytes_out)
+
+
+_connect_timer_installed = False
+
+
+def install_connect_timer():
+    """
+    记录 urllib3 建立新连接(包括TLS握手)的耗时, 即 upstream_connect 阶段
+    通过包装 urllib3 的 HTTPConnection.connect 和 HTTPSConnection.connect 实现
+    """
+    global _connect_timer_installed
+    if _connect_timer_installed:
+        return
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+
+    def wrap(original):
+        def connect(self):
+            _start_time = time()
+            try:
+                return original(self)
+            finally:
+                stage_seconds.observe(time() - _start_time, "upstream_connect")
+
+        return connect
+
+    # HTTPSConnection.connect 不会调用 HTTPConnection.connect, 不会重复记录
+    for cls in (HTTPConnection, HTTPSConnection):
+        cls.connect = wrap(cls.connect)
+    _connect_timer_installed = True
+
+
+def render():
+    """
+    以 Prometheus 的文本格式输出所有指标
+    :rtype: str
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    # 当前状态(gauge)
+    # 每个stream的详细统计只在json格式中输出, 这里只需要数量
+    executor_stats = stream_control.executor.stats()
+    values = [
+        ("zmirror_streams_active", "gauge", "Streamed responses in progress", stream_control.active_stream_count()),
+        ("zmirror_stream_executor_workers", "gauge", "Stream preload threads", executor_stats["workers"]),
+        ("zmirror_stream_executor_active", "gauge", "Streams being preloaded", executor_stats["active"]),
+        ("zmirror_stream_executor_queued", "gauge", "Streams waiting for a preload thread", executor_stats["queued"]),
+        ("zmirror_stream_executor_rejected_total", "counter",
+         "Streams sent without preload because the pool was full", executor_stats["rejected"]),
+    ]
+    for name, metric_type, documentation, value in values:
+        lines.append("# HELP %s %s" % (name, documentation))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        lines.append("%s %s" % (name, value))
+    # 预读任务从提交到开始执行的时间 (线程启动/唤醒的时间)
+    name = "zmirror_stream_executor_wait_seconds"
+    lines.append("# HELP %s Time from submitting a stream preload to its start" % name)
+    lines.append("# TYPE %s summary" % name)
+    lines.append("%s_sum %s" % (name, round(executor_stats["wait_seconds"], 6)))
+    lines.append("%s_count %s" % (name, executor_stats["started"]))
+    return "\n".join(lines) + "\n"
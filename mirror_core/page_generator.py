@@ -2,14 +2,14 @@ import traceback
 
 from flask import make_response, request
 
-from . import CONSTS
+from . import CONSTS, errors
 from utils.util import *
-from .shares import logger
-from .threadlocal import ZmirrorThreadLocal
+from .shares import conf, logger
+from .request_context import RequestContext
 
 
 class PageGenerator:
-    def __init__(self, parse: ZmirrorThreadLocal) -> None:
+    def __init__(self, parse: RequestContext) -> None:
         self.parse = parse
 
     def generate_simple_page(self, content, code=200, content_type="text/html"):
@@ -23,10 +23,29 @@ class PageGenerator:
             content = content.encode()
         return make_response(content, code, {"Content-Type": content_type})
 
+    def generate_upstream_error_page(self, errormsg, error_code=502, retry_after=None):
+        """
+        远程服务器不可用(超时/连接失败/熔断)时的轻量错误页面, 内容是预先生成的,
+        不会打印traceback, 也不会dump快照, 避免在远程服务器故障时给本机带来额外的负担
+
+        :type errormsg: str
+        :type error_code: int
+        :param retry_after: 建议浏览器重试的等待时间(秒), 会被写入 Retry-After 头
+        :type retry_after: Union[int, None]
+        :rtype: Response
+        """
+        resp = self.generate_simple_page(errors.get_simple_error_body(error_code, errormsg), error_code)
+        if retry_after is not None:
+            resp.headers["Retry-After"] = str(retry_after)
+        return resp
+
     def generate_error_page(
         self, errormsg="Unknown Error", error_code=500, is_traceback=False, content_only=False
     ):
         """
+        内部错误的页面
+        traceback 的输出和快照dump受到 errors.snapshot_limiter 的频率限制, 超出时只输出一行错误日志
+        只有 `error_page_show_detail` 开启时才会生成包含详细信息的页面, 否则使用预先生成的简单页面
 
         :type content_only: bool
         :type errormsg: Union(str, bytes)
@@ -34,14 +53,25 @@ class PageGenerator:
         :type is_traceback: bool
         :rtype: Union[Response, str]
         """
-        if is_traceback:
-            traceback.print_exc()
-            logger.error(errormsg)
-
         if isinstance(errormsg, bytes):
             errormsg = errormsg.decode()
 
-        dump_file_path = dump_zmirror_snapshot(self.parse, request, msg=errormsg)
+        dump_file_path = None
+        if errors.snapshot_limiter.allow():
+            if is_traceback:
+                logger.error(errormsg, "\n" + traceback.format_exc())
+            else:
+                logger.error(errormsg)
+            if conf.error_snapshot_enable:
+                dump_file_path = dump_zmirror_snapshot(self.parse, request, msg=errormsg)
+        else:
+            logger.error(errormsg, "(traceback suppressed, total: %d)" % errors.snapshot_limiter.suppressed)
+
+        if not conf.error_page_show_detail:
+            body = errors.get_simple_error_body(error_code, "Internal error, please contact the site admin")
+            if content_only:
+                return body.decode()
+            return self.generate_simple_page(body, error_code)
 
         request_detail = ""
         for attrib in filter(lambda x: x[0] != "_" and x[-2:] != "__", dir(self.parse)):
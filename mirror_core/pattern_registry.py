@@ -0,0 +1,145 @@
+# coding=utf-8
+"""
+带版本号的正则注册表, 即 Shares.re_patterns
+
+读取(每个请求, 每次匹配)只是一次dict查找, 不加锁:
+    所有的正则保存在一个dict中, 这个dict创建后不再修改, 重新编译后整体替换为一个新的dict(原子操作),
+    正在使用旧正则的请求不受影响, 之后的读取就会得到新的正则
+
+重新编译(比如自动白名单加入了新的顶级域名, 见 Shares.try_auto_add_domain())在后台线程中进行, 请求不需要等待:
+    1. rebuild() 只登记需要重新编译的正则及其参数, 同一个正则的多次登记会被合并, 只编译最后一次的
+    2. 后台线程在第一次登记后等待 REBUILD_DELAY 秒, 把这段时间内的登记一起编译, 然后替换, 版本号加一
+    3. 编译耗时的预算: 编译所用的时间最多占 `pattern_rebuild_budget` 比例的时间,
+        比如预算为 0.05 时, 一次耗时 20ms 的编译之后, 至少 400ms 内不会开始下一次编译, 期间的登记会被合并
+"""
+import threading
+import traceback
+from time import perf_counter, sleep, time
+
+try:
+    from typing import Callable, Dict, Tuple
+    import re
+except:  # pragma: no cover
+    pass
+
+# 第一次登记后等待的时间, 秒, 用于合并短时间内的多次登记
+REBUILD_DELAY = 0.2
+
+
+class PatternRegistry:
+    def __init__(self, patterns, budget=0.05, on_rebuilt=None):
+        """
+        :param patterns: 初始的正则, 在启动时同步编译好
+        :type patterns: Dict[str, re.Pattern]
+        :param budget: 编译耗时的预算, 即编译所用时间的最大比例, 见模块说明
+        :type budget: float
+        :param on_rebuilt: 每次替换后在后台线程中调用 on_rebuilt(版本号, {名称: 编译耗时(秒)})
+        :type on_rebuilt: Callable[[int, Dict[str, float]], None]
+        """
+        self._patterns = dict(patterns)  # type: Dict[str, re.Pattern]
+        self.version = 1
+        self._current = (self.version, self._patterns)  # type: Tuple[int, Dict[str, re.Pattern]]
+        self.budget = budget
+        self.on_rebuilt = on_rebuilt
+        self.total_compile_time = 0.0
+        self._pending = {}  # type: Dict[str, Tuple[Callable, tuple]]
+        self._not_before = 0.0
+        self._cond = threading.Condition()
+        self._building = False
+        self._thread = None  # type: threading.Thread
+
+    def __getitem__(self, name):
+        """
+        :type name: str
+        :rtype: re.Pattern
+        """
+        return self._patterns[name]
+
+    def __contains__(self, name):
+        return name in self._patterns
+
+    def get(self, name, default=None):
+        return self._patterns.get(name, default)
+
+    def keys(self):
+        return self._patterns.keys()
+
+    def items(self):
+        return self._patterns.items()
+
+    def snapshot(self):
+        """
+        同一个版本的所有正则, 需要同时使用多个正则并且要求它们一致时使用
+        :rtype: Tuple[int, Dict[str, re.Pattern]]
+        """
+        return self._current
+
+    def rebuild(self, name, builder, *args):
+        """
+        登记一个需要在后台重新编译的正则, 立即返回
+        :param name: 正则的名称, 如 "basic_url"
+        :type name: str
+        :param builder: builder(*args) 返回编译好的正则
+        :type builder: Callable[..., re.Pattern]
+        """
+        with self._cond:
+            self._pending[name] = (builder, args)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._rebuild_loop, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def wait_idle(self, timeout=None):
+        """
+        等待所有登记的重新编译完成
+        :type timeout: float
+        :return: 是否已完成
+        :rtype: bool
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._building, timeout)
+
+    def _rebuild_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+            # 合并短时间内的多次登记, 并且遵守编译耗时的预算
+            sleep(max(REBUILD_DELAY, self._not_before - time()))
+            with self._cond:
+                pending, self._pending = self._pending, {}
+                self._building = True
+            try:
+                self._build(pending)
+            finally:
+                with self._cond:
+                    self._building = False
+                    self._cond.notify_all()
+
+    def _build(self, pending):
+        """
+        :type pending: Dict[str, Tuple[Callable, tuple]]
+        """
+        new_patterns = dict(self._patterns)
+        costs = {}  # type: Dict[str, float]
+        for name, (builder, args) in pending.items():
+            start = perf_counter()
+            try:
+                new_patterns[name] = builder(*args)
+            except Exception:  # coverage: exclude
+                # 编译失败时继续使用旧的正则
+                traceback.print_exc()
+                continue
+            finally:
+                costs[name] = perf_counter() - start
+        cost = sum(costs.values())
+        self.total_compile_time += cost
+        if self.budget > 0:
+            self._not_before = time() + cost / self.budget
+
+        # 整体替换, 读取方要么看到全部旧的正则, 要么看到全部新的正则
+        version = self.version + 1
+        self._patterns = new_patterns
+        self._current = (version, new_patterns)
+        self.version = version
+        if self.on_rebuilt is not None:
+            self.on_rebuilt(version, costs)
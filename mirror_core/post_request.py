@@ -1,23 +1,42 @@
+import copy
 import queue
-import threading
-from collections import Counter
-from time import process_time, time
-from urllib.parse import urljoin, urlsplit
+from time import thread_time, time
+from urllib.parse import urljoin
 
 from flask import Response, request
-from requests import Response as requests_Response
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import parse_content_range_header, parse_range_header
+from werkzeug.wsgi import wrap_file
 
 from utils.util import *
 
+from . import content_codec, header_pipeline, metrics, stream_control
 from .CONSTS import __VERSION__ as pkg_version
+from .cache_system import CacheContentWriter, iter_file_range
 from .shares import Shares, conf, logger
-from .threadlocal import ZmirrorThreadLocal
+from .stream_control import AdaptiveChunkSize, StreamBuffer
+from .request_context import RequestContext
+from .url_mapping import split_url
+
+
+def is_vary_cacheable(vary):
+    """
+    远程响应的 Vary 头是否允许以 url 为key缓存, 我们只会按 Accept-Encoding 区分缓存
+    :type vary: Union[str, None]
+    :rtype: bool
+    """
+    if not vary:
+        return True
+    return all(token.strip().lower() in ("accept-encoding", "") for token in vary.split(","))
 
 
 class ResponseRewriter:
-    def __init__(self, parse: ZmirrorThreadLocal, shares: Shares) -> None:
+    def __init__(self, parse: RequestContext, shares: Shares) -> None:
         self.parse = parse
         self.G = shares
+        # stream传输的收尾函数, 由 generate_our_response() 注册到响应的 call_on_close(), 见 make_stream_closer()
+        #   注册之前出错时, 由 finish_pending_transfers() 调用
+        self.stream_closer = None  # type: Union[Callable[[bool], None], None]
 
     def parse_remote_response(self):
         """
@@ -26,6 +45,9 @@ class ResponseRewriter:
             2. 判断是否以stream(流)式传输响应内容
             3. 提取cache control header, 判断是否允许缓存
         """
+        # 响应体默认不压缩, 在读取/重写响应体时再确定
+        self.parse.content_encoding = ""
+
         # extract response's mime to thread local var
         self.parse.content_type = self.parse.remote_response.headers.get("Content-Type", "")
         self.parse.mime = extract_mime_from_content_type(self.parse.content_type)
@@ -39,15 +61,7 @@ class ResponseRewriter:
 
         # extract cache control header, if not cache, we should disable local cache
         self.parse.cache_control = self.parse.remote_response.headers.get("Cache-Control", "")
-        # 判断响应是否允许缓存. 使用相当保守的缓存策略
-        self.parse.cacheable = (
-            "no-store" not in self.parse.cache_control
-            and "must-revalidate" not in self.parse.cache_control
-            and "max-age=0" not in self.parse.cache_control
-            and "private" not in self.parse.cache_control
-            and self.parse.remote_response.request.method == "GET"
-            and self.parse.remote_response.status_code == 200
-        )
+        self.parse.cacheable = self.is_remote_response_cacheable()
 
         logger.debug(
             "Response Content-Type:",
@@ -61,6 +75,27 @@ class ResponseRewriter:
             v=4,
         )
 
+    def is_remote_response_cacheable(self, status_code=200):
+        """
+        判断响应是否允许缓存. 使用相当保守的缓存策略
+            缓存的key只包含url(和压缩编码), 所以因人而异的响应不能缓存:
+            带有 Set-Cookie 的响应, 以及 Vary 中含有 Accept-Encoding 以外的头的响应
+        :param status_code: 允许缓存的状态码, 完整的响应为200, Range请求的分段为206
+        :type status_code: int
+        :rtype: bool
+        """
+        remote_headers = self.parse.remote_response.headers
+        return (
+            "no-store" not in self.parse.cache_control
+            and "must-revalidate" not in self.parse.cache_control
+            and "max-age=0" not in self.parse.cache_control
+            and "private" not in self.parse.cache_control
+            and self.parse.remote_response.request.method == "GET"
+            and self.parse.remote_response.status_code == status_code
+            and "Set-Cookie" not in remote_headers
+            and is_vary_cacheable(remote_headers.get("Vary"))
+        )
+
     def rewrite_remote_to_mirror_url(self, remote_resp):
         """
         将远程服务器响应文本中的url重写为镜像站的url
@@ -79,7 +114,7 @@ class ResponseRewriter:
 
             _my_host_name = conf.my_host_name
 
-            if remote_domain in conf.target_domain_alias:
+            if not domain_index.is_external(remote_domain):
                 # 主域名
                 core = _my_host_name + suffix_slash
             else:
@@ -94,6 +129,7 @@ class ResponseRewriter:
                 else:  # //target.domain
                     return slash * 2 + core
 
+        domain_index = self.G.domain_index
         return self.G.re_patterns["basic_url"].sub(to_mirror_url, remote_resp)
 
     def regex_url_reassemble(self, match_obj: re.Match):
@@ -154,19 +190,23 @@ class ResponseRewriter:
         if not scheme and ("javascript" in self.parse.mime or '"' in prefix):
             return whole_match_string
 
-        # # v0.19.0+ Automatic Domains Whitelist (Experimental)
-        # if conf.automatic_domains_whitelist_enable:
-        #     self(match_domain) todo
-
         # logger.debug(match_obj.groups(), v=5)
 
         domain = match_domain or self.parse.remote_domain
         # logger.debug('rewrite match_obj:', match_obj, 'domain:', domain, v=5)
 
         # skip if the domain are not in our proxy list
-        if domain not in conf.allowed_domains:
-            # logger.debug('return untouched because domain not match', domain, whole_match_string, v=5)
-            return whole_match_string  # return raw, do not change
+        domain_info = self.G.domain_index.get(domain)
+        if domain_info is None:
+            # v0.19.0+ Automatic Domains Whitelist (Experimental)
+            #   匹配 `domains_whitelist_auto_add_glob_list` 的域名会被加入白名单, 然后正常重写
+            if match_domain and conf.automatic_domains_whitelist_enable:
+                domain = match_domain.lower()
+                if self.G.try_auto_add_domain(domain):
+                    domain_info = self.G.domain_index.get(domain)
+            if domain_info is None:
+                # logger.debug('return untouched because domain not match', domain, whole_match_string, v=5)
+                return whole_match_string  # return raw, do not change
 
         # this resource's absolute url path to the domain root.
         # logger.debug('match path', path, "remote path", self.parse.remote_path, v=5)
@@ -176,9 +216,8 @@ class ResponseRewriter:
             # 当整合后的path不以 / 开头时, 如果当前是主域名, 则不处理, 如果是外部域名则加上 / 前缀
             path = "/" + path
 
-        if domain in conf.external_domains:
-            url_no_scheme = urljoin(domain, path)
-            path = "/extdomains/" + url_no_scheme
+        # 外部域名: /extdomains/域名/path
+        path = domain_info.mirror_prefix + path
 
         if not scheme:
             scheme_domain = ""
@@ -247,25 +286,37 @@ class ResponseRewriter:
         """
 
         _start_time = time()
-        _content = self.parse.remote_response.content
-        req_time_body = time() - _start_time
 
-        if not is_mime_represents_text(self.parse.mime, conf.text_like_mime_types):
-            # simply don't touch binary response content
-            logger.debug("Binary", self.parse.content_type)
+        if not is_mime_represents_text(
+            self.parse.mime, conf.text_like_mime_types
+        ) or not content_codec.get_decoder(self.get_remote_content_encoding()):
+            # simply don't touch binary response content,
+            #   and pass it through in its original (maybe compressed) form, no decompress/recompress
+            _content = b"".join(self.iter_remote_content(conf.stream_buffer_size))
+            req_time_body = time() - _start_time
+            metrics.observe_stage("upstream_body", req_time_body)
+            logger.debug("Binary", self.parse.content_type, self.parse.content_encoding)
             return _content, req_time_body
 
+        # 文本需要解压后才能重写, 使用我们自己的增量解压(支持 br 和 zstd)
+        _content = b"".join(self.iter_remote_content(conf.stream_buffer_size, decode=True))
+        # 让 requests 的 .text 等属性可以继续使用
+        self.parse.remote_response._content = _content
+        self.parse.remote_response._content_consumed = True
+        req_time_body = time() - _start_time
+        metrics.observe_stage("upstream_body", req_time_body)
+
         # Do text rewrite if remote response is text-like (html, css, js, xml, etc..)
-        logger.debug(
-            "Text-like", self.parse.content_type, self.parse.remote_response.text[:15], _content[:15]
+        # 自己进行编码检测, 整个响应只解码一次, 同一个域名的同一种MIME的编码会被记住, 见 charset_detect
+        resp_text, encoding = self.G.charset_detector.decode(
+            _content, self.parse.content_type, cache_key=(self.parse.remote_domain, self.parse.mime)
         )
-        # 自己进行编码检测, 因为 requests 内置的编码检测在天朝GBK面前非常弱鸡
-        encoding = self.G.encoding_detect(self.parse.remote_response.content)
         if encoding is not None:
             self.parse.remote_response.encoding = encoding
-
-        # simply copy the raw text, for custom rewriter function first.
-        resp_text = self.parse.remote_response.text
+        else:
+            # 无法确定编码, 交给 requests 检测
+            resp_text = self.parse.remote_response.text
+        logger.debug("Text-like", self.parse.content_type, encoding, resp_text[:15], _content[:15])
 
         if conf.developer_string_trace is not None and conf.developer_string_trace in resp_text:
             # debug用代码, 对正常运行无任何作用
@@ -293,7 +344,8 @@ class ResponseRewriter:
                 )
 
         # then do the normal rewrites
-        resp_text = self.response_text_rewrite(resp_text)
+        with metrics.stage("rewrite", self.parse.time):
+            resp_text = self.response_text_rewrite(resp_text)
 
         if conf.developer_string_trace is not None and conf.developer_string_trace in resp_text:
             # debug用代码, 对正常运行无任何作用
@@ -314,199 +366,726 @@ class ResponseRewriter:
 
         return resp_text.encode(encoding="utf-8"), req_time_body  # return bytes
 
-    def response_cookies_deep_copy(self):
+    def get_remote_content_encoding(self):
         """
-        It's a BAD hack to get RAW cookies headers, but so far, we don't have better way.
-        We'd go DEEP inside the urllib's private method to get raw headers
-
-        raw_headers example:
-        [('Cache-Control', 'private'),
-        ('Content-Length', '48234'),
-        ('Content-Type', 'text/html; Charset=utf-8'),
-        ('Server', 'Microsoft-IIS/8.5'),
-        ('Set-Cookie','BoardList=BoardID=Show; expires=Mon, 02-May-2016 16:00:00 GMT; path=/'),
-        ('Set-Cookie','aspsky=abcefgh; expires=Sun, 24-Apr-2016 16:00:00 GMT; path=/; HttpOnly'),
-        ('Set-Cookie', 'ASPSESSIONIDSCSSDSSQ=OGKMLAHDHBFDJCDMGBOAGOMJ; path=/'),
-        ('X-Powered-By', 'ASP.NET'),
-        ('Date', 'Tue, 26 Apr 2016 12:32:40 GMT')]
+        远程响应的 Content-Encoding, 小写, 未压缩时为空字符串
+        :rtype: str
+        """
+        encoding = self.parse.remote_response.headers.get("Content-Encoding", "").strip().lower()
+        return "" if encoding == "identity" else encoding
 
+    def iter_remote_content(self, chunk_size, decode=False):
         """
-        raw_headers = self.parse.remote_response.raw._original_response.headers._headers
-        header_cookies_string_list = []
-        for name, value in raw_headers:
-            if name.lower() != "set-cookie":
-                continue
+        逐块读取远程响应体, 并设置 parse.content_encoding 为返回内容的编码
+        必须在请求的线程中调用(需要读取浏览器的请求头), 返回的迭代器可以在其他线程中消费
 
-            if conf.my_scheme == "http://":
-                value = value.replace("Secure;", "")
-                value = value.replace(";Secure", ";")
-                value = value.replace("; Secure", ";")
-            if "httponly" in value.lower():
-                continue
-            if conf.aggressive_cookies_rewrite:
-                # 暴力cookie path重写, 把所有path都重写为 /
-                value = self.G.re_patterns["cookie_path"].sub("path=/;", value)
-            elif conf.aggressive_cookies_rewrite is not None:
-                # 重写HttpOnly Cookies的path到当前url下
-                # eg(/extdomains/a.foobar.com): path=/verify; -> path=/extdomains/a.foobar.com/verify
-
-                if self.parse.remote_domain not in conf.target_domain_alias:  # do not rewrite main domains
-                    value = self.G.re_patterns["cookie_path"].sub(
-                        "\g<prefix>=/extdomains/" + self.parse.remote_domain + "\g<path>", value
-                    )
+        decode=False 时, 如果浏览器能接受远程服务器使用的压缩编码, 则原样透传, 否则增量解压
+        decode=True 时, 总是增量解压 (用于文本重写)
+        不支持的压缩编码总是原样透传
 
-            header_cookies_string_list.append(value)
+        :param chunk_size: 每次读取的大小, 也可以是一个 AdaptiveChunkSize, 此时每次读取的大小会动态变化
+        :type chunk_size: Union[int, AdaptiveChunkSize]
+        :type decode: bool
+        :rtype: Iterator[bytes]
+        """
+        remote_encoding = self.get_remote_content_encoding()
+        if isinstance(chunk_size, AdaptiveChunkSize):
+            chunks = stream_control.iter_raw_chunks(self.parse.remote_response.raw, chunk_size)
+        else:
+            chunks = self.parse.remote_response.raw.stream(chunk_size, decode_content=False)
+        if not self.need_decode_remote_content(decode):
+            self.parse.content_encoding = remote_encoding
+            return chunks
 
-        return header_cookies_string_list
+        self.parse.content_encoding = ""
+        return content_codec.iter_decompress(chunks, remote_encoding)
 
-    def response_cookie_rewrite(self, cookie_string):
+    def need_decode_remote_content(self, decode=False):
         """
-        rewrite response cookie string's domain to `my_host_name`
-        :type cookie_string: str
+        远程响应体是否需要解压, 规则见 iter_remote_content()
+        :type decode: bool
+        :rtype: bool
         """
-        cookie_string = self.G.re_patterns["cookie"].sub(
-            "domain=" + conf.my_host_name_with_port, cookie_string
-        )
-        return cookie_string
+        remote_encoding = self.get_remote_content_encoding()
+        if content_codec.get_decoder(remote_encoding) is None:
+            return False
+        if decode:
+            return True
+        return not content_codec.is_acceptable(remote_encoding, request.headers.get("Accept-Encoding", ""))
+
+    def compress_text_content(self, content):
+        """
+        对重写后的文本响应, 按照浏览器的 Accept-Encoding 选择最合适的编码(br zstd gzip)进行一次压缩
+        压缩后的结果会被缓存, 不会重复压缩
+        :type content: bytes
+        :rtype: bytes
+        """
+        if conf.response_compress_level and len(content) >= conf.response_compress_min_size:
+            encoding = content_codec.negotiate(request.headers.get("Accept-Encoding", ""))
+            if encoding:
+                self.parse.content_encoding = encoding
+                return content_codec.compress(content, encoding, conf.response_compress_level)
+        return content
+
+    def response_cookies_rewrite(self, raw_cookies):
+        """
+        rewrite response cookies' domain to `my_host_name`, and the path/Secure attributes, see cookie_rewrite
+        :param raw_cookies: 远程响应中原始的 Set-Cookie 值, 见 header_pipeline.iter_raw_response_headers()
+        :type raw_cookies: List[str]
+        :rtype: List[str]
+        """
+        # do not rewrite main domains' path
+        path_prefix = "/extdomains/" + self.parse.remote_domain if self.parse.is_external_domain else ""
+        return self.G.cookie_rewriter.rewrite_all(raw_cookies, path_prefix)
 
     def encode_mirror_url(
         self, remote_url: str, remote_domain: str = None, has_scheme: bool = True, escaped: bool = False
     ) -> str:
-        if escaped:
-            unesc_remote_url = un_esc_str(remote_url)
-        else:
-            unesc_remote_url = remote_url
-        splited = urlsplit(unesc_remote_url)
-
-        if "/extdomains/" == splited.path[:12]:
-            return remote_url
+        """
+        把远程url转换为镜像url, 解析和缓存见 url_mapping.UrlMapper
+        url中没有域名时, 使用当前请求的远程域名
+        """
+        return self.G.url_mapper.encode(remote_url, remote_domain, self.parse.remote_domain, has_scheme, escaped)
 
-        domain = remote_domain or splited.netloc or self.parse.remote_domain or conf.target_domain
-        if domain not in conf.allowed_domains:
-            return remote_url
+    def _preload_streamed_response_content_async(self, content_iter, stream_buffer, sizer, stats, remote_response):
+        """
+        stream模式下, 预读远程响应的content, 放入 stream_buffer
+        缓冲区满时阻塞, 不再从远程读取(背压)
+        浏览器断开, 或者超过 `stream_client_stall_timeout` 秒没有读取时, 立即关闭远程连接, 不再继续读取
+        :param content_iter: 远程响应体的迭代器, 见 iter_remote_content(), 每次读取的大小由 sizer 决定
+        :type content_iter: Iterator[bytes]
+        :type stream_buffer: StreamBuffer
+        :type sizer: AdaptiveChunkSize
+        :type stats: StreamStats
+        :type remote_response: requests.Response
+        """
+        try:
+            while True:
+                particle_content = next(content_iter, None)
+                if particle_content is None:
+                    stream_buffer.put_eof()
+                    return
+                stats.bytes_in += len(particle_content)
+
+                if not stream_buffer.put(particle_content, timeout=conf.stream_client_stall_timeout):
+                    if not stream_buffer.closed:
+                        stats.finish("client-stalled")
+                        stream_buffer.put_error(TimeoutError("Client stalled"))
+                    break
+                if stream_buffer.last_put_waited:
+                    stats.stalls += 1
+                stats.chunk_size = sizer.update(len(particle_content))
+        except Exception as e:  # coverage: exclude
+            stream_buffer.put_error(e)
+            return
+
+        # 浏览器已经不再读取, 释放远程连接
+        remote_response.close()
+
+    def get_cache_key(self, url, content_encoding=""):
+        """
+        本地缓存的key, 同一个url的不同压缩形式会被分别缓存
+        :type url: str
+        :type content_encoding: str
+        :rtype: str
+        """
+        if not content_encoding:
+            return url
+        return url + "|" + content_encoding
 
-        if has_scheme:
-            if "//" == unesc_remote_url[:2]:
-                scheme_host = "//" + conf.my_host_name
-            elif splited.scheme:
-                scheme_host = conf.my_scheme_and_host
-            else:
-                scheme_host = ""
-        else:
-            scheme_host = ""
+    def get_cache_encodings(self):
+        """
+        浏览器可以接受的, 可能存在于缓存中的压缩编码, 按优先顺序排列
+        :rtype: List[str]
+        """
+        return content_codec.acceptable_encodings(
+            request.headers.get("Accept-Encoding", ""), content_codec.PREFERRED_ENCODINGS + ("deflate",)
+        )
 
-        if self.G.is_external_domain(domain):
-            middle_part = "/extdomains/" + domain
-        else:
-            middle_part = ""
+    def load_cached_response(self, key):
+        """
+        从本地缓存中读取一个完整的响应, 没有完整内容(stream模式下只有头部)时返回None
+        :type key: str
+        :rtype: Union[Response, None]
+        """
+        info_dict = self.G.cache.get_info(key)
+        if info_dict is None or info_dict.get("without_content", True):
+            return None
+
+        resp = self.G.cache.get_obj(key)
+        if resp is None:
+            return None
+
+        content_path = self.G.cache.get_content_path(key)
+        if content_path is not None:
+            # stream模式缓存的内容以原始二进制存放在单独的文件中, 直接交给WSGI服务器发送
+            #   支持 wsgi.file_wrapper 的服务器(例如gunicorn)会使用 os.sendfile, 内容不经过python
+            try:
+                content_file = open(content_path, "rb")
+            except OSError:
+                return None
+            resp.response = wrap_file(request.environ, content_file, conf.stream_relay_buffer_size)
+            resp.direct_passthrough = True
+            resp.headers["Content-Length"] = str(os.fstat(content_file.fileno()).st_size)
+
+        resp.headers["X-Cache"] = "FileHit"
+        return resp
 
-        path_and_query = self.G.extract_path_and_query(unesc_remote_url)
+    def try_get_cached_response(self):
+        """
+        尝试从本地缓存中取出当前请求的响应, 会根据浏览器的 Accept-Encoding 选择合适的压缩形式
+        如果浏览器的 If-Modified-Since 与缓存一致, 则返回304
+        Range请求见 try_get_cached_range_response()
+        :return: 缓存的响应, 未命中时返回None
+        :rtype: Union[Response, None]
+        """
+        if not conf.local_cache_enable or request.method != "GET":
+            self.set_cache_result("bypass")
+            return None
+
+        if "Range" in request.headers:
+            return self.try_get_cached_range_response()
+
+        stale = False
+        for encoding in self.get_cache_encodings():
+            key = self.get_cache_key(self.parse.remote_url, encoding)
+            stale = stale or self.G.cache.is_stale(key)
+            info_dict = self.G.cache.get_info(key)
+            if info_dict is None or info_dict.get("without_content", True):
+                # 还没有完整内容的缓存(stream模式下只有头部), 不可用
+                continue
 
-        mirror_url = urljoin(scheme_host + middle_part + "/", path_and_query.strip("/"))
-        mirror_url += "#" + splited.fragment if splited.fragment else ""
+            if self.G.cache.is_unchanged(key, request.headers.get("If-Modified-Since")):
+                logger.debug("LocalCache_304", key, v=4)
+                self.set_cache_result("not_modified")
+                return Response(status=304)
+
+            resp = self.load_cached_response(key)
+            if resp is not None:
+                logger.debug("LocalCache_Hit", key, v=4)
+                self.set_cache_result("hit")
+                return resp
+
+        resp = self.build_cached_variant()
+        if resp is not None:
+            self.set_cache_result("hit")
+            return resp
+        self.set_cache_result("stale" if stale else "miss")
+        return None
+
+    def build_cached_variant(self):
+        """
+        缓存中有重写后的文本响应, 但不是浏览器可以接受的压缩编码时,
+            从缓存的版本解压后, 以浏览器需要的编码重新压缩, 并存入缓存
+        每种编码只在第一次被请求时压缩一次, 而不需要再次请求远程服务器和重写, 见 put_response_to_local_cache()
+        :rtype: Union[Response, None]
+        """
+        if not conf.response_compress_level:
+            return None
+        encoding = content_codec.negotiate(request.headers.get("Accept-Encoding", ""))
+        for source_encoding in content_codec.PREFERRED_ENCODINGS + ("",):
+            if source_encoding == encoding:
+                continue
+            source_key = self.get_cache_key(self.parse.remote_url, source_encoding)
+            info_dict = self.G.cache.get_info(source_key)
+            if info_dict is None or not info_dict.get("recompressible"):
+                continue
+            variant = self.G.cache.get_obj(source_key)
+            if variant is None:
+                continue
 
-        if escaped:
-            mirror_url = esc_str(mirror_url)
+            with metrics.stage("compress", self.parse.time):
+                text_content = b"".join(content_codec.iter_decompress([variant.get_data()], source_encoding))
+                variant.set_data(content_codec.compress(text_content, encoding, conf.response_compress_level))
+            if encoding:
+                variant.headers["Content-Encoding"] = encoding
+            else:
+                variant.headers.pop("Content-Encoding", None)
+            key = self.get_cache_key(self.parse.remote_url, encoding)
+            self.G.cache.put_obj(
+                key,
+                variant,
+                expires=int(info_dict["expires_at"] - time()),
+                obj_size=variant.content_length,
+                last_modified=info_dict["last_modified"],
+                info_dict=info_dict,
+            )
+            logger.debug("LocalCache_VariantBuilt", source_key, key, v=4)
+            variant.headers["X-Cache"] = "FileHit"
+            return variant
+        return None
 
-        return mirror_url
+    def set_cache_result(self, result):
+        """
+        记录本地缓存的查找结果, 见 access_log
+        :param result: hit, not_modified, range_hit, segment_hit, miss, stale, bypass
+        :type result: str
+        """
+        self.parse.cache_result = result
+        if result != "bypass":
+            metrics.cache_lookups_total.inc(result)
 
-    def _preload_streamed_response_content_async(
-        self, requests_response: requests_Response, buffer_queue: queue.Queue
-    ):
+    def try_get_cached_range_response(self):
         """
-        stream模式下, 预读远程响应的content
-        :param requests_response_obj:
-        :type buffer_queue: queue.Queue
+        尝试从本地缓存中响应Range请求
+            1. 如果缓存中有完整的响应, 从中截取所请求的范围
+            2. 否则查找能覆盖所请求范围的分段(之前的206响应)
+            3. 都没有时, 如果有正在进行的、覆盖了这一范围的请求, 等待它完成后再次查找分段缓存,
+                否则将本请求登记为正在进行, 见 RangeFetchRegistry
+        只支持单个范围, 并忽略带 If-Range 的请求的分段缓存
+        :rtype: Union[Response, None]
         """
-        for particle_content in requests_response.iter_content(conf.stream_buffer_size):
+        for encoding in self.get_cache_encodings():
+            resp = self.load_cached_response(self.get_cache_key(self.parse.remote_url, encoding))
+            if resp is None:
+                continue
             try:
-                buffer_queue.put(particle_content, timeout=10)
-            except queue.Full:  # coverage: exclude
-                traceback.print_exc()
-                exit()
-            if conf.verbose_level >= 3:
-                logger.debug("BufferSize", buffer_queue.qsize())
-        buffer_queue.put(None, timeout=10)
-        exit()
-
-    def _update_content_in_local_cache(self, url, content, method="GET"):
-        """更新 local_cache 中缓存的资源, 追加content
-        在stream模式中使用"""
-        if conf.local_cache_enable and method == "GET" and self.G.cache.is_cached(url):
-            info_dict = self.G.cache.get_info(url)
-            resp = self.G.cache.get_obj(url)
-            resp.set_data(content)
-
-            # 当存储的资源没有完整的content时, without_content 被设置为true
-            # 此时该缓存不会生效, 只有当content被添加后, 缓存才会实际生效
-            # 在stream模式中, 因为是先接收http头, 然后再接收内容, 所以会出现只有头而没有内容的情况
-            # 此时程序会先将只有头部的响应添加到本地缓存, 在内容实际接收完成后再追加内容
-            info_dict["without_content"] = False
-
-            logger.debug("LocalCache_UpdateCache", url, content[:30], len(content), v=4)
+                resp.make_conditional(request.environ, accept_ranges=True, complete_length=resp.content_length)
+            except RequestedRangeNotSatisfiable as e:
+                resp.close()
+                self.set_cache_result("range_hit")
+                return e.get_response()
+            logger.debug("LocalCache_RangeHit", self.parse.remote_url, resp.headers.get("Content-Range"), v=4)
+            self.set_cache_result("range_hit")
+            return resp
+
+        requested_range = parse_range_header(request.headers.get("Range"))
+        if (
+            requested_range is None
+            or requested_range.units != "bytes"
+            or len(requested_range.ranges) != 1
+            or "If-Range" in request.headers
+        ):
+            self.set_cache_result("miss")
+            return None
+        start, stop = requested_range.ranges[0]
+
+        resp = self.get_cached_segment_response(start, stop)
+        if resp is not None or start < 0 or stop is None or stop - start > self.G.cache.max_stream_size_byte:
+            # 只有有限长度的范围才能合并, 太大的范围也不会被缓存
+            if resp is None:
+                self.set_cache_result("miss")
+            return resp
+
+        event, is_leader = self.G.range_fetches.begin(self.parse.remote_url, start, stop)
+        if is_leader:
+            self.parse.range_fetch = (self.parse.remote_url, event)
+            self.set_cache_result("miss")
+            return None
+
+        logger.debug("RangeCoalesced", self.parse.remote_url, start, stop, v=4)
+        # 只等待一小段时间, 正在进行的请求很慢(比如它的浏览器很慢)时, 直接向远程服务器请求
+        event.wait(conf.range_coalesce_wait_timeout)
+        resp = self.get_cached_segment_response(start, stop)
+        if resp is None:
+            self.set_cache_result("miss")
+        return resp
 
-            self.G.cache.put_obj(
-                url,
-                resp,
-                obj_size=len(content),
-                expires=self.G.get_expire_from_mime(self.parse.mime),
-                last_modified=info_dict.get("last_modified"),
-                info_dict=info_dict,
-            )
+    def get_cached_segment_response(self, start, stop):
+        """
+        从分段缓存中读取所请求的范围, 参数的含义见 FileCache.find_segment()
+        :rtype: Union[Response, None]
+        """
+        for encoding in self.get_cache_encodings():
+            found = self.G.cache.find_segment(self.get_cache_key(self.parse.remote_url, encoding), start, stop)
+            if found is None:
+                continue
+            seg_key, seg_start, seg_stop, range_start, range_stop, complete_length = found
 
-    def iter_streamed_response_async(self):
-        """异步, 一边读取远程响应, 一边发送给用户"""
-        total_size = 0
-        _start_time = time()
+            resp = self.G.cache.get_obj(seg_key)
+            content_path = self.G.cache.get_content_path(seg_key)
+            if resp is None or content_path is None:
+                continue
+            try:
+                content_file = open(content_path, "rb")
+            except OSError:
+                continue
 
-        _content_buffer = b""
-        _disable_cache_temporary = False
+            length = range_stop - range_start
+            content_file.seek(range_start - seg_start)
+            if range_stop == seg_stop:
+                # 一直读到文件末尾, 可以使用 sendfile
+                resp.response = wrap_file(request.environ, content_file, conf.stream_relay_buffer_size)
+                resp.direct_passthrough = True
+            else:
+                resp.response = iter_file_range(content_file, length, conf.stream_relay_buffer_size)
+            resp.headers["Content-Range"] = "bytes %d-%d/%d" % (range_start, range_stop - 1, complete_length)
+            resp.headers["Content-Length"] = str(length)
+            resp.headers["X-Cache"] = "FileHit"
+            logger.debug("LocalCache_SegmentHit", seg_key, range_start, range_stop, v=4)
+            self.set_cache_result("segment_hit")
+            return resp
+        return None
+
+    def get_segment_cache_info(self):
+        """
+        如果远程响应是一个可以缓存的分段(206), 返回 (完整资源的缓存key, start, stop, complete_length), 否则返回None
+        :rtype: Union[Tuple[str, int, int, int], None]
+        """
+        if (
+            not conf.local_cache_enable
+            or not self.is_remote_response_cacheable(206)
+            or self.parse.content_encoding != self.get_remote_content_encoding()
+        ):
+            # 解压后的内容与远程给出的范围对不上
+            return None
+        content_range = parse_content_range_header(self.parse.remote_response.headers.get("Content-Range"))
+        if content_range is None or content_range.units != "bytes" or content_range.length is None:
+            return None
+        if (
+            content_range.stop - content_range.start > self.G.cache.max_stream_size_byte
+            or self.G.get_expire_from_mime(self.parse.mime) <= 0
+        ):
+            return None
+        return (
+            self.get_cache_key(self.parse.remote_url, self.parse.content_encoding),
+            content_range.start,
+            content_range.stop,
+            content_range.length,
+        )
 
-        buffer_queue = queue.Queue(maxsize=conf.stream_transfer_async_preload_max_packages_size)
+    def finish_pending_transfers(self):
+        """
+        请求处理结束时调用, 清理还没有交给WSGI服务器的部分:
+            结束本请求登记的Range请求, 唤醒等待它的请求, 见 try_get_cached_range_response()
+            关闭没能发送出去(生成响应时出错)的stream传输, 见 make_stream_closer()
+        """
+        if self.stream_closer is not None:
+            self.stream_closer(False)
+            self.stream_closer = None
+        if self.parse.range_fetch is not None:
+            self.G.range_fetches.finish(*self.parse.range_fetch)
+            self.parse.range_fetch = None
+
+    def put_response_to_local_cache(self, resp, without_content=False, text_content=None, cache_key=None):
+        """
+        将我们的响应存入本地缓存, 以其发送给浏览器的(压缩)形式存储
+        stream模式下, 先只存入响应头(without_content=True),
+            内容在传输的同时写入临时文件, 完成后附加到缓存条目上, 见 get_cache_writer()
+        对于重写后的文本响应, 其他压缩编码的版本在第一次被请求时才从这个版本生成, 见 build_cached_variant()
+            使用不同 Accept-Encoding 的浏览器都能命中缓存, 而不需要再次请求远程服务器和重写,
+            也不会让每个未命中的请求都同步压缩出所有编码的版本
+        :type resp: Response
+        :type without_content: bool
+        :param text_content: 未压缩的重写后文本, 仅文本响应需要
+        :type text_content: Union[bytes, None]
+        :param cache_key: 指定缓存的key (用于分段), 默认由 get_cache_key() 生成
+        :type cache_key: Union[str, None]
+        """
+        expires = self.G.get_expire_from_mime(self.parse.mime)
+        if expires <= 0 or "Set-Cookie" in resp.headers:
+            # 其他访问者不能得到这个访问者的cookie
+            return
+
+        if without_content:
+            our_resp = copy.copy(resp)
+            our_resp.response = None  # 去掉内容的迭代器, 否则无法序列化
+            obj_size = 0
+        else:
+            our_resp = resp
+            obj_size = resp.content_length or 0
+
+        last_modified = self.parse.remote_response.headers.get("Last-Modified")
+        info_dict = {"without_content": without_content, "last_modified": last_modified}
+        if (
+            text_content is not None
+            and conf.response_compress_level
+            and len(text_content) >= conf.response_compress_min_size
+        ):
+            # 可以从这个版本生成其他压缩编码的版本, 它们与这个版本同时过期
+            info_dict["recompressible"] = True
+            info_dict["expires_at"] = time() + expires
+            resp.headers["Vary"] = "Accept-Encoding"
+
+        self.G.cache.put_obj(
+            cache_key or self.get_cache_key(self.parse.remote_url, self.parse.content_encoding),
+            our_resp,
+            expires=expires,
+            obj_size=obj_size,
+            last_modified=last_modified,
+            info_dict=info_dict,
+        )
 
-        t = threading.Thread(
-            target=self._preload_streamed_response_content_async,
-            args=(self.parse.remote_response, buffer_queue),
-            daemon=True,
+    def iter_streamed_response_async(self):
+        """
+        异步, 一边读取远程响应, 一边发送给用户, 用于需要解压的内容
+        每次从远程读取的块大小根据吞吐量自动调整, 见 AdaptiveChunkSize
+        必须在请求的线程中调用
+        :rtype: Iterator[bytes]
+        """
+        sizer = AdaptiveChunkSize(conf.stream_buffer_size, conf.stream_buffer_max_size)
+        content_iter = self.iter_remote_content(sizer)
+        cache_writer = self.get_cache_writer()
+        self.stream_closer = self.make_stream_closer(self.parse.remote_response, cache_writer)
+        return self._iter_preloaded_content(
+            self.parse.remote_response, content_iter, sizer, cache_writer, self.stream_closer
         )
-        t.start()
 
-        while True:
-            try:
-                particle_content = buffer_queue.get(timeout=15)
-            except queue.Empty:  # coverage: exclude
-                logger.warn("WeGotAnStreamTimeout")
-                traceback.print_exc()
+    def make_stream_closer(self, remote_response, cache_writer, range_fetch=None):
+        """
+        stream传输的收尾函数 close(completed), 只会执行一次:
+            释放(完整读完时)或关闭远程连接, 提交或丢弃缓存的内容, 唤醒等待本请求的重叠Range请求
+        传输结束时由生成器的 finally 调用. 但是浏览器在第一块数据发送之前就断开时, 生成器根本没有开始执行,
+            finally 也不会执行, 所以它同时被注册到响应的 call_on_close(), WSGI服务器一定会调用
+        :type remote_response: requests.Response
+        :type cache_writer: Union[CacheContentWriter, None]
+        :param range_fetch: 本请求登记的Range请求, 见 RangeFetchRegistry
+        :type range_fetch: Union[Tuple[str, threading.Event], None]
+        :rtype: Callable[[bool], None]
+        """
+        closed = []
+
+        def close(completed=False):
+            if closed:
                 return
-            buffer_queue.task_done()
-
-            if particle_content is not None:
-                # 由于stream的特性, content会被消耗掉, 所以需要额外储存起来
-                if conf.local_cache_enable and not _disable_cache_temporary:
-                    if len(_content_buffer) > 8 * 1024 * 1024:  # 8MB
-                        _disable_cache_temporary = True
-                        _content_buffer = None
-                    else:
-                        _content_buffer += particle_content
+            closed.append(True)
+            if completed:
+                # 远程响应已经读完, 连接可以放回连接池
+                remote_response.raw.release_conn()
+            else:
+                # 用户中途断开或远程出错, 关闭连接, 不能放回连接池
+                remote_response.close()
+            self._finish_cache_writer(cache_writer, completed)
+            if range_fetch is not None:
+                self.G.range_fetches.finish(*range_fetch)
+
+        return close
 
+    def get_cache_writer(self):
+        """
+        如果stream模式的响应可以缓存, 返回一个 CacheContentWriter, 边传输边把内容写入缓存, 否则返回None
+        Range请求的分段(206)会被缓存为分段, 见 get_segment_cache_info()
+        必须在请求的线程中, 并且在 parse.content_encoding 确定之后调用
+        :rtype: Union[CacheContentWriter, None]
+        """
+        segment = self.get_segment_cache_info()
+        if segment is not None:
+            return CacheContentWriter(self.G.cache, self.G.cache.get_segment_key(*segment[:3]), segment)
+
+        if (
+            conf.local_cache_enable
+            and self.parse.cacheable
+            and self.G.get_expire_from_mime(self.parse.mime) > 0
+            and int(self.parse.remote_response.headers.get("Content-Length", 0) or 0) <= self.G.cache.max_stream_size_byte
+        ):
+            return CacheContentWriter(
+                self.G.cache, self.get_cache_key(self.parse.remote_url, self.parse.content_encoding)
+            )
+        return None
+
+    def _iter_preloaded_content(self, remote_response, content_iter, sizer, cache_writer, closer):
+        """
+        iter_streamed_response_async() 的生成器部分, 所需的状态都通过参数传入
+        :type remote_response: requests.Response
+        :type content_iter: Iterator[bytes]
+        :type sizer: AdaptiveChunkSize
+        :param cache_writer: 边传输边写入缓存, 为None时不缓存
+        :type cache_writer: Union[CacheContentWriter, None]
+        :param closer: 收尾函数, 见 make_stream_closer()
+        :type closer: Callable[[bool], None]
+        """
+        stats = stream_control.register_stream(remote_response.url, sizer.size)
+        stream_buffer = StreamBuffer(conf.stream_transfer_async_preload_max_packages_size)
+
+        preloaded = stream_control.executor.submit(
+            self._preload_streamed_response_content_async, content_iter, stream_buffer, sizer, stats, remote_response
+        )
+        if not preloaded:
+            # 预读线程池已满, 在当前线程中边读边发, 不进行预读
+            logger.debug("StreamPreloadPoolFull", remote_response.url, v=3)
+
+        state = "aborted"
+        try:
+            while True:
+                try:
+                    if preloaded:
+                        # 远程的读取超时由requests处理, 这里只是防止预读线程意外卡住
+                        particle_content = stream_buffer.get(timeout=conf.remote_read_timeout * 2)
+                    else:
+                        particle_content = next(content_iter, None)
+                        stats.bytes_in += len(particle_content or b"")
+                except TimeoutError:  # coverage: exclude
+                    logger.warn("WeGotAnStreamTimeout", remote_response.url)
+                    state = "timeout"
+                    return
+                except Exception as e:  # coverage: exclude
+                    logger.warn("StreamPreloadError", remote_response.url, e)
+                    state = "error"
+                    return
+
+                if particle_content is None:
+                    # todo
+                    # if self.parse.url_no_scheme in url_to_use_cdn:
+                    #     # 更新记录中的响应的长度
+                    #     url_to_use_cdn[self.parse.url_no_scheme][2] = stats.bytes_out
+
+                    state = "done"
+                    return
+
+                # 由于stream的特性, content会被消耗掉, 所以需要同时写入缓存
+                if cache_writer is not None:
+                    cache_writer.write(particle_content)
+
+                stats.bytes_out += len(particle_content)
                 yield particle_content
-            else:
-                # todo
-                # if self.parse.url_no_scheme in url_to_use_cdn:
-                #     # 更新记录中的响应的长度
-                #     url_to_use_cdn[self.parse.url_no_scheme][2] = len(_content_buffer)
-
-                if conf.local_cache_enable and not _disable_cache_temporary:
-                    self._update_content_in_local_cache(
-                        self.parse.remote_url,
-                        _content_buffer,
-                        method=self.parse.remote_response.request.method,
-                    )
-                return
+        finally:
+            stream_buffer.close()
+            stats.finish(state)
+            metrics.observe_stream(stats)
+            if logger.is_enabled_for(3):
+                logger.debug("StreamStats", stats.as_dict(), v=3)
+            closer(state == "done")
+
+    def _relay_streamed_response_async(self, fp, free_buffers, filled_queue, sizer, stats, remote_response):
+        """
+        stream模式下, 将远程响应体直接从socket读取到可复用的缓冲区中
+        缓冲区在 free_buffers 和 filled_queue 之间循环使用, 不会为每个数据块分配新的对象
+        每次读取的大小由 sizer 决定, 缓冲区会按需重新分配到合适的大小
+        所有缓冲区都在浏览器那边时, 不再从远程读取(背压),
+            超过 `stream_client_stall_timeout` 秒浏览器仍不读取, 则关闭远程连接
+        :param fp: 远程响应的底层文件对象(http.client.HTTPResponse), 支持 readinto()
+        :param free_buffers: 可用的空缓冲区, 取到None时停止
+        :type free_buffers: queue.Queue
+        :param filled_queue: 填充好的缓冲区, 元素为 (bytearray, 有效长度), 出错时为 (None, 异常)
+        :type filled_queue: queue.Queue
+        :type sizer: AdaptiveChunkSize
+        :type stats: StreamStats
+        :type remote_response: requests.Response
+        """
+        try:
+            while True:
+                waited = free_buffers.empty()
+                try:
+                    buffer = free_buffers.get(timeout=conf.stream_client_stall_timeout)
+                except queue.Empty:
+                    stats.finish("client-stalled")
+                    filled_queue.put((None, TimeoutError("Client stalled")))
+                    remote_response.close()
+                    return
+                if buffer is None:
+                    return
+                if waited:
+                    stats.stalls += 1
+
+                if len(buffer) < sizer.size or len(buffer) > sizer.size * 4:
+                    buffer = bytearray(sizer.size)
+
+                size = fp.readinto(memoryview(buffer)[: sizer.size])
+                stats.bytes_in += size
+                filled_queue.put((buffer, size))
+                if not size:
+                    return
+                stats.chunk_size = sizer.update(size)
+        except Exception as e:  # coverage: exclude
+            filled_queue.put((None, e))
+
+    def iter_relayed_response_async(self):
+        """
+        异步, 原样透传远程响应体, 用于不需要解压的二进制内容
+        一边从socket读取到几个可复用的大缓冲区中, 一边发送给用户
+        如果响应可以缓存, 内容会被同时追加写入到一个临时文件, 完成后附加到本地缓存中(见 FileCache.attach_content)
+        必须在请求的线程中调用
+        :rtype: Iterator[bytes]
+        """
+        remote_response = self.parse.remote_response
+        fp = getattr(remote_response.raw, "_original_response", None)
+        if fp is None or not hasattr(fp, "readinto"):  # coverage: exclude
+            return self.iter_streamed_response_async()
+
+        cache_writer = self.get_cache_writer()
+        range_fetch = None
+        if cache_writer is not None and cache_writer.segment is not None:
+            # Range请求的分段, 传输完成后再唤醒等待它的请求
+            range_fetch, self.parse.range_fetch = self.parse.range_fetch, None
+
+        self.stream_closer = self.make_stream_closer(remote_response, cache_writer, range_fetch)
+        return self._iter_relayed_buffers(remote_response, fp, cache_writer, self.stream_closer)
 
-            total_size += len(particle_content)
-            speed = total_size / 1024 / (time() - _start_time + 0.000001)
-            logger.debug("total_size:", total_size, "total_speed(KB/s):", speed, v=4)
+    def _iter_relayed_buffers(self, remote_response, fp, cache_writer, closer):
+        """
+        iter_relayed_response_async() 的生成器部分
+        在WSGI服务器迭代响应时才会执行, 此时请求的上下文可能已经不存在, 所以需要的状态都通过参数传入
+        :param cache_writer: 边传输边写入缓存, 为None时不缓存
+        :type cache_writer: Union[CacheContentWriter, None]
+        :param closer: 收尾函数, 见 make_stream_closer()
+        :type closer: Callable[[bool], None]
+        """
+        sizer = AdaptiveChunkSize(conf.stream_buffer_size, conf.stream_relay_buffer_size)
+        stats = stream_control.register_stream(remote_response.url, sizer.size)
+
+        buffer_count = max(2, conf.stream_relay_buffer_count)
+        free_buffers = queue.Queue()
+        for _ in range(buffer_count):
+            free_buffers.put(bytearray(sizer.size))
+        filled_queue = queue.Queue()
+
+        preloaded = stream_control.executor.submit(
+            self._relay_streamed_response_async, fp, free_buffers, filled_queue, sizer, stats, remote_response
+        )
+        if not preloaded:
+            # 预读线程池已满, 在当前线程中边读边发, 不进行预读
+            logger.debug("StreamPreloadPoolFull", remote_response.url, v=3)
+
+        total_size = 0
+        completed = False
+        state = "aborted"
+        try:
+            while True:
+                try:
+                    if preloaded:
+                        # 远程的读取超时由requests处理, 这里只是防止预读线程意外卡住
+                        buffer, size = filled_queue.get(timeout=conf.remote_read_timeout * 2)
+                    else:
+                        buffer = free_buffers.get_nowait()
+                        size = fp.readinto(buffer)
+                        stats.bytes_in += size
+                except queue.Empty:  # coverage: exclude
+                    logger.warn("WeGotAnStreamTimeout", remote_response.url)
+                    state = "timeout"
+                    return
+                except Exception as e:  # coverage: exclude
+                    buffer, size = None, e
+
+                if buffer is None:  # coverage: exclude
+                    logger.warn("StreamRelayError", remote_response.url, size)
+                    state = "error"
+                    return
+                if not size:
+                    completed = True
+                    state = "done"
+                    break
+
+                view = memoryview(buffer)[:size]
+                if cache_writer is not None:
+                    cache_writer.write(view)
+                # WSGI要求响应体的每一块都是bytes, 这是唯一的一次复制
+                chunk = bytes(view)
+                view.release()
+                free_buffers.put(buffer)
+
+                total_size += size
+                stats.bytes_out = total_size
+                yield chunk
+        finally:
+            free_buffers.put(None)  # 停止预读线程
+            stats.finish(state)
+            metrics.observe_stream(stats)
+            if logger.is_enabled_for(3):
+                logger.debug("StreamStats", stats.as_dict(), v=3)
+            closer(completed)
+
+    def _finish_cache_writer(self, cache_writer, completed):
+        """
+        stream传输结束时, 完整的内容加入缓存, 不完整的丢弃
+        :type cache_writer: Union[CacheContentWriter, None]
+        :type completed: bool
+        """
+        if cache_writer is None:
+            return
+        if not completed:
+            cache_writer.discard()
+        elif cache_writer.commit():
+            logger.debug("LocalCache_AttachContent", cache_writer.key, cache_writer.size, v=4)
 
     def rewrite_resp_headers(self, resp: Response):
         """
@@ -519,59 +1098,79 @@ class ResponseRewriter:
 
         logger.debug("RemoteRespHeaders", self.parse.remote_response.headers)
         # --------------------- 将远程响应头筛选/重写并复制到我们的响应中 -----------------------
-        # 筛选远程响应头时采用白名单制, 只有在 `allowed_remote_response_headers` 中的远程响应头才会被发送回浏览器
-        for header_key in self.parse.remote_response.headers:
-            header_key_lower = header_key.lower()
-            # Add necessary response headers from the origin site, drop other headers
-            if header_key_lower in conf.allowed_remote_response_headers:
-                if header_key_lower == "location":
-                    # 对于重定向的 location 的重写, 改写为zmirror的url
-                    _location = self.parse.remote_response.headers[header_key]
-
-                    if conf.custom_text_rewriter_enable:
-                        # location头也会调用自定义重写函数进行重写, 并且有一个特殊的MIME: mwm/headers-location
-                        # 这部分以后可能会单独独立出一个自定义重写函数
-                        _location = self.G.custom_response_text_rewriter(
-                            _location, "mwm/headers-location", self.parse.remote_url
-                        )
-
-                    resp.headers[header_key] = self.encode_mirror_url(_location)
-
-                elif header_key_lower == "content-type":
-                    # force add utf-8 to content-type if it is text
-                    if (
-                        is_mime_represents_text(self.parse.mime, conf.text_like_mime_types)
-                        and "utf-8" not in self.parse.content_type
-                    ):
-                        resp.headers[header_key] = self.parse.mime + "; charset=utf-8"
-                    else:
-                        resp.headers[header_key] = self.parse.remote_response.headers[header_key]
-
-                elif header_key_lower in ("access-control-allow-origin", "timing-allow-origin"):
-                    if conf.custom_allowed_origin is None:
-                        resp.headers[header_key] = conf.my_scheme_and_host
-                    elif conf.custom_allowed_origin == "_*_":  # coverage: exclude
-                        _origin = (
-                            request.headers.get("origin") or request.headers.get("Origin") or conf.my_scheme_and_host
-                        )
-                        resp.headers[header_key] = _origin
-                    else:
-                        resp.headers[header_key] = conf.custom_allowed_origin
-                    pass
-
-                else:
-                    resp.headers[header_key] = self.parse.remote_response.headers[header_key]
-
-            # If we have the Set-Cookie header, we should extract the raw ones
-            #   and then change the cookie domain to our domain
-            if header_key_lower == "set-cookie":
-                for cookie_string in self.response_cookies_deep_copy():
-                    resp.headers.add("Set-Cookie", self.response_cookie_rewrite(cookie_string))
+        self.copy_response_headers(resp, header_pipeline.iter_raw_response_headers(self.parse.remote_response))
+
+        # 响应体以远程服务器的原始压缩形式透传, 或者被我们压缩过
+        if self.parse.content_encoding:
+            resp.headers["Content-Encoding"] = self.parse.content_encoding
+            resp.headers["Vary"] = "Accept-Encoding"
+        # stream模式下响应体被原样透传时, 远程服务器给出的长度依然是准确的
+        if (
+            self.parse.streame_our_response
+            and self.parse.content_encoding == self.get_remote_content_encoding()
+            and "Content-Length" in self.parse.remote_response.headers
+        ):
+            resp.headers["Content-Length"] = self.parse.remote_response.headers["Content-Length"]
 
         logger.debug("OurRespHeaders:\n", resp.headers)
 
         return resp
 
+    def copy_response_headers(self, resp, raw_headers):
+        """
+        筛选远程响应头时采用白名单制, 只有在 `allowed_remote_response_headers` 中的远程响应头才会被发送回浏览器
+        各个响应头的动作在启动时就已经确定, 见 header_pipeline
+        :type resp: Response
+        :param raw_headers: 远程响应的原始头列表 [(名称, 值)], 重复的头不合并
+        :type raw_headers: Iterable[Tuple[str, str]]
+        """
+        lookup = self.G.response_header_table.lookup
+        headers = resp.headers
+        set_cookies = None
+        for header_key, value in raw_headers:
+            _, action, arg = lookup(header_key)
+            if action == header_pipeline.DROP:
+                continue
+            elif action == header_pipeline.PASS:
+                headers.add(header_key, value)
+            elif action == header_pipeline.CALL:
+                # content-type 会覆盖flask默认的值
+                value = arg(self, value)
+                if value is not None:
+                    headers.set(header_key, value)
+            elif action == header_pipeline.FIXED:
+                headers.set(header_key, arg)
+            elif action == header_pipeline.REWRITE_URL:
+                headers.set(header_key, self.rewrite_location_header(value))
+            elif action == header_pipeline.REWRITE_COOKIE:
+                # If we have the Set-Cookie header, change the cookie domain to our domain
+                if set_cookies is None:
+                    set_cookies = []
+                set_cookies.append(value)
+
+        if set_cookies:
+            # 所有 Set-Cookie 一起重写, 每个cookie只出现一次
+            with metrics.stage("cookie_rewrite", self.parse.time):
+                for cookie_string in self.response_cookies_rewrite(set_cookies):
+                    headers.add("Set-Cookie", cookie_string)
+
+    def rewrite_location_header(self, location):
+        """
+        对于重定向的 location 的重写, 改写为zmirror的url
+        :type location: str
+        :rtype: str
+        """
+        if conf.custom_text_rewriter_enable:
+            # location头也会调用自定义重写函数进行重写, 并且有一个特殊的MIME: mwm/headers-location
+            # 这部分以后可能会单独独立出一个自定义重写函数
+            location = self.G.custom_response_text_rewriter(location, "mwm/headers-location", self.parse.remote_url)
+        if conf.automatic_domains_whitelist_enable:
+            # 重定向到的域名也可能需要加入自动白名单
+            netloc = split_url(location)[1].lower()
+            if netloc and netloc not in self.G.domain_index:
+                self.G.try_auto_add_domain(netloc)
+        return self.encode_mirror_url(location)
+
     def add_extra_headers(self, resp: Response):
         # add extra headers
         if self.parse.time["req_time_header"] >= 0.00001:
@@ -580,7 +1179,7 @@ class ResponseRewriter:
             # remote request time should be excluded when calculating total time
             self.parse.set_extra_resp_header("X-Body-Req-Time", "%.4f" % self.parse.time["req_time_body"])
             self.parse.set_extra_resp_header(
-                "X-Compute-Time", "%.4f" % (process_time() - self.parse.time["start_time"])
+                "X-Compute-Time", "%.4f" % (thread_time() - self.parse.time["start_time"])
             )
         self.parse.set_extra_resp_header("X-Powered-By", "zmirror/%s" % pkg_version)
         for k, v in self.parse.extra_resp_headers.items():
@@ -601,21 +1200,52 @@ class ResponseRewriter:
         self.parse_remote_response()
 
         # process remote reponse
+        text_content = None
         if self.parse.streame_our_response:
             self.parse.time["req_time_body"] = 0
-            # 异步传输内容, 不进行任何重写, 返回一个生成器
-            content = self.iter_streamed_response_async()
+            # 异步传输内容, 不进行任何重写, 尽量以原始的压缩形式透传, 返回一个生成器
+            if not self.need_decode_remote_content():
+                # 不需要解压, 直接从socket透传
+                self.parse.content_encoding = self.get_remote_content_encoding()
+                content = self.iter_relayed_response_async()
+            else:
+                content = self.iter_streamed_response_async()
         else:
             # 如果不是异步传输, 则(可能)进行重写
             content, self.parse.time["req_time_body"] = self.response_content_rewrite()
+            if is_mime_represents_text(self.parse.mime, conf.text_like_mime_types) and not self.parse.content_encoding:
+                # 重写后的文本, 压缩一次后发送
+                text_content = content
+                with metrics.stage("compress", self.parse.time):
+                    content = self.compress_text_content(text_content)
 
         # 创建基础的Response对象
         resp = Response(content, status=self.parse.remote_response.status_code)
         resp = self.rewrite_resp_headers(resp)
+
+        if conf.local_cache_enable and self.parse.cacheable:
+            with metrics.stage("cache_store", self.parse.time):
+                self.put_response_to_local_cache(
+                    resp, without_content=self.parse.streame_our_response, text_content=text_content
+                )
+        elif self.parse.streame_our_response:
+            # Range请求的分段, 同样先只存入响应头, 见 get_cache_writer()
+            segment = self.get_segment_cache_info()
+            if segment is not None:
+                with metrics.stage("cache_store", self.parse.time):
+                    self.put_response_to_local_cache(
+                        resp, without_content=True, cache_key=self.G.cache.get_segment_key(*segment[:3])
+                    )
+
+        if self.stream_closer is not None:
+            # 在存入缓存之后才注册, 缓存中的响应对象不应带有它
+            resp.call_on_close(self.stream_closer)
+            self.stream_closer = None
+
         resp = self.add_extra_headers(resp)
 
         # dump request and response data to file
         if conf.developer_dump_all_files and not self.parse.streame_our_response:
-            dump_zmirror_snapshot("traffic")
+            dump_zmirror_snapshot(self.parse, request, root="traffic", our_response=resp)
 
         return resp
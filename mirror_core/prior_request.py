@@ -1,15 +1,14 @@
-from urllib.parse import urljoin, urlsplit
+from urllib.parse import urljoin
 
 from flask import request
 
-from utils.util import *
-
+from . import header_pipeline, metrics
 from .shares import Shares, conf, logger
-from .threadlocal import ZmirrorThreadLocal
+from .request_context import RequestContext
 
 
 class RequestRewriter:
-    def __init__(self, parse: ZmirrorThreadLocal, shares: Shares) -> None:
+    def __init__(self, parse: RequestContext, shares: Shares) -> None:
         self.parse = parse
         self.G = shares
 
@@ -19,65 +18,16 @@ class RequestRewriter:
         可以不是完整的url, 只需要有 path 部分即可(query_string也可以有)
         若参数留空, 则使用当前用户正在请求的url
         支持json (处理 \/ 和 \. 的转义)
+        解析和缓存见 url_mapping.UrlMapper
 
         :rtype: dict[str, Union[str, bool]]
         :return: {'domain':str, 'is_https':bool, 'path':str, 'path_query':str}
         """
-        _is_escaped_dot = False
-        _is_escaped_slash = False
-        result = {}
-
         if mirror_url is None:
-            mirror_path_query = self.G.extract_path_and_query()  # type: str
+            domain, is_https, path, path_query = self.G.url_mapper.decode(self.G.extract_path_and_query())
         else:
-            if r"\/" in mirror_url:  # 如果 \/ 在url中, 先反转义, 处理完后再转义回来
-                _is_escaped_slash = True
-                mirror_url = mirror_url.replace(r"\/", "/")
-
-            if r"\." in mirror_url:  # 如果 \. 在url中, 先反转义, 处理完后再转义回来
-                _is_escaped_dot = True
-                mirror_url = mirror_url.replace(r"\.", ".")
-
-            mirror_path_query = self.extract_path_and_query(mirror_url)  # type: str
-
-        if mirror_path_query[:12] == "/extdomains/":
-            # 12 == len('/extdomains/')
-            split = urlsplit("//" + mirror_path_query[12:].lstrip("/"))
-
-            real_domain = split.netloc
-            real_path_query = (split.path or "/") + (("?" + split.query) if split.query else "")
-
-            if real_domain[:6] == "https-":
-                # 如果显式指定了 /extdomains/https-域名 形式(为了兼容老版本)的, 那么使用https
-                real_domain = real_domain[6:]
-                _is_https = True
-            else:
-                # 如果是 /extdomains/域名 形式, 没有 "https-" 那么根据域名判断是否使用HTTPS
-                _is_https = self.G.is_target_domain_use_https(real_domain)
-
-            # real_path_query = self.client_requests_text_rewrite(real_path_query)
-
-            if _is_escaped_dot:
-                real_path_query = real_path_query.replace(".", r"\.")
-            if _is_escaped_slash:
-                real_path_query = esc_str(real_path_query)
-            result["domain"] = real_domain
-            result["is_https"] = _is_https
-            result["path_query"] = real_path_query
-            result["path"] = urlsplit(real_path_query).path
-            return result
-
-        # input_path_query = self.client_requests_text_rewrite(input_path_query)
-
-        if _is_escaped_dot:
-            mirror_path_query = mirror_path_query.replace(".", r"\.")
-        if _is_escaped_slash:
-            mirror_path_query = esc_str(mirror_path_query)
-        result["domain"] = conf.target_domain
-        result["is_https"] = conf.target_scheme == "https://"
-        result["path_query"] = mirror_path_query
-        result["path"] = urlsplit(mirror_path_query).path
-        return result
+            domain, is_https, path, path_query = self.G.url_mapper.decode_url(mirror_url)
+        return {"domain": domain, "is_https": is_https, "path": path, "path_query": path_query}
 
     def assemble_remote_url(self):
         """
@@ -86,28 +36,34 @@ class RequestRewriter:
         """
         if self.parse.is_external_domain:
             # 请求的是外部域名 (external domains)
-            scheme = "https://" if self.parse.is_https else "http://"
-            return urljoin(scheme + self.parse.remote_domain, self.parse.remote_path_query)
+            scheme_host = ("https://" if self.parse.is_https else "http://") + self.parse.remote_domain
         else:
             # 请求的是主域名及可以被当做(alias)主域名的域名
-            return urljoin(conf.target_scheme + conf.target_domain, self.parse.remote_path_query)
+            scheme_host = conf.target_scheme + conf.target_domain
+        path_query = self.parse.remote_path_query
+        if path_query[:1] == "/" and path_query[:2] != "//" and "/." not in path_query:
+            # 绝大部分的情况, 直接拼接, 与 urljoin() 的结果相同
+            return scheme_host + path_query
+        return urljoin(scheme_host, path_query)
 
     def assemle_parse(self):
         """将用户请求的URL解析为对应的目标服务器URL"""
-        remote_url_info = self.decode_mirror_url()
-        self.parse.remote_domain = remote_url_info["domain"]  # type: str
-        self.parse.is_https = remote_url_info["is_https"]  # type: bool
-        self.parse.remote_path = remote_url_info["path"]  # type: str
-        self.parse.remote_path_query = remote_url_info["path_query"]  # type: str
-        self.parse.is_external_domain = self.G.is_external_domain(self.parse.remote_domain)
-        self.parse.remote_url = self.assemble_remote_url()  # type: str
-        self.parse.url_no_scheme = self.parse.remote_url[self.parse.remote_url.find("//") + 2 :]  # type: str
+        with metrics.stage("url_decode", self.parse.time):
+            remote_url_info = self.decode_mirror_url()
+            self.parse.remote_domain = remote_url_info["domain"]  # type: str
+            self.parse.is_https = remote_url_info["is_https"]  # type: bool
+            self.parse.remote_path = remote_url_info["path"]  # type: str
+            self.parse.remote_path_query = remote_url_info["path_query"]  # type: str
+            self.parse.is_external_domain = self.G.is_external_domain(self.parse.remote_domain)
+            self.parse.remote_url = self.assemble_remote_url()  # type: str
+            self.parse.url_no_scheme = self.parse.remote_url[self.parse.remote_url.find("//") + 2 :]  # type: str
 
         # extract client header
-        self.parse.client_header = self.extract_client_header()
+        with metrics.stage("header_extract", self.parse.time):
+            self.parse.client_header = self.extract_client_header()
 
         # 写入最近使用的域名
-        self.G.recent_domains[self.parse.remote_domain] = True
+        self.G.recent_domains[self.parse.remote_domain] += 1
 
         logger.debug(
             "after assemble_parse, url:",
@@ -130,43 +86,32 @@ class RequestRewriter:
         """
         rewrited_headers = {}
         logger.debug("BrowserRequestHeaders:", request.headers)
-        for head_name, head_value in request.headers:
-            head_name_l = head_name.lower()  # requests的请求头是区分大小写的, 统一变为小写
-
-            # ------------------ 特殊请求头的处理 -------------------
-            if head_name_l in ("host", "content-length"):
-                # 丢弃浏览器的这两个头, 会在zmirror请求时重新生成
-                continue
-
-            elif head_name_l == "content-type" and head_value == "":
-                # 跳过请求头中的空白的 content-type
-                #   在flask的request中, 无论浏览器实际有没有传入, content-type头会始终存在,
-                #   如果它是空值, 则表示实际上没这个头, 则剔除掉
-                continue
-
-            elif head_name_l == "accept-encoding" and ("br" in head_value or "sdch" in head_value):
-                # 一些现代浏览器支持sdch和br编码, 而requests不支持, 所以会剔除掉请求头中sdch和br编码的标记
-                # For Firefox, they may send 'Accept-Encoding: gzip, deflate, br'
-                # For Chrome, they may send 'Accept-Encoding: gzip, deflate, sdch, br'
-                #   however, requests cannot decode the br encode, so we have to remove it from the request header.
-                _str_buff = ""
-                if "gzip" in head_value:
-                    _str_buff += "gzip, "
-                if "deflate" in head_value:
-                    _str_buff += "deflate"
-                if _str_buff:
-                    rewrited_headers[head_name_l] = _str_buff
-            else:
-                # ------------------ 其他请求头的处理 -------------------
-                # 对于其他的头, 进行一次内容重写后保留
-                rewrited_headers[head_name_l] = self.G.client_requests_text_rewrite(head_value)
-
-                # 移除掉 cookie 中的 zmirror_verify
-                if head_name_l == "cookie":
-                    rewrited_headers[head_name_l] = self.G.re_patterns["verify_header"].sub(
-                        "",
-                        rewrited_headers[head_name_l],
-                    )
+        # 各个请求头的动作在启动时就已经确定, 见 header_pipeline
+        #   requests的请求头是区分大小写的, 统一变为小写
+        lookup = self.G.request_header_table.lookup_environ
+        for head_name, head_value in header_pipeline.iter_raw_request_headers(request.environ):
+            head_name_l, action, arg = lookup(head_name)
+            if action == header_pipeline.PASS:
+                rewrited_headers[head_name_l] = head_value
+            elif action == header_pipeline.REWRITE_URL:
+                # 进行一次内容重写后保留
+                rewrited_headers[head_name_l] = self.G.client_request_header_rewrite(head_name_l, head_value)
+            elif action == header_pipeline.REWRITE_COOKIE:
+                # 重写后移除掉 cookie 中的 zmirror_verify
+                rewrited_headers[head_name_l] = self.G.re_patterns["verify_header"].sub(
+                    "", self.G.client_request_header_rewrite(head_name_l, head_value)
+                )
+            elif action == header_pipeline.CALL:
+                head_value = arg(self, head_value)
+                if head_value is not None:
+                    rewrited_headers[head_name_l] = head_value
+            elif action == header_pipeline.FIXED:
+                rewrited_headers[head_name_l] = arg
+            # DROP: 丢弃, 比如 host 和 content-length 会在zmirror请求时重新生成
+
+        if "accept-encoding" not in rewrited_headers:
+            # 浏览器没有声明支持任何压缩, 避免 requests 自动加上默认的 Accept-Encoding
+            rewrited_headers["accept-encoding"] = "identity"
 
         logger.debug("FilteredBrowserRequestHeaders:", rewrited_headers)
 
@@ -0,0 +1,211 @@
+# coding=utf-8
+"""
+本模块为支持 `profiler_enable` 选项而存在
+运行中的采样分析器(sampling profiler), 不需要重启就能找出线上的热点(比如 response_text_rewrite)
+
+在一段时间内, 每隔 interval 秒对所有线程(包括请求线程, stream预读线程等)的调用栈采样一次,
+    结束后写入文件, 支持两种格式:
+    collapsed   每行一个调用栈 "线程;外层函数;...;内层函数 采样次数", 可以直接交给 flamegraph.pl 或 speedscope
+    speedscope  https://www.speedscope.app 的json格式, 每个线程(按名称合并)一个profile
+
+可以通过两种方式启动:
+    访问 `profiler_path` (只允许 `profiler_allowed_ips`), 参数 seconds, interval, format
+    向进程发送 `profiler_signal` 信号(默认 SIGUSR2), 使用默认参数
+"""
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from time import sleep, time
+
+try:
+    from typing import Dict, List, Tuple, Union
+except:  # pragma: no cover
+    pass
+
+FORMATS = ("collapsed", "speedscope")
+
+# 单次采样的最长时间(秒)
+MAX_SECONDS = 600
+
+# 线程名中的编号, 同一类线程合并统计, 如 "Thread-12 (_worker)" --> "Thread (_worker)"
+_thread_number_regex = re.compile(r"-\d+")
+
+
+class SamplingProfiler:
+    """同一时间只能进行一次采样"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+        self.last_file = None  # type: Union[str, None]
+        self._labels = {}  # type: Dict[object, Tuple[str, str, int]]
+
+    def start(self, seconds, interval, output_format, output_dir):
+        """
+        在后台线程中开始采样
+        :param seconds: 采样持续的秒数
+        :type seconds: float
+        :param interval: 采样间隔(秒)
+        :type interval: float
+        :param output_format: collapsed 或 speedscope
+        :type output_format: str
+        :param output_dir: 输出文件夹, 不存在时会被创建
+        :type output_dir: str
+        :return: 输出文件的路径, 已经在采样时返回None
+        :rtype: Union[str, None]
+        """
+        if output_format not in FORMATS:
+            raise ValueError("Unsupported profile format: {}".format(output_format))
+        # 不阻塞, 信号处理函数可能在持有锁的线程中被调用
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            if self.running:
+                return None
+            self.running = True
+        finally:
+            self._lock.release()
+
+        file_name = datetime.now().strftime("profile_%Y-%m-%d_%H-%M-%S")
+        file_name += ".collapsed.txt" if output_format == "collapsed" else ".speedscope.json"
+        path = os.path.abspath(os.path.join(output_dir, file_name))
+        threading.Thread(
+            target=self._run, args=(seconds, interval, output_format, path), name="zmirror-profiler", daemon=True
+        ).start()
+        return path
+
+    def _run(self, seconds, interval, output_format, path):
+        try:
+            stacks, duration = self.collect(seconds, interval)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if output_format == "collapsed":
+                content = self.to_collapsed(stacks)
+            else:
+                content = self.to_speedscope(stacks, interval, duration)
+            with open(path, "w", encoding="utf-8") as fp:
+                fp.write(content)
+            self.last_file = path
+        finally:
+            self._labels.clear()
+            self.running = False
+
+    def collect(self, seconds, interval):
+        """
+        采样, 阻塞 seconds 秒
+        :return: ({(线程名, 调用栈的帧): 采样次数}, 实际持续时间)
+        :rtype: Tuple[Counter, float]
+        """
+        stacks = Counter()
+        my_ident = threading.get_ident()
+        start_time = time()
+        deadline = start_time + seconds
+        while time() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == my_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._get_label(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                thread_name = _thread_number_regex.sub("", thread_names.get(ident, "Thread"))
+                stacks[(thread_name, tuple(stack))] += 1
+            sleep(interval)
+        return stacks, time() - start_time
+
+    def _get_label(self, code):
+        """
+        :rtype: Tuple[str, str, int]
+        """
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = (code.co_name, code.co_filename, code.co_firstlineno)
+        return label
+
+    @staticmethod
+    def to_collapsed(stacks):
+        """
+        :type stacks: Counter
+        :rtype: str
+        """
+        lines = []
+        for (thread_name, stack), count in sorted(stacks.items(), key=lambda x: -x[1]):
+            frames = [thread_name.replace(";", ":")] + [
+                "%s (%s:%d)" % (name, os.path.basename(filename), lineno) for name, filename, lineno in stack
+            ]
+            lines.append("%s %d" % (";".join(frames), count))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def to_speedscope(stacks, interval, duration):
+        """
+        :type stacks: Counter
+        :type interval: float
+        :type duration: float
+        :rtype: str
+        """
+        frames = []  # type: List[dict]
+        frame_index = {}  # type: Dict[Tuple[str, str, int], int]
+        profiles = {}  # type: Dict[str, dict]
+        for (thread_name, stack), count in stacks.items():
+            indexes = []
+            for label in stack:
+                index = frame_index.get(label)
+                if index is None:
+                    index = frame_index[label] = len(frames)
+                    frames.append({"name": label[0], "file": label[1], "line": label[2]})
+                indexes.append(index)
+            profile = profiles.get(thread_name)
+            if profile is None:
+                profile = profiles[thread_name] = {
+                    "type": "sampled",
+                    "name": thread_name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": 0,
+                    "samples": [],
+                    "weights": [],
+                }
+            profile["samples"].append(indexes)
+            profile["weights"].append(count * interval)
+            profile["endValue"] += count * interval
+        return json.dumps({
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": "zmirror profile (%.1fs)" % duration,
+            "exporter": "zmirror",
+            "shared": {"frames": frames},
+            "profiles": sorted(profiles.values(), key=lambda x: -x["endValue"]),
+        })
+
+
+profiler = SamplingProfiler()
+
+
+def install_signal_handler(signal_name, seconds, interval, output_format, output_dir):
+    """
+    收到信号时开始采样, 只能在主线程中调用
+    :param signal_name: 信号名称, 如 "SIGUSR2"
+    :type signal_name: str
+    :return: 是否安装成功, 当前平台不支持该信号或不在主线程中时返回False
+    :rtype: bool
+    """
+    import signal
+
+    signal_number = getattr(signal, signal_name, None)
+    if signal_number is None:
+        return False
+
+    def handler(signum, frame):
+        profiler.start(seconds, interval, output_format, output_dir)
+
+    try:
+        signal.signal(signal_number, handler)
+    except ValueError:
+        # 不在主线程中
+        return False
+    return True
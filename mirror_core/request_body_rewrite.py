@@ -0,0 +1,113 @@
+# coding=utf-8
+"""
+浏览器请求体(POST data)的重写, 根据 Content-Type 只重写含有本站域名的字段, 而不是对整个请求体执行正则
+
+    application/x-www-form-urlencoded  字段以 & 分隔, 只有含有本站域名的字段会被重写
+    application/json, *+json           字符串以 " 分隔, 只有含有本站域名的字符串会被重写
+    其他类型                           与之前相同: 预过滤 + 对整个文本执行正则, 见 Shares.client_requests_text_rewrite()
+
+并不需要真正地解析出每个字段: 先用 str.find 找到本站域名(和 extdomains)出现的位置,
+    然后只对它所在的, 由分隔符界定的那一段执行正则, 其余部分原样拼接回去
+重写的正则不会匹配到分隔符(域名, 协议, 斜线中都不会含有 & 和 "), 所以结果与对整个文本重写完全相同
+大部分请求体不含本站域名, 此时原样返回
+"""
+import re
+
+try:
+    from typing import Callable, Dict, Iterable, List
+except:  # pragma: no cover
+    pass
+
+# 与 Shares.is_requests_text_need_rewrite() 相同, extdomains 不区分大小写
+#   非ASCII文本不能使用 text.lower().find(), 因为个别unicode字符小写后长度会改变, 位置就对不上了
+_extdomains_regex = re.compile("extdomains", flags=re.IGNORECASE)
+
+
+class RequestBodyRewriter:
+    def __init__(self, host_literals, need_rewrite, rewrite_text):
+        """
+        :param host_literals: 本站域名的各种字面形式, 区分大小写, 即 Shares.my_host_name_literals
+        :type host_literals: Iterable[str]
+        :param need_rewrite: 预过滤, 文本中是否可能含有需要重写的内容, 即 Shares.is_requests_text_need_rewrite()
+        :type need_rewrite: Callable[[str], bool]
+        :param rewrite_text: 对一段文本执行正则重写 (不再进行预过滤)
+        :type rewrite_text: Callable[[str], str]
+        """
+        self.host_literals = tuple(host_literals)
+        self.need_rewrite = need_rewrite
+        self.rewrite_text = rewrite_text
+        # MIME --> 字段分隔符
+        self.delimiters = {
+            "application/x-www-form-urlencoded": "&",
+            "application/json": '"',
+        }  # type: Dict[str, str]
+
+    def rewrite(self, text, mime):
+        """
+        :param text: 解码后的请求体
+        :type text: str
+        :param mime: 请求体的MIME, 如 "application/json", 可以为空
+        :type mime: str
+        :rtype: str
+        """
+        if not self.need_rewrite(text):
+            return text
+        delimiter = self.delimiters.get(mime)
+        if delimiter is None:
+            if not mime or not mime.endswith("+json"):
+                return self.rewrite_text(text)
+            delimiter = '"'
+        return self.rewrite_segments(text, delimiter)
+
+    def rewrite_segments(self, text, delimiter):
+        """
+        只重写含有本站域名的段
+        eg(delimiter="&"): a=1&u=http%3A%2F%2Fmy.mirror.com%2Fextdomains%2Fb.com&c=3 --> 只有 u=... 这一段会被重写
+        :type text: str
+        :type delimiter: str
+        :rtype: str
+        """
+        parts = []  # type: List[str]
+        pos = 0
+        for hit in self._find_hits(text):
+            if hit < pos:
+                # 与上一个位置在同一段中, 已经重写过了
+                continue
+            start = text.rfind(delimiter, pos, hit) + 1 or pos
+            end = text.find(delimiter, hit)
+            if end == -1:
+                end = len(text)
+            parts.append(text[pos:start])
+            parts.append(self.rewrite_text(text[start:end]))
+            pos = end
+        parts.append(text[pos:])
+        return "".join(parts)
+
+    def _find_hits(self, text):
+        """
+        本站域名和 extdomains 在文本中出现的位置, 从小到大
+        :type text: str
+        :rtype: List[int]
+        """
+        if text.isascii():
+            hits = self._find_all("extdomains", text.lower())
+        else:
+            hits = [m.start() for m in _extdomains_regex.finditer(text)]
+        for literal in self.host_literals:
+            hits += self._find_all(literal, text)
+        hits.sort()
+        return hits
+
+    @staticmethod
+    def _find_all(literal, text):
+        """
+        :type literal: str
+        :type text: str
+        :rtype: List[int]
+        """
+        result = []
+        index = text.find(literal)
+        while index != -1:
+            result.append(index)
+            index = text.find(literal, index + len(literal))
+        return result
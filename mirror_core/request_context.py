@@ -0,0 +1,175 @@
+# coding=utf-8
+try:
+    from typing import Dict, List, Tuple, Union
+    import threading
+    import requests
+except:  # pragma: no cover
+    pass
+
+
+class RequestContext:
+    """
+    一个请求的上下文, 每个请求新建一个, 通过构造函数显式地传给
+        RequestRewriter, RequestSender, ResponseRewriter 和 PageGenerator
+    不依赖 thread-local, 所以不会残留上一个请求的值, stream预读线程中也可以安全地访问
+
+    本类在 zmirror 中被实例化为变量 parse
+    这个变量的重要性不亚于 request, 在 zmirror 各个部分都会用到
+
+    其各个变量的含义如下:
+    parse.time                记录请求过程中的各种时间点和各阶段的耗时, 见 metrics
+         .method              请求的方法, 如 GET POST
+         .remote_domain       当前请求对应的远程域名
+         .is_external_domain  远程域名是否是外部域名, 比如google镜像, www.gstatic.com 就是外部域名
+         .is_https            是否需要用https 来请求远程域名
+         .remote_url          远程服务器的url, 比如 https://google.com/search?q=233
+         .url_no_scheme       没有协议前缀的url,比如 google.com/search?q=233 通常在缓存中用
+         .remote_path_query   对应的远程path+query, 比如 /search?q=2333
+         .remote_path         对应的远程path,  比如 /search
+         .client_header       经过转换和重写以后的访问者请求头
+         .content_type        远程服务器响应头中的 content_type, 比如 "text/plain; encoding=utf-8"
+         .mime                远程服务器响应的MIME, 比如 "text/html"
+         .content_encoding    我们发送给浏览器的响应体的编码(Content-Encoding), 比如 "gzip", 未压缩时为空字符串
+         .request_data        浏览器传入的data(已经经过重写) 可能为str或bytes或None
+         .request_data_encoding 浏览器传入的data的编码(如果有) 如果为二进制或编码未知, 则为None
+         .request_data_encoded  编码后的二进制 request_data, 由 set_request_data() 一次性计算
+         .cache_control       远程服务器响应的cache_control内容
+         .remote_response     远程服务器的响应, requests.Response
+         .cacheable           是否可以对这一响应应用缓存 (CDN也算是缓存的一种, 依赖于此选项)
+         .range_fetch         本请求登记的正在进行的Range请求 (key, threading.Event), 用于合并重叠的Range请求, 没有时为None
+         .cache_result        本地缓存的查找结果, 如 "hit", "miss", 见 access_log
+         .extra_resp_headers  发送给浏览器的额外响应头 (比如一些调试信息什么的)
+         .extra_cookies       额外的cookies, 在目前版本只能添加, 不能覆盖已有cookie
+         .streame_our_response  是否以 stream 模式向浏览器传送这个响应
+         .temporary_domain_alias 用于纯文本域名替换, 见 `plain_replace_domain_alias` 选项
+
+    本类的方法:
+        .dump()                   dump所有信息到dict
+        .set_request_data()       设置浏览器传入的data, 同时计算 request_data_encoded
+        .set_extra_resp_header()  设置一个响应头, 会发送给访问者, 会在内部操作 self.extra_resp_headers
+        .set_cookies()            添加一个cookie 会在内部操作 self.extra_cookies, 目前版本只能添加新的cookie, 不能覆盖已有cookie
+
+    """
+
+    __slots__ = (
+        "time",
+        "method",
+        "remote_domain",
+        "is_external_domain",
+        "is_https",
+        "remote_url",
+        "url_no_scheme",
+        "remote_path_query",
+        "remote_path",
+        "client_header",
+        "content_type",
+        "mime",
+        "content_encoding",
+        "request_data",
+        "request_data_encoding",
+        "request_data_encoded",
+        "cache_control",
+        "remote_response",
+        "cacheable",
+        "range_fetch",
+        "cache_result",
+        "extra_resp_headers",
+        "extra_cookies",
+        "streame_our_response",
+        "temporary_domain_alias",
+    )
+
+    def __init__(self, method=None):
+        self.time = {}  # type: Dict[str, float]
+        self.method = method  # type: str
+        self.remote_domain = None  # type: str
+        self.is_external_domain = None  # type: bool
+        self.is_https = None  # type: bool
+        self.remote_url = None  # type: str
+        self.url_no_scheme = None  # type: str
+        self.remote_path_query = None  # type: str
+        self.remote_path = None  # type: str
+        self.client_header = None  # type: Dict[str, str]
+        self.content_type = None  # type: str
+        self.mime = None  # type: str
+        self.content_encoding = ""  # type: str
+        self.request_data = None  # type: Union[str, bytes, None]
+        self.request_data_encoding = None  # type: Union[str, None]
+        self.request_data_encoded = None  # type: Union[bytes, None]
+        self.cache_control = None  # type: str
+        self.remote_response = None  # type: requests.Response
+        self.cacheable = False  # type: bool
+        self.range_fetch = None  # type: Union[Tuple[str, threading.Event], None]
+        self.cache_result = None  # type: Union[str, None]
+        self.extra_resp_headers = {}  # type: Dict[str, str]
+        self.extra_cookies = {}  # type: Dict[str, str]
+        self.streame_our_response = False  # type: bool
+        self.temporary_domain_alias = []  # type: List[Tuple[str, str]]
+
+    def dump(self):
+        return {
+            "time": self.time,
+            "method": self.method,
+            "remote_domain": self.remote_domain,
+            "is_external_domain": self.is_external_domain,
+            "is_https": self.is_https,
+            "remote_url": self.remote_url,
+            "url_no_scheme": self.url_no_scheme,
+            "remote_path_query": self.remote_path_query,
+            "client_header": self.client_header,
+            "content_type": self.content_type,
+            "remote_path": self.remote_path,
+            "mime": self.mime,
+            "content_encoding": self.content_encoding,
+            "cache_control": self.cache_control,
+            "temporary_domain_alias": self.temporary_domain_alias,
+            "remote_response": self.remote_response,
+            "streamed_our_response": self.streame_our_response,
+            "cacheable": self.cacheable,
+            "range_fetch": self.range_fetch,
+            "cache_result": self.cache_result,
+            "extra_resp_headers": self.extra_resp_headers,
+            "extra_cookies": self.extra_cookies,
+            "request_data": self.request_data,
+            "request_data_encoding": self.request_data_encoding,
+        }
+
+    def __str__(self):
+        return str(self.dump())
+
+    def set_request_data(self, data, encoding=None):
+        """
+        设置浏览器传入的data, 发送给远程服务器的二进制形式只在这里计算一次
+        :type data: Union[str, bytes, None]
+        :type encoding: Union[str, None]
+        """
+        self.request_data = data
+        self.request_data_encoding = encoding
+        if isinstance(data, str):
+            self.request_data_encoded = data.encode(encoding=encoding or "utf-8")
+        else:
+            self.request_data_encoded = data
+
+    def set_extra_resp_header(self, name, value):
+        """
+        :type name: str
+        :type value: str
+        """
+        self.extra_resp_headers[name] = value
+
+    def set_cookies(self, name, value, ttl=12 * 35 * 24 * 60 * 60, path="/"):
+        """
+        :param ttl: cookie有效时间, 秒
+        :type ttl: int
+        :type path: str
+        :type name:  str
+        :type value:  str
+        """
+        from http.cookies import SimpleCookie
+
+        c = SimpleCookie()
+        c[name] = value
+        c[name]["path"] = path
+        c[name]["expires"] = ttl
+
+        self.extra_cookies[name] = c[name].OutputString()
@@ -4,51 +4,132 @@ from urllib.parse import urlsplit
 import requests
 from flask import request
 
-from utils.util import current_line_number
+from utils.util import current_line_number, is_mime_represents_text
 
-from .connection_pool import get_session
+from . import metrics
+from .circuit_breaker import CircuitOpenError, get_breaker
+from .connection_pool import create_session, get_session
+from .request_context import RequestContext
 from .shares import Shares, conf, logger
-from .threadlocal import ZmirrorThreadLocal
+
+try:
+    from typing import Iterator, Tuple, Union
+except:  # pragma: no cover
+    pass
+
+# 这些表单虽然不是文本MIME, 但是较小时依然会被读取并重写
+REWRITABLE_FORM_MIMES = ("application/x-www-form-urlencoded", "multipart/form-data")
+
+# 以stream模式转发请求体时, 每次从浏览器读取的大小
+REQUEST_BODY_CHUNK_SIZE = 64 * 1024
+
+
+class StreamedRequestBody:
+    """
+    浏览器的请求体, 边从浏览器读取边发送给远程服务器, 内存占用与请求体的大小无关
+    长度已知时 requests 会发送 Content-Length (通过 __len__), 否则使用 chunked 传输, 见 as_request_data()
+    """
+
+    def __init__(self, stream, length=None, chunk_size=REQUEST_BODY_CHUNK_SIZE):
+        """
+        :param stream: 浏览器请求体的输入流, 即 request.stream
+        :param length: 请求体的大小, 未知时为None
+        :type length: Union[int, None]
+        :type chunk_size: int
+        """
+        self.stream = stream
+        self.length = length
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+
+    def __len__(self):
+        return self.length or 0
+
+    def read(self, size=-1):
+        """
+        :type size: int
+        :rtype: bytes
+        """
+        if size is None or size < 0:
+            size = self.chunk_size
+        chunk = self.stream.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def as_request_data(self):
+        """
+        交给 requests 的 data 参数: 长度已知时是本对象(文件), 否则是生成器(chunked)
+        """
+        if self.length:
+            return self
+        return iter(self)
+
+    def __repr__(self):
+        return "<StreamedRequestBody length=%s read=%d>" % (self.length, self.bytes_read)
 
 
 class RequestSender:
-    def __init__(self, parse: ZmirrorThreadLocal, shares: Shares) -> None:
+    def __init__(self, parse: RequestContext, shares: Shares) -> None:
         self.parse = parse
         self.G = shares
 
+    def is_request_data_streamable(self):
+        """
+        浏览器的请求体是否以stream模式转发给远程服务器: 不读入内存, 也不进行重写
+            大小超过 `request_body_rewrite_max_size` 或未知(chunked)的, 以及二进制的(如 application/octet-stream)
+        小的文本(包括表单)请求体依然会被读入内存并重写, 见 try_decode_request_data()
+        :rtype: bool
+        """
+        length = request.content_length
+        if length is None:
+            # 没有 Content-Length 时, 只有 chunked 的请求体才需要读取
+            return bool(request.environ.get("wsgi.input_terminated"))
+        if length > conf.request_body_rewrite_max_size:
+            return True
+        mime = request.mimetype
+        return bool(mime) and not (
+            is_mime_represents_text(mime, conf.text_like_mime_types) or mime in REWRITABLE_FORM_MIMES
+        )
+
     def try_decode_request_data(self):
         """
         解析出浏览者发送过来的data, 如果是文本, 则进行重写
         如果是文本, 则对文本内容进行重写后返回str
         如果是二进制则, 则原样返回, 不进行任何处理 (bytes)
-        :rtype: Union[str, bytes, None]
+        大的或二进制的请求体不会被读取, 返回一个 StreamedRequestBody, 见 is_request_data_streamable()
+        :rtype: Tuple[Union[str, bytes, StreamedRequestBody, None], Union[str, None]]
         """
+        if self.is_request_data_streamable():
+            data = StreamedRequestBody(request.stream, request.content_length)
+            logger.debug("RequestBodyStreamed", request.mimetype, request.content_length, v=4)
+            self.parse.set_request_data(data, None)
+            return data, None
+
         data: bytes = request.get_data()  # type: bytes
 
         # 尝试解析浏览器传入的东西的编码
-        encoding = self.G.encoding_detect(data)
+        #   严格模式: 解码失败, data是二进制内容或无法理解的编码, 原样返回, 不进行重写
+        data_str, encoding = self.G.charset_detector.decode(data, request.content_type, errors="strict")
 
         if encoding is not None:
-            try:
-                data_str = data.decode(encoding=encoding)  # type: str
-            except:
-                # 解码失败, data是二进制内容或无法理解的编码, 原样返回, 不进行重写
-                encoding = None
-            else:
-                # data是文本内容, 则进行重写, 并返回str
-                data_str = self.G.client_requests_text_rewrite(data_str)  # type: str
-
-        # 下面这个if是debug用代码, 对正常运行无任何作用
-        if conf.developer_string_trace:  # coverage: exclude
-            if isinstance(data, str):
-                data = data.encode(encoding=encoding)
-            if conf.developer_string_trace.encode(encoding=encoding) in data:
+            # data是文本内容, 则进行重写, 并返回str
+            data = self.G.client_request_body_rewrite(data_str, request.mimetype)  # type: str
+
+            # 下面这个if是debug用代码, 对正常运行无任何作用
+            if conf.developer_string_trace and conf.developer_string_trace in data:  # coverage: exclude
                 logger.info(
-                    "StringTrace: appears after client_requests_bin_rewrite, code line no. ",
+                    "StringTrace: appears after client_request_body_rewrite, code line no. ",
                     current_line_number(),
                 )
 
-        self.parse.request_data, self.parse.request_data_encoding = data, encoding
+        self.parse.set_request_data(data, encoding)
         return data, encoding
 
     def send_request(self, url, method="GET", headers=None, param_get=None, data=None):
@@ -59,40 +140,69 @@ class RequestSender:
         final_hostname = urlsplit(url).netloc
         logger.debug("FinalRequestUrl", url, "FinalHostname", final_hostname)
         # Only external in-zone domains are allowed (SSRF check layer 2)
-        if final_hostname not in conf.allowed_domains and not conf.developer_disable_ssrf_check:
+        if final_hostname not in self.G.domain_index and not conf.developer_disable_ssrf_check:
             raise ConnectionAbortedError(
                 "Trying to access an OUT-OF-ZONE domain(SSRF Layer 2):", final_hostname
             )
 
+        # 如果该域名持续失败, 熔断器会打开, 此时直接失败, 不再占用线程去等待超时
+        if conf.circuit_breaker_enable:
+            breaker = get_breaker(
+                final_hostname, conf.circuit_breaker_failure_threshold, conf.circuit_breaker_recovery_time
+            )
+            if not breaker.allow_request():
+                raise CircuitOpenError(final_hostname, breaker.retry_after())
+        else:
+            breaker = None
+
         # set zero data to None instead of b''
         if not data:
             data = None
 
-        prepared_req = requests.Request(
-            method,
-            url,
-            headers=headers,
-            params=param_get,
-            data=data,
-        ).prepare()
-
-        # get session
-        if conf.connection_keep_alive_enable:
-            _session = get_session(final_hostname)
-        else:
-            _session = requests.Session()
-
-        # Send real requests
         self.parse.time["req_start_time"] = time()
-        r = _session.send(
-            prepared_req,
-            proxies=conf.proxy_settings if conf.is_use_proxy else None,
-            allow_redirects=False,  # disable redirect
-            stream=conf.stream_transfer_enable,
-            verify=not conf.developer_disable_ssl_verify,
-        )
+        try:
+            prepared_req = requests.Request(
+                method,
+                url,
+                headers=headers,
+                params=param_get,
+                data=data,
+            ).prepare()
+
+            # get session
+            if conf.connection_keep_alive_enable:
+                _session = get_session(final_hostname)
+            else:
+                _session = create_session()
+
+            # Send real requests
+            r = _session.send(
+                prepared_req,
+                proxies=conf.proxy_settings if conf.is_use_proxy else None,
+                allow_redirects=False,  # disable redirect
+                # 总是以stream模式请求, 响应体在之后才被读取,
+                #   这样二进制响应可以以远程服务器的原始(压缩)形式透传给浏览器
+                stream=True,
+                verify=not conf.developer_disable_ssl_verify,
+                timeout=(conf.remote_connect_timeout, conf.remote_read_timeout),
+            )
+        except requests.RequestException:
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        except BaseException:
+            # 与远程服务器无关的错误(比如读取浏览器上传的请求体时浏览器断开), 不计入失败
+            if breaker is not None:
+                breaker.record_aborted()
+            raise
+        if breaker is not None:
+            if r.status_code in (502, 503, 504):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
         # remote request time
         self.parse.time["req_time_header"] = time() - self.parse.time["req_start_time"]
+        metrics.observe_stage("upstream_ttfb", self.parse.time["req_time_header"])
         logger.debug("RequestTime:", self.parse.time["req_time_header"], v=4)
 
         # Some debug output
@@ -106,19 +216,28 @@ class RequestSender:
 
         return r
 
+    def get_request_data_to_send(self):
+        """
+        :rtype: Union[bytes, StreamedRequestBody, Iterator[bytes], None]
+        """
+        data = self.parse.request_data_encoded
+        if isinstance(data, StreamedRequestBody):
+            return data.as_request_data()
+        return data
+
     def request_remote_site(self):
         """
         请求远程服务器(high-level), 并在返回404/500时进行 domain_guess 尝试
         """
 
-        self.parse.request_data, self.parse.request_data_encoding = self.try_decode_request_data()
+        self.try_decode_request_data()
         # 请求被镜像的网站
         # 注意: 在zmirror内部不会处理重定向, 重定向响应会原样返回给浏览器
         self.parse.remote_response = self.send_request(
             self.parse.remote_url,
             method=request.method,
             headers=self.parse.client_header,
-            data=self.parse.request_data_encoded,
+            data=self.get_request_data_to_send(),
         )
 
         if self.parse.remote_response.url != self.parse.remote_url:
@@ -1,18 +1,32 @@
 import re
+import threading
 import traceback
 from collections import Counter
+from functools import lru_cache
+from time import sleep
 from urllib.parse import urlsplit
 
 from flask import request
 
 from configuration import Config
-from utils.ColorfulPyPrint import ColorfulPrinter
 from utils.util import current_line_number, get_group
 
-from .threadlocal import ZmirrorThreadLocal
+from . import connection_pool, dns_cache, errors, header_pipeline, metrics, stream_control
+from .access_log import AccessLogWriter
+from .charset_detect import CharsetDetector
+from .cookie_rewrite import SetCookieRewriter
+from .domain_index import DomainIndex
+from .domain_whitelist import AutoDomainWhitelist
+from .pattern_registry import PatternRegistry
+from .request_body_rewrite import RequestBodyRewriter
+from .request_context import RequestContext
+from .structured_log import StructuredLogger
+from .url_mapping import UrlMapper
 
 conf = Config(conf_path="config.py")
-logger = ColorfulPrinter(conf.verbose_level)
+logger = StructuredLogger(
+    conf.verbose_level, conf.log_format, conf.log_file, conf.log_debug_sample_rate, conf.log_queue_size
+)
 
 
 class Shares:
@@ -21,16 +35,50 @@ class Shares:
     and contains some commonly used functions
     """
 
+    _prewarm_thread = None  # type: threading.Thread
+
     def __init__(self) -> None:
         self.logger = logger
-        self.recent_domains = {}  # type: dict[str, bool]
+        self.recent_domains = Counter()  # type: Counter[str]
         self.conf = conf
 
         # do some preparation
         self.prepare()
 
     def prepare(self):
+        # 自动域名白名单, 之前学习到的域名在启动时就加入 `allowed_domains`
+        self.auto_whitelist = None  # type: AutoDomainWhitelist
+        self._domains_lock = threading.Lock()
+        if conf.automatic_domains_whitelist_enable and conf.domains_whitelist_auto_add_glob_list:
+            self.auto_whitelist = AutoDomainWhitelist(
+                conf.domains_whitelist_auto_add_glob_list,
+                conf.automatic_domains_whitelist_max_size,
+                conf.automatic_domains_whitelist_file,
+            )
+            for domain in self.auto_whitelist.load():
+                self.__add_allowed_domain(domain)
+        # 每个域名的分类(主域名/外部域名, scheme, 镜像路径前缀), 见 domain_index
+        self.domain_index = DomainIndex(conf)
         self.__precompile_regex()
+        self.request_header_table = header_pipeline.build_request_header_table(conf)
+        self.response_header_table = header_pipeline.build_response_header_table(conf)
+        self.cookie_rewriter = SetCookieRewriter(
+            conf.my_host_name, conf.my_scheme == "http://", conf.aggressive_cookies_rewrite
+        )
+        # 自己进行编码检测, 因为 requests 内置的编码检测在天朝GBK面前非常弱鸡
+        self.charset_detector = CharsetDetector(
+            conf.force_decode_with_charsets, conf.possible_charsets, conf.charset_detect_prefix_size
+        )
+        # 请求头的重写结果, 同一个浏览器的 cookie referer 等会反复出现
+        self.__cached_requests_text_rewrite = lru_cache(maxsize=conf.request_rewrite_cache_size)(
+            self.__requests_text_rewrite
+        )
+        # 镜像url与远程url的相互转换, 见 decode_mirror_url() 和 encode_mirror_url()
+        self.url_mapper = UrlMapper(conf, self.domain_index, conf.url_mapping_cache_size)
+        # 请求体按 Content-Type 只重写含有本站域名的字段/字符串
+        self.request_body_rewriter = RequestBodyRewriter(
+            self.my_host_name_literals, self.is_requests_text_need_rewrite, self.__requests_text_rewrite
+        )
 
         if conf.custom_text_rewriter_enable:
             try:
@@ -45,21 +93,128 @@ class Shares:
 
         if conf.local_cache_enable:
             try:
-                from .cache_system import FileCache, get_expire_from_mime
+                from .cache_system import FileCache, RangeFetchRegistry, get_expire_from_mime
 
-                self.cache = FileCache()
+                self.cache = FileCache(
+                    max_stream_size=conf.local_cache_max_stream_size, max_disk_size=conf.local_cache_max_disk_size
+                )
+                self.range_fetches = RangeFetchRegistry(timeout=conf.remote_read_timeout)
                 self.get_expire_from_mime = get_expire_from_mime
             except:  # coverage: exclude
                 traceback.print_exc()
                 logger.error("Can Not Create Local File Cache, local file cache is disabled automatically.")
                 conf.local_cache_enable = False
 
+        self.access_log = None  # type: Union[AccessLogWriter, None]
+        if conf.access_log_enable:
+            self.access_log = AccessLogWriter(
+                conf.access_log_path,
+                max_bytes=conf.access_log_max_bytes,
+                backup_count=conf.access_log_backup_count,
+                flush_interval=conf.access_log_flush_interval,
+            )
+
+        connection_pool.set_max_retries(conf.remote_retry_count)
+        errors.snapshot_limiter.configure(conf.error_snapshot_max_per_minute, conf.error_snapshot_sample_rate)
+        stream_control.executor.configure(conf.stream_preload_max_workers)
+        metrics.enabled = conf.metrics_enable
+        if conf.metrics_enable:
+            metrics.install_connect_timer()
+
+        if conf.dns_cache_enable:
+            dns_cache.install(conf.allowed_domains, ttl=conf.dns_cache_ttl)
+
+        if conf.connection_prewarm_enable and Shares._prewarm_thread is None:
+            # 预热线程全局只需要一个
+            Shares._prewarm_thread = threading.Thread(target=self.__connection_prewarm_loop, daemon=True)
+            Shares._prewarm_thread.start()
+
+    def __connection_prewarm_loop(self):
+        """
+        预热线程, 启动时以及每隔 `connection_prewarm_interval` 秒,
+        预热一次到常用域名的连接, 并清理过期的session
+        """
+        while True:
+            try:
+                if conf.dns_cache_enable:
+                    dns_cache.refresh()
+                connection_pool.clear()
+                self.prewarm_connections()
+            except:  # coverage: exclude
+                traceback.print_exc()
+            sleep(conf.connection_prewarm_interval)
+
+    def get_prewarm_domains(self):
+        """
+        需要预热的域名列表, 主域名始终在第一位, 其余的外部域名按最近的使用次数排序
+        :rtype: list[str]
+        """
+        domains = [conf.target_domain]
+        for domain, _ in self.recent_domains.most_common():
+            if domain not in domains and domain in self.domain_index:
+                domains.append(domain)
+        for domain in conf.external_domains:
+            if domain not in domains:
+                domains.append(domain)
+        return domains[: conf.connection_prewarm_max_domains]
+
+    def prewarm_connections(self):
+        """解析并建立到常用域名的 keep-alive 连接"""
+        for domain in self.get_prewarm_domains():
+            info = self.domain_index.get(domain)
+            scheme = info.scheme if info is not None else conf.target_scheme
+            if conf.dns_cache_enable:
+                # 端口需要与之后实际连接时的一致, 才能命中缓存
+                dns_cache.resolve(domain, 443 if scheme == "https://" else 80)
+            is_ok = connection_pool.prewarm(
+                domain,
+                scheme + domain + "/",
+                proxies=conf.proxy_settings if conf.is_use_proxy else None,
+                verify=not conf.developer_disable_ssl_verify,
+                timeout=10,
+            )
+            logger.debug("ConnectionPrewarm", domain, "ok" if is_ok else "failed", v=4)
+
+    def try_auto_add_domain(self, domain):
+        """
+        v0.19.0+ Automatic Domains Whitelist
+        响应中出现的不在 `allowed_domains` 中的域名, 如果匹配 `domains_whitelist_auto_add_glob_list`, 则加入白名单
+        只更新受影响的部分: 域名索引会被复制一份并加入这个域名, 只有出现了新的顶级域名时才重新编译 basic_url 正则
+        :param domain: 小写的域名, 可以带端口
+        :type domain: str
+        :return: 是否加入了白名单
+        :rtype: bool
+        """
+        whitelist = self.auto_whitelist
+        if whitelist is None:
+            return False
+        if not whitelist.add(domain):
+            if whitelist.dropped == 1:
+                logger.warn("AutoWhitelist", "is full, no more domains would be added. first ignored:", domain)
+            return False
+
+        with self._domains_lock:
+            self.__add_allowed_domain(domain)
+            self.domain_index = self.domain_index.with_domains([domain])
+            self.url_mapper.set_domain_index(self.domain_index)
+            self.__add_basic_url_tld(domain)
+        if conf.dns_cache_enable:
+            dns_cache.install([domain], ttl=conf.dns_cache_ttl)
+        logger.info("AutoWhitelist", "domain added:", domain)
+        return True
+
+    def __add_allowed_domain(self, domain):
+        if domain not in conf.allowed_domains:
+            conf.allowed_domains.add(domain)
+        if domain not in conf.external_domains:
+            conf.external_domains.append(domain)
+
     def is_external_domain(self, domain):
         """
         check if a domain is external domain,
         all domains not in target_domain_alias are considered as external domain
         """
-        return domain not in conf.target_domain_alias
+        return self.domain_index.is_external(domain)
 
     def __precompile_regex(self) -> dict[str, re.Pattern]:
         """
@@ -78,6 +233,14 @@ class Shares:
         # %2522 %2527 %255C%2522 %255C%2527
         # &quot;
         REGEX_QUOTE = r"""(?:\\*["']|%(?:(?:25)?5[Cc]%)*2(?:52)?[27]|&quot;)"""
+        self.re_consts = {
+            "COLON": REGEX_COLON,
+            "SLASH": REGEX_SLASH,
+            "QUOTE": REGEX_QUOTE,
+        }
+
+        # 本镜像域名的字面值, 用于在正则之前快速判断, 见 is_requests_text_need_rewrite()
+        self.my_host_name_literals = tuple({conf.my_host_name, conf.my_host_name_with_port})
 
         # 代表本镜像域名的正则
         if conf.my_port is not None:
@@ -125,31 +288,9 @@ class Shares:
         #     suffix_slash: // or / or None
 
         # 统计各个顶级域名(tld)出现的频率, 并且按照出现频率降序排列, 有助于提升正则效率
-        tld_freq = Counter(re.escape(x.split(".")[-1]) for x in conf.allowed_domains)
-        all_remote_tld = sorted(list(tld_freq.keys()), key=lambda tld: tld_freq[tld], reverse=True)
-        re_all_remote_tld = "(?:" + "|".join(all_remote_tld) + ")"
-
-        re_scheme = r"""(?:https?(?P<colon>{REGEX_COLON}))?""".format(
-            REGEX_COLON=REGEX_COLON
-        )  # http(s): or nothing(note the ? at the end)
-        re_scheme_slash = r"""(?P<scheme_slash>{SLASH})(?P=scheme_slash)""".format(SLASH=REGEX_SLASH)  # //
-        re_quote = r"""(?P<quote>{REGEX_QUOTE})""".format(REGEX_QUOTE=REGEX_QUOTE)
-        re_domain = r"""(?P<domain>([a-zA-Z0-9-]+\.){1,5}%s)\b""" % re_all_remote_tld
-        # explain: (?(name)yes-pattern|no-pattern)
-        #  if the group with given name matched, then use yes-pattern, else use no-pattern, and if no-pattern is omitted, then use empty string
-        re_suffix_slash = r"""(?P<suffix_slash>(?(scheme_slash)(?P=scheme_slash)|{SLASH}))?""".format(
-            SLASH=REGEX_SLASH
-        )  # suffix slash is optional(not the ? at the end)
-        # right quote (if we have left quote)
-        re_right_quote = r"""(?(quote)(?P=quote))"""
-
-        regex_basic_url_pattern: re.Pattern = re.compile(
-            f"(?:{re_scheme}{re_scheme_slash}|{re_quote}){re_domain}{re_suffix_slash}{re_right_quote}"
-        )
-
-        # Response Cookies Rewriter, see response_cookie_rewrite()
-        regex_cookie_pattern = re.compile(r"\bdomain=(\.?([\w-]+\.)+\w+)\b", flags=re.IGNORECASE)
-        regex_cookie_path_pattern = re.compile(r"(?P<prefix>[pP]ath)=(?P<path>[\w\._/-]+?;)")
+        #   自动白名单加入新的域名时, 只有出现了新的顶级域名才需要重新编译, 见 __add_basic_url_tld()
+        self.__basic_url_tld_freq = Counter(re.escape(x.split(".")[-1]) for x in conf.allowed_domains)
+        regex_basic_url_pattern = self.__compile_basic_url_pattern(self.__basic_url_tld_freq)
 
         # Request Domains Rewriter, see client_requests_text_rewrite()
         # 该正则用于匹配类似于下面的东西
@@ -191,21 +332,74 @@ class Shares:
         # 用于移除掉cookie中类似于 zmirror_verify=75bf23086a541e1f; 的部分
         regex_zmirror_verify_header_pattern = re.compile(r"""zmirror_verify=[a-zA-Z0-9]+\b;? ?""")
 
-        # assemble these regex patterns into a dict
-        self.re_patterns: dict[str, re.Pattern] = {
-            "basic_url": regex_basic_url_pattern,  # 用于匹配url的正则表达式, 不含路径和query param
-            "url": regex_adv_url_pattern,
-            "main_domain": regex_main_domain_pattern,
-            "ext_domains": regex_extdomains_pattern,
-            "cookie": regex_cookie_pattern,
-            "cookie_path": regex_cookie_path_pattern,
-            "verify_header": regex_zmirror_verify_header_pattern,
-        }
-        self.re_consts = {
-            "COLON": REGEX_COLON,
-            "SLASH": REGEX_SLASH,
-            "QUOTE": REGEX_QUOTE,
-        }
+        # assemble these regex patterns into a registry, 域名改变时在后台重新编译, 见 pattern_registry
+        self.re_patterns = PatternRegistry(
+            {
+                "basic_url": regex_basic_url_pattern,  # 用于匹配url的正则表达式, 不含路径和query param
+                "url": regex_adv_url_pattern,
+                "main_domain": regex_main_domain_pattern,
+                "ext_domains": regex_extdomains_pattern,
+                "verify_header": regex_zmirror_verify_header_pattern,
+            },
+            budget=conf.pattern_rebuild_budget,
+            on_rebuilt=self.__on_patterns_rebuilt,
+        )
+
+    def __compile_basic_url_pattern(self, tld_freq):
+        """
+        basic_url 正则, 用于匹配响应文本中的url(不含路径和query param)
+        :param tld_freq: 各个顶级域名(已经过re.escape)出现的次数
+        :type tld_freq: Counter[str]
+        :rtype: re.Pattern
+        """
+        REGEX_COLON = self.re_consts["COLON"]
+        REGEX_SLASH = self.re_consts["SLASH"]
+        REGEX_QUOTE = self.re_consts["QUOTE"]
+        all_remote_tld = sorted(list(tld_freq.keys()), key=lambda tld: tld_freq[tld], reverse=True)
+        re_all_remote_tld = "(?:" + "|".join(all_remote_tld) + ")"
+
+        re_scheme = r"""(?:https?(?P<colon>{REGEX_COLON}))?""".format(
+            REGEX_COLON=REGEX_COLON
+        )  # http(s): or nothing(note the ? at the end)
+        re_scheme_slash = r"""(?P<scheme_slash>{SLASH})(?P=scheme_slash)""".format(SLASH=REGEX_SLASH)  # //
+        re_quote = r"""(?P<quote>{REGEX_QUOTE})""".format(REGEX_QUOTE=REGEX_QUOTE)
+        re_domain = r"""(?P<domain>([a-zA-Z0-9-]+\.){1,5}%s)\b""" % re_all_remote_tld
+        # explain: (?(name)yes-pattern|no-pattern)
+        #  if the group with given name matched, then use yes-pattern, else use no-pattern, and if no-pattern is omitted, then use empty string
+        re_suffix_slash = r"""(?P<suffix_slash>(?(scheme_slash)(?P=scheme_slash)|{SLASH}))?""".format(
+            SLASH=REGEX_SLASH
+        )  # suffix slash is optional(not the ? at the end)
+        # right quote (if we have left quote)
+        re_right_quote = r"""(?(quote)(?P=quote))"""
+
+        return re.compile(
+            f"(?:{re_scheme}{re_scheme_slash}|{re_quote}){re_domain}{re_suffix_slash}{re_right_quote}"
+        )
+
+    def __add_basic_url_tld(self, domain):
+        """
+        新加入的域名的顶级域名如果已经在 basic_url 正则中, 则不需要做任何事,
+            否则只登记 basic_url 这一个正则在后台重新编译, 编译完成前继续使用旧的正则
+        :type domain: str
+        """
+        tld = re.escape(domain.split(".")[-1])
+        is_new_tld = tld not in self.__basic_url_tld_freq
+        self.__basic_url_tld_freq[tld] += 1
+        if is_new_tld:
+            self.re_patterns.rebuild(
+                "basic_url", self.__compile_basic_url_pattern, Counter(self.__basic_url_tld_freq)
+            )
+            logger.debug("AutoWhitelist", "basic_url pattern rebuild scheduled for new tld:", tld, v=4)
+
+    def __on_patterns_rebuilt(self, version, costs):
+        logger.debug(
+            "PatternRegistry",
+            "version",
+            version,
+            "rebuilt:",
+            ", ".join("%s %.1fms" % (name, cost * 1000) for name, cost in costs.items()),
+            v=4,
+        )
 
     def extract_path_and_query(self, full_url=None, no_query=False):
         """
@@ -225,40 +419,21 @@ class Shares:
             result += "?" + split.query
         return result
 
-    def encoding_detect(self, byte_content: bytes):
+    def is_target_domain_use_https(self, domain):
+        """请求目标域名时是否使用https, 即 `force_https_domains`"""
+        return self.domain_index.use_https(domain)
+
+    def is_requests_text_need_rewrite(self, raw_text):
         """
-        试图解析并返回二进制串的编码, 如果失败, 则返回 None
-        :param byte_content: 待解码的二进制串
-        :type byte_content: bytes
-        :return: 编码类型或None
-        :rtype: Union[str, None]
+        只有含有本站域名或 extdomains 的文本才可能需要重写, 大部分请求头(如 Accept)和请求体都不含有
+        与 client_requests_text_rewrite() 中的正则完全对应: 本站域名的正则区分大小写, extdomains 的不区分
+        :type raw_text: str
+        :rtype: bool
         """
-
-        if conf.force_decode_with_charsets is not None:
-            return conf.force_decode_with_charsets
-        if conf.possible_charsets:
-            for charset in conf.possible_charsets:
-                try:
-                    byte_content.decode(encoding=charset)
-                except:
-                    pass
-                else:
-                    return charset
-        # if cchardet_available:  # detect the encoding using cchardet (if we have)
-        #     return c_chardet(byte_content)["encoding"]
-
-        return None
-
-    def is_target_domain_use_https(self, domain):
-        """请求目标域名时是否使用https"""
-        if conf.force_https_domains == "NONE" or conf.force_https_domains is None:
-            return False
-        if conf.force_https_domains == "ALL":
-            return True
-        if domain in conf.force_https_domains:
-            return True
-        else:
-            return False
+        for host_name in self.my_host_name_literals:
+            if host_name in raw_text:
+                return True
+        return "extdomains" in raw_text.lower()
 
     def client_requests_text_rewrite(self, raw_text):
         """
@@ -274,6 +449,38 @@ class Shares:
         :type raw_text: str
         :rtype: str
         """
+        if not self.is_requests_text_need_rewrite(raw_text):
+            return raw_text
+        return self.__requests_text_rewrite(raw_text)
+
+    def client_request_header_rewrite(self, name, value):
+        """
+        重写一个浏览器请求头的值, `request_rewrite_skip_headers` 中的请求头原样返回, 其余的重写结果会被缓存
+        :param name: 小写的请求头名称
+        :type name: str
+        :type value: str
+        :rtype: str
+        """
+        if name in conf.request_rewrite_skip_headers or not self.is_requests_text_need_rewrite(value):
+            return value
+        return self.__cached_requests_text_rewrite(value)
+
+    def client_request_body_rewrite(self, raw_text, mime):
+        """
+        重写浏览器的请求体, 表单和JSON只重写含有本站域名的部分, 其他类型与 client_requests_text_rewrite() 相同
+        :type raw_text: str
+        :param mime: 请求体的MIME, 如 "application/json"
+        :type mime: str
+        :rtype: str
+        """
+        return self.request_body_rewriter.rewrite(raw_text, mime)
+
+    def __requests_text_rewrite(self, raw_text):
+        """
+        client_requests_text_rewrite() 的正则替换部分
+        :type raw_text: str
+        :rtype: str
+        """
 
         def replace_to_real_domain(match_obj: re.Match):
             scheme = get_group("scheme", match_obj)  # type: str
@@ -317,7 +524,7 @@ class Shares:
 
 
 class Base:
-    def __init__(self, parse: ZmirrorThreadLocal, shares: Shares) -> None:
+    def __init__(self, parse: RequestContext, shares: Shares) -> None:
         self.parse = parse
         self.G = shares
 
@@ -0,0 +1,333 @@
+# coding=utf-8
+"""
+本模块为stream模式的异步预读提供流量控制
+
+    StreamBuffer: 预读线程和发送给浏览器的生成器之间的有界缓冲区,
+        缓冲区满时预读线程阻塞, 不再从远程读取(背压), 浏览器断开时可以立即唤醒并停止预读线程
+    AdaptiveChunkSize: 根据观察到的吞吐量调整每次从远程读取的块大小,
+        远程和浏览器都很快时逐渐增大, 任意一方变慢时减小
+    StreamStats: 每个stream的吞吐量统计, 见 get_stream_stats(), 可以在统计页面以json格式获取 (metrics_path?format=json)
+    StreamExecutor: 所有stream共享的有界预读线程池, 线程数量不会随着stream的数量增长
+"""
+import queue
+import threading
+import traceback
+from collections import deque
+from time import time
+
+try:
+    from typing import Dict, List, Union
+except:  # pragma: no cover
+    pass
+
+# 每一块的目标传输时间, 见 AdaptiveChunkSize
+TARGET_CHUNK_SECONDS = 0.05
+
+
+class StreamBuffer:
+    """
+    有界的缓冲区, 单个生产者(预读线程), 单个消费者(发送给浏览器的生成器)
+    与 queue.Queue 的区别是可以被任意一方关闭, 阻塞在另一端的线程会立即被唤醒
+    """
+
+    def __init__(self, max_items):
+        self.max_items = max(1, max_items)
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._eof = False
+        self._error = None  # type: Union[BaseException, None]
+        self.closed = False  # 消费者已经关闭(浏览器断开)
+        self.queued_bytes = 0
+        self.last_put_waited = False  # 最近一次 put() 是否因为缓冲区满而等待过
+
+    def put(self, chunk, timeout=None):
+        """
+        放入一块数据, 缓冲区满时等待
+        :type chunk: bytes
+        :param timeout: 最长等待时间, 超时说明浏览器长时间没有读取
+        :return: 是否成功, 缓冲区已关闭或超时返回False
+        :rtype: bool
+        """
+        with self._cond:
+            self.last_put_waited = len(self._items) >= self.max_items
+            if not self._cond.wait_for(lambda: self.closed or len(self._items) < self.max_items, timeout):
+                return False
+            if self.closed:
+                return False
+            self._items.append(chunk)
+            self.queued_bytes += len(chunk)
+            self._cond.notify_all()
+            return True
+
+    def put_eof(self):
+        """远程响应已经读完"""
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def put_error(self, error):
+        """预读出错, 消费者在读完已有数据后会收到这个异常"""
+        with self._cond:
+            self._error = error
+            self._eof = True
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        取出一块数据
+        :return: 数据块, 远程响应读完时返回None
+        :rtype: Union[bytes, None]
+        :raises TimeoutError: 超时
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self._eof, timeout):
+                raise TimeoutError("Stream preload timeout")
+            if self._items:
+                chunk = self._items.popleft()
+                self.queued_bytes -= len(chunk)
+                self._cond.notify_all()
+                return chunk
+            if self._error is not None:
+                raise self._error
+            return None
+
+    def close(self):
+        """消费者不再读取, 唤醒并停止生产者"""
+        with self._cond:
+            self.closed = True
+            self._items.clear()
+            self.queued_bytes = 0
+            self._cond.notify_all()
+
+
+class AdaptiveChunkSize:
+    """
+    根据吞吐量调整块大小, 在 minimum 和 maximum 之间按2的倍数变化
+    吞吐量是整条链路的速度, 取决于远程和浏览器中较慢的一方,
+        块大小的目标是大约 TARGET_CHUNK_SECONDS 秒的数据量:
+        快的stream使用大块, 减少每块的开销; 慢的stream使用小块, 降低延迟, 也不会占用太多内存
+    """
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.size = minimum
+        self.rate = 0.0  # 字节/秒, 指数移动平均
+        self._last_time = None
+
+    def update(self, size):
+        """
+        每处理完一块后调用
+        :param size: 这一块的大小
+        :type size: int
+        :return: 新的块大小
+        :rtype: int
+        """
+        now = time()
+        if self._last_time is None:
+            self._last_time = now
+            return self.size
+        rate = size / max(now - self._last_time, 0.000001)
+        self._last_time = now
+        self.rate = rate if not self.rate else self.rate * 0.7 + rate * 0.3
+
+        target = self.rate * TARGET_CHUNK_SECONDS
+        if target >= self.size * 2:
+            self.size = min(self.maximum, self.size * 2)
+        elif target < self.size / 2:
+            self.size = max(self.minimum, self.size // 2)
+        return self.size
+
+
+class StreamStats:
+    """一个stream的统计信息"""
+
+    __slots__ = ("url", "started", "finished", "bytes_in", "bytes_out", "chunk_size", "stalls", "state")
+
+    def __init__(self, url, chunk_size=0):
+        self.url = url
+        self.started = time()
+        self.finished = None  # type: Union[float, None]
+        self.bytes_in = 0  # 从远程读取的字节数
+        self.bytes_out = 0  # 发送给浏览器的字节数
+        self.chunk_size = chunk_size  # 当前的块大小
+        self.stalls = 0  # 因为浏览器跟不上而等待的次数
+        self.state = "streaming"
+
+    def finish(self, state):
+        """
+        :param state: done, aborted(浏览器断开), client-stalled(浏览器长时间不读取), error, timeout
+        :type state: str
+        """
+        if self.finished is not None:
+            return
+        self.finished = time()
+        self.state = state
+        with _stats_lock:
+            _active_streams.pop(id(self), None)
+            _finished_streams.append(self)
+
+    def as_dict(self):
+        """
+        :rtype: Dict[str, Union[str, int, float]]
+        """
+        duration = (self.finished or time()) - self.started + 0.000001
+        return {
+            "url": self.url,
+            "state": self.state,
+            "duration": round(duration, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "speed_in_kbps": round(self.bytes_in / 1024 / duration, 1),
+            "speed_out_kbps": round(self.bytes_out / 1024 / duration, 1),
+            "chunk_size": self.chunk_size,
+            "stalls": self.stalls,
+        }
+
+
+class StreamExecutor:
+    """
+    所有stream共享的预读线程池
+    每个stream的预读任务在结束前会一直占用一个线程, 所以同时预读的stream数量最多为 max_workers,
+        超出的任务会被立即拒绝, 调用者应该退回到不预读的同步传输
+        不设等待队列: 排队的任务要等到某个stream整个传输完才能开始, 而同步传输可以立即开始发送
+    线程按需创建, 创建后一直保留, 供之后的stream复用
+    """
+
+    def __init__(self, max_workers=32):
+        self.max_workers = max_workers
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self.workers = 0  # 已创建的线程数
+        self.idle = 0  # 空闲的线程数
+        self.active = 0  # 正在执行的任务数
+        self.queued = 0  # 已接受, 但还没有被线程取走的任务数 (线程正在启动或者刚被唤醒)
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_seconds = 0.0  # 所有已开始的任务从提交到开始执行的时间总和
+        self.started = 0  # 已开始执行的任务数
+
+    def configure(self, max_workers):
+        """
+        修改线程池的大小, 已经创建的线程不会被回收
+        :type max_workers: int
+        """
+        with self._lock:
+            self.max_workers = max(1, max_workers)
+
+    def submit(self, fn, *args):
+        """
+        提交一个任务
+        :return: 是否被接受, 没有可用的线程(所有线程都在执行任务, 并且不能再创建新的线程)时返回False
+        :rtype: bool
+        """
+        with self._lock:
+            # 每个被接受的任务都有一个空闲的或者新创建的线程, 不会排在其他stream之后
+            if self.active + self.queued >= self.max_workers:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            self.submitted += 1
+            start_worker = self.queued > self.idle and self.workers < self.max_workers
+            if start_worker:
+                self.workers += 1
+        if start_worker:
+            threading.Thread(target=self._worker, daemon=True).start()
+        self._tasks.put((fn, args, time()))
+        return True
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                self.idle += 1
+            fn, args, queued_at = self._tasks.get()
+            with self._lock:
+                self.idle -= 1
+                self.queued -= 1
+                self.active += 1
+                self.wait_seconds += time() - queued_at
+                self.started += 1
+            try:
+                fn(*args)
+            except:  # coverage: exclude
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+    def stats(self):
+        """
+        :rtype: Dict[str, Union[int, float]]
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "workers": self.workers,
+                "active": self.active,
+                "queued": self.queued,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "started": self.started,
+                "wait_seconds": self.wait_seconds,
+            }
+
+
+# 所有stream共享的预读线程池, 大小由 Shares 根据设置调整
+executor = StreamExecutor()
+
+
+def iter_raw_chunks(raw, sizer):
+    """
+    从 urllib3 的原始响应中逐块读取(不解压), 每块的大小为 sizer 当前的值
+    :type raw: urllib3.response.HTTPResponse
+    :type sizer: AdaptiveChunkSize
+    :rtype: Iterator[bytes]
+    """
+    while True:
+        data = raw.read(sizer.size, decode_content=False)
+        if not data:
+            return
+        yield data
+
+
+_active_streams = {}  # type: Dict[int, StreamStats]
+_finished_streams = deque(maxlen=100)  # 最近结束的stream
+_stats_lock = threading.Lock()
+
+
+def register_stream(url, chunk_size=0):
+    """
+    开始统计一个stream, 结束时需要调用 StreamStats.finish()
+    :type url: str
+    :rtype: StreamStats
+    """
+    stats = StreamStats(url, chunk_size)
+    with _stats_lock:
+        _active_streams[id(stats)] = stats
+    return stats
+
+
+def active_stream_count():
+    """
+    :rtype: int
+    """
+    return len(_active_streams)
+
+
+def get_stream_stats():
+    """
+    所有正在进行的, 以及最近结束的stream的统计信息, 以及预读线程池的状态
+    只在访问统计页面的json格式时才会计算, 见 MirrorApp.metrics_page()
+    :rtype: Dict[str, Union[list, dict]]
+    """
+    with _stats_lock:
+        active = list(_active_streams.values())
+        finished = list(_finished_streams)
+    return {
+        "active": [stats.as_dict() for stats in active],
+        "finished": [stats.as_dict() for stats in finished],
+        "executor": executor.stats(),
+    }
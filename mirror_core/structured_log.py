@@ -0,0 +1,247 @@
+# coding=utf-8
+"""
+本模块为热路径上的日志提供低开销的实现, 接口与 ColorfulPrinter 兼容 (debug/info/warn/error/important_print, v=)
+
+    1. 先检查级别: 低于 verbose_level 的日志在第一行就返回, 参数不会被格式化
+        所以 logger.debug("Headers:", request.headers) 在生产环境中只是一次整数比较
+        参数本身的计算(如 stats.as_dict())依然会发生, 开销大的参数请先用 is_enabled_for() 判断
+    2. 异步写入: 调用者只把参数转为字符串(避免之后被修改), 排版和输出由后台线程完成
+        队列满时丢弃日志并计数, 不会阻塞请求线程
+    3. debug 级别(v>=3)的日志可以按比例采样, 见 `log_debug_sample_rate`
+    4. 每条日志带有当前请求的 request id (关联ID), 见 set_request_id()
+
+输出格式 `log_format`:
+    text  与 ColorfulPrinter 相同的彩色文本(输出到终端时)
+    json  每行一个json对象: {"ts", "level", "v", "rid", "thread", "msg", "args"}
+"""
+import atexit
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+from random import random
+from time import localtime, sleep, strftime, time
+
+from utils.ColorfulPyPrint.thirdparty import Fore
+
+try:
+    from typing import List, Tuple, Union
+except:  # pragma: no cover
+    pass
+
+_LEVEL_STYLES = {
+    "info": (Fore.GREEN, "[INFO] "),
+    "debug": (Fore.LIGHTBLUE_EX, "[DEBUG] "),
+    "warn": (Fore.YELLOW, "[WARNING] "),
+    "error": (Fore.RED, "[ERROR] "),
+    "important": (Fore.LIGHTMAGENTA_EX, "[IMPORTANT] "),
+}
+
+_STOP = object()
+
+# ------------- request id -------------
+_local = threading.local()
+_request_id_counter = itertools.count(1)
+_request_id_prefix = "%x" % (int(time()) & 0xFFFFFF)
+
+
+def new_request_id():
+    """
+    生成一个新的 request id, 在进程内唯一
+    :rtype: str
+    """
+    return "%s-%x-%x" % (_request_id_prefix, os.getpid(), next(_request_id_counter))
+
+
+def set_request_id(request_id):
+    """
+    设置当前线程正在处理的请求的id, 之后这个线程输出的日志都会带上它
+    :type request_id: Union[str, None]
+    """
+    _local.request_id = request_id
+
+
+def get_request_id():
+    """
+    :rtype: Union[str, None]
+    """
+    return getattr(_local, "request_id", None)
+
+
+class StructuredLogger:
+    def __init__(self, verbose_level=1, log_format="text", log_file=None, debug_sample_rate=1.0, queue_size=10000):
+        """
+        :param verbose_level: v 小于等于它的日志才会输出, 与 ColorfulPrinter 相同
+        :param log_format: text 或 json
+        :param log_file: 日志文件路径, None 表示 stdout
+        :param debug_sample_rate: v>=3 的日志的采样比例, 1 表示全部输出
+        :param queue_size: 等待写入的日志的最大条数, 超过时丢弃
+        """
+        self.PRINT_VERBOSE_LEVEL = verbose_level
+        self.log_format = log_format
+        self.log_file = log_file
+        self.debug_sample_rate = debug_sample_rate
+        self.dropped = 0  # 因为队列满而丢弃的日志条数
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer = None  # type: Union[threading.Thread, None]
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def set_print_lower_bound(self, verbose_level=1):
+        self.PRINT_VERBOSE_LEVEL = verbose_level
+
+    def get_print_lower_bound(self):
+        return self.PRINT_VERBOSE_LEVEL
+
+    def is_enabled_for(self, v):
+        """
+        v 级别的日志是否会被输出, 用于在计算开销大的日志参数之前判断
+        :type v: int
+        :rtype: bool
+        """
+        return v <= self.PRINT_VERBOSE_LEVEL
+
+    # ------------- 与 ColorfulPrinter 兼容的接口 -------------
+    # 多余的关键字参数(timelevel, is_beep, i)被忽略
+    def important_print(self, output="", *other_inputs, v=0, **kwargs):
+        if v <= self.PRINT_VERBOSE_LEVEL:
+            self._log("important", v, output, other_inputs)
+
+    def error(self, output="", *other_inputs, v=0, **kwargs):
+        if v <= self.PRINT_VERBOSE_LEVEL:
+            self._log("error", v, output, other_inputs)
+
+    def warn(self, output="", *other_inputs, v=1, **kwargs):
+        if v <= self.PRINT_VERBOSE_LEVEL:
+            self._log("warn", v, output, other_inputs)
+
+    def info(self, output="", *other_inputs, v=2, **kwargs):
+        if v <= self.PRINT_VERBOSE_LEVEL:
+            self._log("info", v, output, other_inputs)
+
+    def debug(self, output="", *other_inputs, v=3, **kwargs):
+        if v <= self.PRINT_VERBOSE_LEVEL:
+            self._log("debug", v, output, other_inputs)
+
+    def _log(self, level, v, output, other_inputs):
+        if v >= 3 and self.debug_sample_rate < 1 and random() >= self.debug_sample_rate:
+            return
+        # 在调用者的线程中转为字符串, 参数(如 parse.time)之后可能会被修改
+        record = (
+            time(),
+            level,
+            v,
+            getattr(_local, "request_id", None),
+            threading.current_thread().name,
+            str(output),
+            [str(item) for item in other_inputs],
+        )
+        if self._writer_pid != os.getpid():
+            self._start_writer()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # ------------- 后台写入 -------------
+    def _start_writer(self):
+        with self._writer_lock:
+            pid = os.getpid()
+            if self._writer_pid == pid:
+                return
+            if self._writer_pid is not None:
+                # fork 之后的子进程, 父进程的线程已经不存在了
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._writer = threading.Thread(target=self._write_loop, name="zmirror-log-writer", daemon=True)
+            self._writer.start()
+            self._writer_pid = pid
+
+    def _open_stream(self):
+        if self.log_file:
+            return open(self.log_file, "a", encoding="utf-8")
+        return sys.stdout
+
+    def _write_loop(self):
+        stream = self._open_stream()
+        colorful = self.log_format == "text" and hasattr(stream, "isatty") and stream.isatty()
+        last_second = None
+        time_str = ""
+        reported_dropped = 0
+        while True:
+            record = self._queue.get()
+            if record is _STOP:
+                self._queue.task_done()
+                break
+            taken = 1
+            lines = []
+            if self.dropped != reported_dropped:
+                lines.append(self._format((time(), "warn", 1, None, "zmirror-log-writer",
+                                           "LogRecordsDropped", [str(self.dropped - reported_dropped)]),
+                                          time_str, colorful))
+                reported_dropped = self.dropped
+            while record is not None and record is not _STOP:
+                second = int(record[0])
+                if second != last_second:
+                    last_second = second
+                    time_str = strftime("%Y-%m-%d %H:%M:%S", localtime(second))
+                lines.append(self._format(record, time_str, colorful))
+                # 一次取出所有已经排队的日志, 合并写入
+                try:
+                    record = self._queue.get_nowait()
+                    taken += 1
+                except queue.Empty:
+                    record = None
+            try:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+            except Exception as e:  # coverage: exclude
+                print("LOG WRITE ERROR:", e, file=sys.stderr)
+            for _ in range(taken):
+                self._queue.task_done()
+            if record is _STOP:
+                break
+        if stream is not sys.stdout:
+            stream.close()
+
+    def _format(self, record, time_str, colorful):
+        timestamp, level, v, request_id, thread_name, msg, args = record
+        if self.log_format == "json":
+            return json.dumps(
+                {"ts": round(timestamp, 6), "level": level, "v": v, "rid": request_id,
+                 "thread": thread_name, "msg": msg, "args": args},
+                ensure_ascii=False,
+            )
+        color, section_type = _LEVEL_STYLES[level]
+        text = "[" + time_str + "] " + section_type
+        if request_id is not None:
+            text += "[" + request_id + "] "
+        text += " ".join([msg] + args)
+        if colorful:
+            text = color + text + Fore.RESET
+        return text
+
+    def flush(self, timeout=1.0):
+        """
+        等待已经排队的日志被写入, 最多等待 timeout 秒
+        :return: 是否已经全部写入
+        :rtype: bool
+        """
+        deadline = time() + timeout
+        while self._queue.unfinished_tasks and time() < deadline:
+            sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def close(self):
+        """停止后台线程, 进程退出时自动调用"""
+        if self._writer is None or self._writer_pid != os.getpid():
+            return
+        try:
+            self._queue.put(_STOP, timeout=1)
+        except queue.Full:
+            return
+        self._writer.join(1)
+        self._writer = None
+        self._writer_pid = None
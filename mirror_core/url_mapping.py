@@ -0,0 +1,321 @@
+# coding=utf-8
+"""
+镜像url与远程url之间的相互转换
+
+    远程url --> 镜像url (encode)
+        https://www.target.com/a/b?q=1          --> http://my.mirror.com/a/b?q=1
+        https://ext.foo.com/a/b?q=1#top          --> http://my.mirror.com/extdomains/ext.foo.com/a/b?q=1#top
+    镜像url --> 远程url (decode)
+        /extdomains/ext.foo.com/a/b?q=1          --> (ext.foo.com, /a/b?q=1)
+        /extdomains/https-ext.foo.com/a/b?q=1    --> (ext.foo.com, /a/b?q=1, https), 兼容老版本的形式
+        /a/b?q=1                                 --> (www.target.com, /a/b?q=1)
+
+url使用手写的解析器 split_url() 拆分, 每个url只扫描一次, 不再多次调用 urlsplit() 和 urljoin()
+两个方向的结果都有LRU缓存(大小为 `url_mapping_cache_size`), 同一个页面中的url会反复出现
+    缓存的结果依赖于域名的设置, 域名列表改变后需要调用 UrlMapper.set_domain_index()
+
+除了被规范化的部分(path开头的多个斜线会被合并为一个), 总是满足 decode(encode(url)) == url
+
+正确性检查(随机生成url, 验证上面的等式, 并与旧的 urlsplit()/urljoin() 实现对比)和基准测试:
+    python -m mirror_core.url_mapping [--number 20000]
+"""
+from functools import lru_cache
+
+from utils.util import esc_str, un_esc_str
+
+try:
+    from typing import Dict, Tuple, Union
+    from configuration import Config
+    from .domain_index import DomainIndex
+except:  # pragma: no cover
+    pass
+
+_SCHEME_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+-.")
+
+
+def split_url(url):
+    """
+    与 urllib.parse.urlsplit() 相同地把url拆分为 (scheme, netloc, path, query, fragment),
+        只是不会去除url中的空白字符, scheme 也不会被转换为小写
+    :type url: str
+    :rtype: Tuple[str, str, str, str, str]
+    """
+    scheme = ""
+    colon = url.find(":")
+    if colon > 0 and url[0].isascii() and url[0].isalpha():
+        for char in url[1:colon]:
+            if char not in _SCHEME_CHARS:
+                break
+        else:
+            scheme = url[:colon]
+            url = url[colon + 1 :]
+
+    netloc = ""
+    if url[:2] == "//":
+        end = len(url)
+        for delimiter in "/?#":
+            index = url.find(delimiter, 2)
+            if 0 <= index < end:
+                end = index
+        netloc = url[2:end]
+        url = url[end:]
+
+    url, _, fragment = url.partition("#")
+    path, _, query = url.partition("?")
+    return scheme, netloc, path, query, fragment
+
+
+def path_and_query(path, query):
+    """
+    :type path: str
+    :type query: str
+    :rtype: str
+    """
+    return (path or "/") + ("?" + query if query else "")
+
+
+class UrlMapper:
+    def __init__(self, conf, domain_index, cache_size=4096):
+        """
+        :type conf: Config
+        :param domain_index: 域名的分类, 即 Shares.domain_index
+        :type domain_index: DomainIndex
+        :param cache_size: 每个方向缓存的url的个数, 0 表示不缓存
+        :type cache_size: int
+        """
+        self.conf = conf
+        self.domain_index = domain_index
+        self.cache_size = cache_size
+        self._cached_decode = lru_cache(maxsize=cache_size)(self._decode)
+        self._cached_encode = lru_cache(maxsize=cache_size)(self._encode)
+
+    def set_domain_index(self, domain_index):
+        """
+        域名设置改变后, 使用新的索引, 并清空缓存
+        :type domain_index: DomainIndex
+        """
+        self.domain_index = domain_index
+        self.clear_cache()
+
+    def clear_cache(self):
+        self._cached_decode.cache_clear()
+        self._cached_encode.cache_clear()
+
+    def cache_info(self):
+        """
+        :rtype: Dict[str, object]
+        """
+        return {"decode": self._cached_decode.cache_info(), "encode": self._cached_encode.cache_info()}
+
+    # ------------- 镜像url --> 远程url -------------
+    def decode(self, mirror_path_query):
+        """
+        解析镜像url的 path+query 部分(可能含有extdomains), 得到远程url的信息
+        :param mirror_path_query: 如 "/extdomains/ext.foo.com/a/b?q=1"
+        :type mirror_path_query: str
+        :return: (远程域名, 是否https, 远程path, 远程path+query)
+        :rtype: Tuple[str, bool, str, str]
+        """
+        return self._cached_decode(mirror_path_query)
+
+    def decode_url(self, mirror_url):
+        """
+        与 decode() 相同, 但是参数可以是完整的url, 并且支持json (处理 \\/ 和 \\. 的转义)
+        :type mirror_url: str
+        :rtype: Tuple[str, bool, str, str]
+        """
+        escaped_slash = r"\/" in mirror_url
+        if escaped_slash:  # 如果 \/ 在url中, 先反转义, 处理完后再转义回来
+            mirror_url = mirror_url.replace(r"\/", "/")
+        escaped_dot = r"\." in mirror_url
+        if escaped_dot:  # 如果 \. 在url中, 先反转义, 处理完后再转义回来
+            mirror_url = mirror_url.replace(r"\.", ".")
+
+        if mirror_url[:1] != "/" or mirror_url[:2] == "//" or "#" in mirror_url:
+            _, _, path, query, _ = split_url(mirror_url)
+            mirror_url = path_and_query(path, query)
+        domain, is_https, path, real_path_query = self._cached_decode(mirror_url)
+
+        if escaped_dot or escaped_slash:
+            if escaped_dot:
+                real_path_query = real_path_query.replace(".", r"\.")
+            if escaped_slash:
+                real_path_query = esc_str(real_path_query)
+            path = real_path_query.partition("?")[0]
+        return domain, is_https, path, real_path_query
+
+    def _decode(self, mirror_path_query):
+        if mirror_path_query[:12] != "/extdomains/":
+            return (
+                self.conf.target_domain,
+                self.conf.target_scheme == "https://",
+                mirror_path_query.partition("?")[0],
+                mirror_path_query,
+            )
+
+        # 12 == len('/extdomains/')
+        rest = mirror_path_query[12:].lstrip("/")
+        end = len(rest)
+        for delimiter in "/?#":
+            index = rest.find(delimiter)
+            if 0 <= index < end:
+                end = index
+        domain = rest[:end]
+        path, _, query = rest[end:].partition("#")[0].partition("?")
+
+        if domain[:6] == "https-":
+            # 如果显式指定了 /extdomains/https-域名 形式(为了兼容老版本)的, 那么使用https
+            domain = domain[6:]
+            is_https = True
+        else:
+            # 如果是 /extdomains/域名 形式, 没有 "https-" 那么根据域名判断是否使用HTTPS
+            is_https = self.domain_index.use_https(domain)
+        return domain, is_https, path or "/", path_and_query(path, query)
+
+    # ------------- 远程url --> 镜像url -------------
+    def encode(self, remote_url, remote_domain=None, default_domain=None, has_scheme=True, escaped=False):
+        """
+        把远程url转换为镜像url, 不在 `allowed_domains` 中的url原样返回
+        :param remote_url: 远程url, 可以是完整的url, 也可以只有path(此时使用 default_domain)
+        :type remote_url: str
+        :param remote_domain: 不为None时, 总是使用这个域名, 忽略url中的域名
+        :type remote_domain: Union[str, None]
+        :param default_domain: url中没有域名时使用的域名, 通常为当前请求的远程域名
+        :type default_domain: Union[str, None]
+        :param has_scheme: 为False时只生成 path+query 部分
+        :type has_scheme: bool
+        :param escaped: url中的斜线是否被转义为 \\/ (比如在json中)
+        :type escaped: bool
+        :rtype: str
+        """
+        return self._cached_encode(remote_url, remote_domain, default_domain, has_scheme, escaped)
+
+    def _encode(self, remote_url, remote_domain, default_domain, has_scheme, escaped):
+        conf = self.conf
+        unesc_remote_url = un_esc_str(remote_url) if escaped else remote_url
+        scheme, netloc, path, query, fragment = split_url(unesc_remote_url)
+
+        if path[:12] == "/extdomains/":
+            return remote_url
+
+        domain = remote_domain or netloc or default_domain or conf.target_domain
+        domain_info = self.domain_index.get(domain)
+        if domain_info is None:
+            return remote_url
+
+        if not has_scheme:
+            scheme_host = ""
+        elif unesc_remote_url[:2] == "//":
+            scheme_host = "//" + conf.my_host_name
+        elif scheme:
+            scheme_host = conf.my_scheme_and_host
+        else:
+            scheme_host = ""
+
+        # 相对路径也视为从根目录开始, 开头的多个斜线只保留一个, 否则会被当作 //域名
+        mirror_url = scheme_host + domain_info.mirror_prefix + "/" + path_and_query(path, query).lstrip("/")
+        if fragment:
+            mirror_url += "#" + fragment
+
+        if escaped:
+            mirror_url = esc_str(mirror_url)
+        return mirror_url
+
+
+# ------------- 正确性检查和基准测试 -------------
+def _old_encode(conf, remote_url, default_domain):
+    """
+    之前基于 urlsplit()/urljoin() 的实现, 用于对比
+    """
+    from urllib.parse import urljoin, urlsplit
+
+    splited = urlsplit(remote_url)
+    if "/extdomains/" == splited.path[:12]:
+        return remote_url
+    domain = splited.netloc or default_domain
+    if domain not in conf.allowed_domains:
+        return remote_url
+    if "//" == remote_url[:2]:
+        scheme_host = "//" + conf.my_host_name
+    elif splited.scheme:
+        scheme_host = conf.my_scheme_and_host
+    else:
+        scheme_host = ""
+    middle_part = "/extdomains/" + domain if domain not in conf.target_domain_alias else ""
+    mirror_url = urljoin(scheme_host + middle_part + "/", path_and_query(splited.path, splited.query).strip("/"))
+    return mirror_url + ("#" + splited.fragment if splited.fragment else "")
+
+
+def main(argv=None):
+    import argparse
+    import random
+    import timeit
+    from urllib.parse import urlsplit
+
+    from .shares import Shares, conf
+
+    parser = argparse.ArgumentParser(description="Check and measure the mirror url mapping")
+    parser.add_argument("--number", type=int, default=20000, help="number of random urls")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    G = Shares()
+    G.logger.set_print_lower_bound(1)
+    mapper = UrlMapper(conf, G.domain_index, cache_size=0)
+    rnd = random.Random(args.seed)
+    domains = sorted(conf.allowed_domains)
+    segments = ["a", "b.html", "%E4%B8%AD", "x-y_z", "1.2", "~u", "a:b", "@", "..", ""]
+
+    def random_url():
+        path = "/" + "/".join(rnd.choice(segments) for _ in range(rnd.randint(0, 4)))
+        query = "&".join("k%d=%s" % (i, rnd.choice(segments)) for i in range(rnd.randint(0, 3)))
+        return (
+            rnd.choice(["http://", "https://", "//"])
+            + rnd.choice(domains)
+            + path
+            + ("?" + query if query else "")
+            + rnd.choice(["", "", "#top", "#a/b"])
+        )
+
+    urls = [random_url() for _ in range(args.number)]
+    differs = 0
+    for url in urls:
+        split = urlsplit(url)
+        assert split_url(url) == (split.scheme, split.netloc, split.path, split.query, split.fragment), url
+        # path开头的多个斜线会被合并为一个
+        expected = "/" + path_and_query(split.path, split.query).lstrip("/")
+        for escaped in (False, True):
+            remote_url = esc_str(url) if escaped else url
+            mirror_url = mapper.encode(remote_url, default_domain=conf.target_domain, escaped=escaped)
+            # decode(encode(x)) == x
+            result = mapper.decode_url(mirror_url)
+            assert result[0] == split.netloc, (url, mirror_url, result)
+            assert result[3] == (esc_str(expected) if escaped else expected), (url, mirror_url, result)
+            assert result[2] == result[3].partition("?")[0], (url, mirror_url, result)
+        # 与旧实现的区别: path末尾的斜线不再被去掉, 中间的 // . .. 不再被合并, "a:b" 这样的path不再被当作url
+        mirror_url = mapper.encode(url, default_domain=conf.target_domain)
+        if mirror_url != _old_encode(conf, url, conf.target_domain):
+            differs += 1
+            path = split.path.lstrip("/")
+            assert path[-1:] == "/" or "//" in path or ":" in path or "." in path, (url, mirror_url)
+    print("%d random urls: decode(encode(url)) == url, %d differ from the old encoder" % (len(urls), differs))
+
+    samples = urls[:200]
+    # 每个请求解码的是 path+query
+    mirror_samples = [path_and_query(*split_url(mapper.encode(u))[2:4]) for u in samples]
+    cached = UrlMapper(conf, G.domain_index)
+    for name, func in (
+        ("urlsplit", lambda: [urlsplit(u) for u in samples]),
+        ("split_url", lambda: [split_url(u) for u in samples]),
+        ("old encode", lambda: [_old_encode(conf, u, conf.target_domain) for u in samples]),
+        ("encode", lambda: [mapper.encode(u) for u in samples]),
+        ("encode (cached)", lambda: [cached.encode(u) for u in samples]),
+        ("decode", lambda: [mapper.decode(u) for u in mirror_samples]),
+        ("decode (cached)", lambda: [cached.decode(u) for u in mirror_samples]),
+    ):
+        cost = timeit.timeit(func, number=100) / 100 / len(samples)
+        print("%-16s %.2f us per url" % (name, cost * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -209,9 +209,41 @@ def inject_content_head_last(html, content):
     return html[:head_end_pos] + content + html[head_end_pos:]
 
 
+# 快照中不保存的请求头和设置项(名称中含有这些词的), 只保留 REDACTED
+_SNAPSHOT_SECRET_HEADERS = frozenset(("authorization", "proxy-authorization", "cookie", "set-cookie"))
+_snapshot_secret_name_regex = re.compile(r"token|passw|secret|credential|proxy|auth", flags=re.IGNORECASE)
+REDACTED = "<redacted>"
+
+
+def _redact_headers(headers):
+    """
+    :type headers: Union[dict, werkzeug.datastructures.Headers, None]
+    :rtype: Union[dict, None]
+    """
+    if headers is None:
+        return None
+    return {k: REDACTED if k.lower() in _SNAPSHOT_SECRET_HEADERS else v for k, v in headers.items()}
+
+
+def _request_snapshot(request):
+    """
+    浏览器请求的快照, 只读取不会触发读取请求体的属性(不使用 .data .form .json 等)
+    :rtype: dict
+    """
+    return {
+        "method": request.method,
+        "url": request.url,
+        "remote_addr": request.remote_addr,
+        "content_type": request.content_type,
+        "content_length": request.content_length,
+        "headers": _redact_headers(request.headers),
+    }
+
+
 def dump_zmirror_snapshot(parse, request, root="error_dump", msg=None, our_response=None):
     """
     dump当前状态到文件
+    密钥(设置中的 admin_token, 代理设置等)以及 Authorization, Cookie 请求头不会被保存
     :param root: 文件夹名
     :type root: str
     :param our_response: Flask返回对象, 可选
@@ -223,25 +255,31 @@ def dump_zmirror_snapshot(parse, request, root="error_dump", msg=None, our_respo
     """
 
     try:
-        if not os.path.exists(root(root)):
-            os.mkdir(root(root))
-        _time_str = datetime.now().strftime("snapshot_%Y-%m-%d_%H-%M-%S")
+        if not os.path.exists(root):
+            os.mkdir(root)
+        _time_str = datetime.now().strftime("snapshot_%Y-%m-%d_%H-%M-%S_%f")
 
         import config
 
+        parse_dump = parse.dump()
+        parse_dump["client_header"] = _redact_headers(parse_dump["client_header"])
         snapshot = {
             "time": datetime.now(),
-            "parse": parse.dump(),
+            # 只保存字符串形式, 避免pickle远程响应时读取整个响应体
+            "parse": {k: str(v)[:1024] for k, v in parse_dump.items()},
             "msg": msg,
             "traceback": traceback.format_exc(),
-            "config": attributes(config, to_dict=True),
-            "FlaskRequest": attributes(request, to_dict=True),
+            "config": {
+                k: REDACTED if _snapshot_secret_name_regex.search(k) else v
+                for k, v in attributes(config, to_dict=True).items()
+            },
+            "FlaskRequest": _request_snapshot(request),
         }
         if our_response is not None:
             our_response.freeze()
         snapshot["OurResponse"] = our_response
 
-        dump_file_path = os.path.abspath(os.path.join(root(root), _time_str + ".dump"))
+        dump_file_path = os.path.abspath(os.path.join(root, _time_str + ".dump"))
 
         with open(dump_file_path, "wb") as fp:
             pickle.dump(snapshot, fp, pickle.HIGHEST_PROTOCOL)
@@ -253,10 +291,14 @@ def dump_zmirror_snapshot(parse, request, root="error_dump", msg=None, our_respo
 def attributes(var, to_dict=False, max_len=1024):
     output = {} if to_dict else ""
     for name in dir(var):
-        if name[0] != "_" and name[-2:] != "__":
+        if name[0] == "_":
             continue
 
-        value = str(getattr(var, name))
+        try:
+            value = str(getattr(var, name))
+        except Exception:
+            # 比如 flask.Request.json 在请求不是json时会抛出异常
+            continue
         if max_len:
             length = len(value)
             if length > max_len: